@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+Times the stages of a build on synthetic TEI (see unbind.synthetic) at
+several scales, so that regressions and the way each stage scales can be
+seen without a copy of the sga data:
+
+    python bench.py
+    python bench.py --pages 10,100,500 --repeat 5 --json bench.json
+"""
+
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import timeit
+
+from unbind import tei, synthetic
+from unbind.shared_canvas import Manifest
+
+URI = "http://example.com/manifests/synthetic/Manifest.jsonld"
+
+STAGES = ["tei.Surface", "tei.Document", "Manifest._build", "Manifest.jsonld", "direct jsonld"]
+
+
+def bench(tei_file, repeat=3):
+    """
+    Returns the best time in seconds of each stage of building a manifest
+    for a TEI document out of repeat runs.
+    """
+    doc = tei.Document(tei_file)
+    doc.surfaces
+    manifest = Manifest(doc, URI)
+    stages = {
+        "tei.Surface": lambda: [tei.Surface(f, doc) for f in doc.filenames],
+        "tei.Document": lambda: tei.Document(tei_file).surfaces,
+        "Manifest._build": lambda: Manifest(doc, URI),
+        "Manifest.jsonld": manifest.jsonld,
+        "direct jsonld": lambda: Manifest(doc, URI, direct=True).jsonld(),
+    }
+    times = {}
+    for stage in STAGES:
+        times[stage] = min(timeit.repeat(stages[stage], number=1, repeat=repeat))
+    return times
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark unbind on synthetic TEI.")
+    parser.add_argument('--pages', default='5,25,100', help="Comma separated page counts to benchmark (default: 5,25,100).")
+    parser.add_argument('--zones', type=int, default=3, help="Zones per surface (default: 3).")
+    parser.add_argument('--lines', type=int, default=20, help="Lines in the main zone of a surface (default: 20).")
+    parser.add_argument('--adds', type=float, default=0.2, help="Chance of a line having an add (default: 0.2).")
+    parser.add_argument('--deletes', type=float, default=0.2, help="Chance of a line having a del (default: 0.2).")
+    parser.add_argument('--spans', type=float, default=0.05, help="Chance of a line having an addSpan or delSpan and its anchor (default: 0.05).")
+    parser.add_argument('--milestones', type=float, default=0.05, help="Chance of a line having a milestone and its anchor (default: 0.05).")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs to take the best time of (default: 3).")
+    parser.add_argument('--json', dest='json', help="Also write the results to this file.")
+    parser.add_argument('--keep', dest='keep', help="Generate the TEI in this directory and keep it.")
+    args = parser.parse_args(argv)
+
+    directory = args.keep or tempfile.mkdtemp(prefix="unbind-bench-")
+    results = []
+    try:
+        print("%8s  %s" % ("pages", "  ".join("%16s" % s for s in STAGES)))
+        for pages in [int(p) for p in args.pages.split(',')]:
+            tei_file = synthetic.generate(directory, "ox-bench_%s" % pages, pages=pages,
+                                          zones=args.zones, lines=args.lines, adds=args.adds,
+                                          deletes=args.deletes, spans=args.spans,
+                                          milestones=args.milestones)
+            times = bench(tei_file, args.repeat)
+            results.append({"pages": pages, "seconds": times})
+            print("%8s  %s" % (pages, "  ".join("%15.3fs" % times[s] for s in STAGES)))
+            sys.stdout.flush()
+    finally:
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump({"options": vars(args), "results": results}, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
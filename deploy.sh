@@ -1,14 +1,13 @@
 sga="/Users/ed/Projects/sga"
 user="ubuntu"
 ip="shelleygodwinarchive.org"
-host="shelleygodwinarchive.org"
-ids=(a b c1 c2)
+build="$sga/build/manifests"
+deployed="$sga/build/deployed.json"
 
-for id in ${ids[*]}
-do
-    tei="$sga/data/tei/ox/ox-frankenstein_notebook_$id.xml"
-    echo "generating Manifest.jsonld for $tei"
-    bin/unbind $tei http://$host/data/ox/ox-frankenstein-notebook_$id/Manifest.jsonld > Manifest.jsonld
-    echo "deploying Manifest.jsonld to $ip"
-    scp Manifest.jsonld $user@$ip:/usr/share/nginx/static/data/ox/ox-frankenstein-notebook_$id/
-done
+# ship the manifests unbind_all.sh built that changed since the last
+# deploy, and delete the ones that are no longer built
+echo "deploying the changed manifests in $build to $ip"
+bin/unbind publish --remote $user@$ip --dest /usr/share/nginx/static/manifests \
+    $build/catalog.json $deployed > deploy-commands.sh \
+    && sh -e deploy-commands.sh && cp $build/catalog.json $deployed
+rm -f deploy-commands.sh
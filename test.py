@@ -1,15 +1,37 @@
 #!/usr/bin/env python
 
+import io
+import os
+import glob
+import gzip
 import json
+import pickle
+import re
+import sys
+import signal
+import pstats
 import pytest
+import teizone
 
 from rdflib.plugin import register, Parser
 from rdflib import ConjunctiveGraph, URIRef, RDF
+from rdflib.compare import isomorphic
 
-from unbind.tei import Document, Surface
-from unbind.shared_canvas import Manifest
+from unbind.tei import Document, Surface, LineOffsetHandler, PageSelection, Line
+from unbind.cache import SurfaceCache
+from unbind.header import Header
+from unbind.sidecar import Sidecar
+from unbind.catalog import Catalog, commands
+from unbind.stats import Stats
+from unbind import stats as stats_module
+from unbind.profiler import Profiler
+from unbind.watch import Watcher
+from unbind.serve import ManifestServer
+from unbind.shared_canvas import Manifest, PLACE_CSS, RENDER_CSS
+from unbind import batch, coordinates, synthetic, tei
 from unbind.namespaces import SGA
 
+from xml.sax import make_parser
 from xml.etree import ElementTree as etree
 
 
@@ -18,6 +40,34 @@ def test_doc():
     d = Document(tei_file)
     assert len(d.surfaces) == 36
 
+def test_doc_jobs():
+    tei_file = "sga/data/tei/ox/ox-frankenstein_notebook_c1.xml"
+    d1 = Document(tei_file)
+    d2 = Document(tei_file, jobs=2)
+    assert [s.xmlid for s in d2.surfaces] == [s.xmlid for s in d1.surfaces]
+    assert list(d2.ranges.items()) == list(d1.ranges.items())
+    assert d2.section_loci_pages_only == d1.section_loci_pages_only
+    assert [len(s.zones) for s in d2.surfaces] == [len(s.zones) for s in d1.surfaces]
+
+def test_doc_pages():
+    tei_file = "sga/data/tei/ox/ox-frankenstein_notebook_c1.xml"
+    d = Document(tei_file, pages="2-3,ox-frankenstein_notebook_c1-0010")
+    assert [s.page for s in d.surfaces] == [2, 3, 10]
+    assert d.surfaces[2].xmlid == "ox-frankenstein_notebook_c1-0010"
+
+    m = Manifest(tei_file, 'http://example.com/frankenstein.json', page=5, direct=True)
+    assert len(m.tei.surfaces) == 1
+    assert count_type(m.jsonld(), 'sc:Canvas') == 1
+
+def test_page_selection():
+    pages = PageSelection("1, 3-5,#ox-frankenstein_notebook_c1-0010")
+    assert pages.numbers == set([1, 3, 4, 5])
+    assert pages.ids == set(["ox-frankenstein_notebook_c1-0010"])
+    assert PageSelection(7).numbers == set([7])
+    assert PageSelection([2, "4-5"]).numbers == set([2, 4, 5])
+    with pytest.raises(ValueError):
+        PageSelection("5-3")
+
 def test_surface():
     tei_file = "sga/data/tei/ox/ox-ms_abinger_c58/ox-ms_abinger_c58-0001.xml"
     s = Surface(tei_file)
@@ -67,6 +117,125 @@ def test_add():
     z = s.zones[2]
     assert len(z.adds) == 3
 
+def test_spans(tmpdir):
+    tei_file = tmpdir.join("surface.xml")
+    tei_file.write('''<surface xmlns="http://www.tei-c.org/ns/1.0" ulx="0" uly="0" lrx="100" lry="100" xml:id="s1">
+<zone type="main">
+<line>aa<addSpan spanTo="#x"/>bb<delSpan spanTo="#x" rend="strikethrough"/>cc</line>
+<line>dd<anchor xml:id="x"/>ee<addSpan spanTo="#never"/>ff</line>
+</zone>
+</surface>''')
+    s = Surface(str(tei_file))
+    z = s.zones[0]
+    assert [(a.begin, a.end) for a in z.adds] == [(4, 11), (13, 0)]
+    assert [(d.begin, d.end) for d in z.deletes] == [(6, 11)]
+    assert s.unclosed_spans == [(13, 'addSpan', 'never')]
+
+def test_zone_table(tmpdir):
+    tei_file = tmpdir.join("surface.xml")
+    tei_file.write('''<surface xmlns="http://www.tei-c.org/ns/1.0" ulx="0" uly="0" lrx="100" lry="100" xml:id="s1">
+<zone type="main">
+<line hand="#pbs">aa<add place="superlinear">bb</add></line>
+<line hand="#pbs" rend="center">cc<hi rend="underline">dd</hi></line>
+</zone>
+</surface>''')
+    s = Surface(str(tei_file))
+    table = s.zone_table
+    assert len(table) == 4
+    assert list(table.kind) == [0, 0, 2, 4]
+    assert table.values.count('pbs') == 1
+
+    # the views stand in for the objects the handler built
+    lines = s.zones[0].lines
+    assert isinstance(lines[1], Line)
+    assert (lines[1].begin, lines[1].end, lines[1].hand, lines[1].rend) == (7, 11, 'pbs', 'center')
+    assert s.zones[0].adds[0].place == 'superlinear'
+    assert not hasattr(s.zones[0].adds[0], 'in_work')
+
+    s2 = pickle.loads(pickle.dumps(s, pickle.HIGHEST_PROTOCOL))
+    assert [(l.begin, l.end) for l in s2.zones[0].lines] == [(l.begin, l.end) for l in lines]
+
+    # the values shared between tables don't grow without bound, and the
+    # ones still in use stay shared
+    tei._interned_values.clear()
+    kept = tei._interned(u"value 0")
+    for i in range(1, tei._INTERNED_MAX + 10):
+        tei._interned(u"value %s" % i)
+        assert tei._interned(u"".join([u"value ", u"0"])) is kept
+    assert len(tei._interned_values) == tei._INTERNED_MAX
+    assert u"value 1" not in tei._interned_values
+
+def test_register_handler(tmpdir):
+    tei_file = tmpdir.join("surface.xml")
+    tei_file.write('''<surface xmlns="http://www.tei-c.org/ns/1.0" ulx="0" uly="0" lrx="100" lry="100" xml:id="s1">
+<zone type="main">
+<line>aa<gap reason="illegible"/>bb</line>
+</zone>
+</surface>''')
+
+    class GapHandler(LineOffsetHandler):
+        gaps = []
+
+    GapHandler.register("gap", start=lambda h, attrs: h.gaps.append((h.pos, attrs.get('reason'))))
+    assert "gap" not in LineOffsetHandler.start_handlers
+
+    handler = GapHandler()
+    parser = make_parser()
+    parser.setContentHandler(handler)
+    parser.parse(str(tei_file))
+    assert handler.gaps == [(4, 'illegible')]
+    assert [(l.begin, l.end) for l in handler.zones[0].lines] == [(2, 6)]
+
+def test_offsets_match_sax(tmpdir):
+    # walking the in memory tree should give the same offsets as
+    # saving it and parsing it again with a SAX parser
+    tei_file = "sga/data/tei/ox/ox-ms_abinger_c58/ox-ms_abinger_c58-0061.xml"
+    z = teizone.Surface(tei_file)
+    z.guess_coordinates()
+    saved = str(tmpdir.join("surface.xml"))
+    z.save(saved)
+    handler = LineOffsetHandler()
+    parser = make_parser()
+    parser.setContentHandler(handler)
+    parser.parse(saved)
+
+    s = Surface(tei_file)
+    assert len(s.zones) == len(handler.zones)
+    for z1, z2 in zip(s.zones, handler.zones):
+        assert (z1.begin, z1.end, z1.xywh) == (z2.begin, z2.end, z2.xywh)
+        for k in ('lines', 'adds', 'deletes', 'highlights', 'spaces'):
+            offsets1 = [(a.begin, a.end) for a in getattr(z1, k)]
+            offsets2 = [(a.begin, a.end) for a in getattr(z2, k)]
+            assert offsets1 == offsets2
+
+def test_cache(tmpdir):
+    tei_file = "sga/data/tei/ox/ox-frankenstein_notebook_c1.xml"
+    cache = SurfaceCache(str(tmpdir))
+    d1 = Document(tei_file, cache=cache)
+    assert cache.misses == 36
+    d2 = Document(tei_file, cache=cache)
+    assert cache.hits == 36
+    assert d2.ranges == d1.ranges
+    assert d2.section_loci_pages_only == d1.section_loci_pages_only
+    l1 = d1.surfaces[0].zones[-1].lines[0]
+    l2 = d2.surfaces[0].zones[-1].lines[0]
+    assert (l2.begin, l2.end, l2.hand) == (l1.begin, l1.end, l1.hand)
+
+    cache.max_size = 0
+    assert cache.prune() == 36
+    Document(tei_file, cache=cache)
+    assert cache.misses == 72
+
+def test_cache_jobs(tmpdir, synthetic_tei):
+    # lookups made in the pool's processes are counted in this one
+    tei_file = synthetic_tei(pages=3)
+    cache = SurfaceCache(str(tmpdir.join("cache")))
+    assert len(Document(tei_file, cache=cache, jobs=2).surfaces) == 3
+    assert (cache.hits, cache.misses) == (0, 3)
+    d = Document(tei_file, cache=cache, jobs=2)
+    assert not any(hasattr(s, 'cached') for s in d.surfaces)
+    assert (cache.hits, cache.misses) == (3, 3)
+
 def test_jsonld():
     # generate shared canvase json-ld
     tei_file = "sga/data/tei/ox/ox-frankenstein_notebook_c1.xml"
@@ -100,8 +269,13 @@ def test_jsonld():
     # check the content annotations
     assert count_type(jsonld, 'sc:ContentAnnotation') == 90
    
-    # css should be there
-    assert count_type(jsonld, 'cnt:ContentAsText') == 61
+    # css should be there: the 61 styled annotations share one node for
+    # each style they use
+    css = [r['chars'] for r in jsonld['@graph'] if r.get('@type') == 'cnt:ContentAsText']
+    refs = style_refs(jsonld)
+    assert len(refs) == 61
+    assert len(css) == len(set(refs)) == len(set(css))
+    assert set(css) <= set(PLACE_CSS.values()) | set(RENDER_CSS.values())
 
     # parse the json-ld as rdf
     register('json-ld', Parser, 'rdflib_jsonld.parser', 'JsonLDParser')
@@ -114,6 +288,457 @@ def test_jsonld():
     line_anns = list(g.triples((None, RDF.type, SGA.LineAnnotation)))
     assert len(line_anns) == 638
 
+def test_jsonld_direct(synthetic_tei):
+    tei_file = synthetic_tei(pages=2, lines=3)
+    manifest_uri = 'http://example.com/synthetic.json'
+    d = Document(tei_file)
+    jsonld = Manifest(d, manifest_uri).jsonld()
+    direct = Manifest(d, manifest_uri, direct=True).jsonld()
+    assert direct['@context'] == jsonld['@context']
+    for t in ['sc:Canvas', 'sc:ContentAnnotation', 'cnt:ContentAsText', 'sga:LineAnnotation']:
+        assert count_type(direct, t) == count_type(jsonld, t)
+
+    # both describe the same graph
+    register('json-ld', Parser, 'rdflib_jsonld.parser', 'JsonLDParser')
+    g1 = ConjunctiveGraph()
+    g1.parse(data=json.dumps(jsonld), format='json-ld')
+    g2 = ConjunctiveGraph()
+    g2.parse(data=json.dumps(direct), format='json-ld')
+    assert isomorphic(g1, g2)
+    assert g2.value(URIRef(manifest_uri), RDF.type) == URIRef('http://www.shared-canvas.org/ns/Manifest')
+
+def test_stream(tmpdir):
+    tei_file = "sga/data/tei/ox/ox-frankenstein_notebook_c1.xml"
+    manifest_uri = 'http://example.com/frankenstein.json'
+    d = Document(tei_file, stream=True)
+    assert d.surfaces is None
+    path = tmpdir.join("manifest.jsonld")
+    with open(str(path), "w") as fh:
+        Manifest(d, manifest_uri).write(fh)
+    streamed = json.load(open(str(path)))
+    direct = Manifest(tei_file, manifest_uri, direct=True).jsonld()
+    assert streamed == direct
+    assert list(d.ranges.keys()) == list(Document(tei_file).ranges.keys())
+
+def test_sidecar(tmpdir):
+    tei_file = "sga/data/tei/ox/ox-frankenstein_notebook_c1.xml"
+    manifest_uri = 'http://example.com/frankenstein.json'
+    path = str(tmpdir.join("manifest.sidecar"))
+    direct = Manifest(tei_file, manifest_uri, direct=True).jsonld()
+
+    m = Manifest(tei_file, manifest_uri, sidecar=Sidecar.load(path))
+    assert m.jsonld() == direct
+    assert len(m.sidecar.pages) == 36
+    m.sidecar.save(path)
+
+    # nothing changed so no surface is parsed
+    cache = SurfaceCache(str(tmpdir.join("cache")))
+    m = Manifest(tei_file, manifest_uri, cache=cache, sidecar=Sidecar.load(path))
+    assert m.jsonld() == direct
+    assert cache.hits + cache.misses == 0
+
+    # unless the manifest is built differently
+    m = Manifest(tei_file, manifest_uri, cache=cache, skip_annos=True, sidecar=Sidecar.load(path))
+    m.jsonld()
+    assert cache.misses == 36
+
+def test_sidecar_moved(tmpdir, synthetic_tei):
+    tei_file = synthetic_tei(pages=3)
+    uri = 'http://example.com/synthetic.json'
+    path = str(tmpdir.join("manifest.sidecar"))
+    m = Manifest(tei_file, uri, sidecar=Sidecar.load(path))
+    m.jsonld()
+    m.sidecar.save(path)
+
+    # a surface that moves is built again, for its new urls
+    surface = Document(tei_file).filenames[1]
+    moved = os.path.join(os.path.dirname(tei_file), "moved", os.path.basename(surface))
+    os.makedirs(os.path.dirname(moved))
+    os.rename(surface, moved)
+    with open(tei_file) as fh:
+        xml = fh.read()
+    with open(tei_file, "w") as fh:
+        fh.write(xml.replace("ox-synthetic_notebook/ox-synthetic_notebook-0002.xml", "moved/ox-synthetic_notebook-0002.xml"))
+    stats = Stats()
+    jsonld = Manifest(tei_file, uri, sidecar=Sidecar.load(path), stats=stats).jsonld()
+    assert stats.counts["surfaces.parsed"] == 1
+    assert jsonld == Manifest(tei_file, uri, direct=True).jsonld()
+    assert any('/tei/ox/moved/ox-synthetic_notebook-0002.xml' in json.dumps(n) for n in jsonld['@graph'])
+
+def test_synthetic(synthetic_tei):
+    # synthetic TEI works without the sga data
+    tei_file = synthetic_tei(pages=4)
+    d = Document(tei_file)
+    assert len(d.surfaces) == 4
+    assert list(d.ranges.keys()) == ["Chapter 1", "Mont Blanc", "Chapter 2"]
+    jsonld = Manifest(d, 'http://example.com/synthetic.json', direct=True).jsonld()
+    assert count_type(jsonld, 'sc:Canvas') == 4
+    assert count_type(jsonld, 'sga:LineAnnotation') == 4 * (5 + 2 + 2)
+
+    # annotations with the same style share its node
+    for j in [jsonld, Manifest(d, 'http://example.com/synthetic.json').jsonld()]:
+        assert len(style_refs(j)) == 7
+        assert len(set(style_refs(j))) == count_type(j, 'cnt:ContentAsText') == 3
+
+    # every milestone starts a segment of Mont Blanc
+    milestones = sum(open(f).read().count("<milestone") for f in d.filenames)
+    assert milestones > 0
+    assert count_type(jsonld, 'sga:SegmentAnnotation') == milestones
+    segments = [seg for surface in d.surfaces for z in surface.zones for seg in z.segments]
+    assert len(segments) == milestones
+    assert set(seg.in_work for seg in segments) == set(["mont_blanc"])
+
+    # zones past the ZONE_TYPES are more left margins, with their own ids
+    d = Document(synthetic_tei(pages=1, zones=7, milestones=0))
+    assert [z.type for z in d.surfaces[0].zones][3:] == ["left_margin"] * 4
+    line_ids = re.findall(r'<line xml:id="([^"]+)"', open(d.filenames[0]).read())
+    assert len(set(line_ids)) == len(line_ids) == 5 + 6 * 2
+
+def test_header(synthetic_tei):
+    tei_file = synthetic_tei(pages=4)
+    header = Header(tei_file)
+    assert header.xmlid == "ox-synthetic_notebook"
+    assert header.title == "Frankenstein, or the Modern Prometheus and others"
+    assert header.agent == "Percy Shelley"
+    assert header.label == "Synthetic Notebook"
+    assert header.hands == {"mws": "Mary Shelley", "pbs": "Percy Shelley"}
+    assert header.main_hand == "mws"
+    assert header.loci[0] == ("ox-synthetic_notebook-0001", "frankenstein__or_the_modern_prometheus", "Chapter 1")
+
+    # the rest of the document is read as the includes are asked for
+    includes = header.includes()
+    assert next(includes) == "ox-synthetic_notebook/ox-synthetic_notebook-0001.xml"
+    assert len(list(includes)) == 3
+
+    d = Document(tei_file)
+    assert d._filenames == []
+    assert len(d.filenames) == 4
+
+def test_header_only(synthetic_tei, caplog):
+    # metadata is only read from the teiHeader
+    tei_file = synthetic_tei(pages=2)
+    with open(tei_file) as fh:
+        xml = fh.read()
+    with open(tei_file, "w") as fh:
+        fh.write(xml.replace("</sourceDoc>", "</sourceDoc>\n<msItem class=\"#work\"><bibl><title>Late</title></bibl>"
+                             "<locus target=\"#ox-synthetic_notebook-0002\"/></msItem>"))
+    header = Header(tei_file)
+    assert "Late" not in header.works
+    assert len(list(header.includes())) == 2
+    assert "ignoring <msItem> outside the teiHeader" in caplog.text
+
+def test_parsers(synthetic_tei):
+    pytest.importorskip("lxml")
+    tei_file = synthetic_tei(pages=2)
+    # lxml keeps comments and processing instructions in the tree
+    surface_file = Document(tei_file, parser="stdlib").filenames[0]
+    with io.open(surface_file, encoding="utf-8") as fh:
+        xml = fh.read()
+    with io.open(surface_file, "w", encoding="utf-8") as fh:
+        fh.write(xml.replace(u"on a dreary", u"on <!-- a -->a <?pi b?>dr\u00eb<!-- c -->ary", 1))
+
+    manifests = []
+    for parser in ["stdlib", "lxml"]:
+        d = Document(tei_file, parser=parser)
+        assert d.parser == parser
+        manifests.append(Manifest(d, 'http://example.com/synthetic.json', direct=True).jsonld())
+    assert manifests[0] == manifests[1]
+
+def test_lists(tmpdir, synthetic_tei):
+    tei_file = synthetic_tei(pages=2)
+    lists = tmpdir.join("lists")
+    m = Manifest(tei_file, 'http://example.com/m/synthetic.json', lists=str(lists))
+    jsonld = m.jsonld()
+    # the manifest only has the canvases, their images and the ranges
+    assert count_type(jsonld, 'sc:Canvas') == 2
+    assert count_type(jsonld, 'sga:LineAnnotation') == 0
+    canvas = [r for r in jsonld['@graph'] if r.get('@type') == 'sc:Canvas'][0]
+    assert canvas['otherContent'][0] == 'http://example.com/m/lists/ox-synthetic_notebook-0001-zone.jsonld'
+    assert len(canvas['otherContent']) == 4
+
+    # and each canvas has a list of annotations for every layer
+    assert len(lists.listdir()) == 2 * 4
+    text = json.loads(lists.join("ox-synthetic_notebook-0001-text.jsonld").read())
+    annotation_list = [r for r in text['@graph'] if r.get('@type') == 'sc:AnnotationList'][0]
+    assert annotation_list['@id'] == canvas['otherContent'][1]
+    assert count_type(text, 'sga:LineAnnotation') == 5 + 2 + 2
+
+def test_layers(synthetic_tei):
+    tei_file = synthetic_tei(pages=2)
+    d = Document(tei_file)
+    for direct in [True, False]:
+        m = Manifest(d, 'http://example.com/synthetic.json', direct=direct, layers="zone,text", text_types=["line"])
+        jsonld = m.jsonld()
+        assert count_type(jsonld, 'sc:Layer') == 2
+        assert count_type(jsonld, 'sc:ContentAnnotation') > 0
+        assert count_type(jsonld, 'sga:LineAnnotation') == 2 * (5 + 2 + 2)
+        assert count_type(jsonld, 'sga:DeletionAnnotation') == 0
+        assert count_type(jsonld, 'sga:AdditionAnnotation') == 0
+
+    with pytest.raises(ValueError):
+        Manifest(d, 'http://example.com/synthetic.json', layers="zones")
+
+def test_stable(tmpdir, synthetic_tei):
+    tei_file = synthetic_tei(pages=3)
+    uri = 'http://example.com/synthetic.json'
+    out = [str(tmpdir.join("a.json")), str(tmpdir.join("b.json"))]
+    for filename in out:
+        with open(filename, "w") as fh:
+            Manifest(tei_file, uri, stable=True).write(fh)
+    assert open(out[0], "rb").read() == open(out[1], "rb").read()
+
+    # the labels of a page don't depend on the other pages
+    ids = lambda m: set(n['@id'] for n in m.jsonld()['@graph'] if n['@id'].startswith('_:ox-synthetic_notebook-0002'))
+    page = ids(Manifest(tei_file, uri, stable=True))
+    assert page
+    assert page == ids(Manifest(tei_file, uri, page=2, stable=True))
+
+def test_stats(synthetic_tei):
+    tei_file = synthetic_tei(pages=3)
+    stats = Stats()
+    m = Manifest(tei_file, 'http://example.com/synthetic.json', stats=stats)
+    m.jsonld()
+    assert stats.stages["surface.offsets"]["calls"] == 3
+    for stage in ["document.parse", "manifest.graph", "manifest.serialize", "manifest.compact"]:
+        assert stats.stages[stage]["seconds"] > 0
+    assert stats.counts["surfaces.parsed"] == 3
+    assert stats.counts["annotations.LineAnnotation"] == 3 * (5 + 2 + 2)
+    assert stats.counts["triples"] == len(m.g)
+    assert [s["page"] for s in stats.surfaces] == [1, 2, 3]
+
+def test_stats_memory(monkeypatch):
+    # stages record how much they raised the peak memory, not the peak
+    peaks = iter([1000, 1500, 1500, 1500, 1500, 1800])
+    monkeypatch.setattr(stats_module, "max_rss_kb", lambda: next(peaks))
+    stats = Stats()
+    with stats.stage("parse"):
+        pass
+    with stats.stage("emit"):
+        pass
+    with stats.stage("emit"):
+        pass
+    assert stats.stages["parse"]["rss_growth_kb"] == 500
+    assert stats.stages["emit"]["rss_growth_kb"] == 300
+
+def test_profile(tmpdir, synthetic_tei):
+    tei_file = synthetic_tei(pages=5)
+    profiler = Profiler()
+    profiler.start()
+    with profiler.label("document:synthetic"):
+        Manifest(tei_file, 'http://example.com/synthetic.json', stats=profiler).jsonld()
+        # the timer may not fire in a short build, so take a sample too
+        with profiler.stage("sample"):
+            profiler._sample(signal.SIGPROF, sys._getframe())
+    profiler.stop()
+    prefix = str(tmpdir.join("build"))
+    profiler.save_profile(prefix)
+
+    profile = pstats.Stats(prefix + ".pstats")
+    assert any(f == "jsonld" and os.path.basename(path) == "shared_canvas.py"
+               for path, line, f in profile.stats)
+    stacks = [line.rsplit(" ", 1)[0] for line in open(prefix + ".folded")]
+    assert any(s.startswith("document:synthetic;stage:sample;") and ";test_profile (test.py:" in s
+               for s in stacks)
+    assert profiler.stages["manifest.compact"]["calls"] == 1
+
+def test_batch(tmpdir):
+    tei_file = "sga/data/tei/ox/ox-frankenstein_notebook_c1.xml"
+    uri = 'http://example.com/manifests/{id}/{name}'
+    written = batch.build([tei_file], uri, out_dir=str(tmpdir), root="sga/data/tei")
+    assert written == [
+        str(tmpdir.join("ox/ox-frankenstein_notebook_c1/Manifest.jsonld")),
+        str(tmpdir.join("ox/ox-frankenstein_notebook_c1/Manifest-index.jsonld"))
+    ]
+
+    full = json.load(open(written[0]))
+    assert count_type(full, 'sc:ContentAnnotation') == 90
+    index = json.load(open(written[1]))
+    assert count_type(index, 'sc:ContentAnnotation') == 0
+    assert count_type(index, 'sc:Canvas') == 36
+    ids = [r['@id'] for r in index['@graph']]
+    assert 'http://example.com/manifests/ox/ox-frankenstein_notebook_c1/Manifest-index.jsonld' in ids
+
+def test_materialize_coords(tmpdir, synthetic_tei):
+    tei_file = synthetic_tei(pages=3)
+    uri = 'http://example.com/synthetic.json'
+    before = Manifest(tei_file, uri, direct=True).jsonld()
+    surfaces = Document(tei_file).filenames
+    assert all(coordinates.materialize(f) is not None for f in surfaces)
+    os.chmod(surfaces[0], 0o640)
+    os.chmod(surfaces[1], 0o755)
+    assert all(coordinates.materialize_file(f) for f in surfaces)
+    assert all(coordinates.materialize(f) is None for f in surfaces)
+
+    # the files keep their modes
+    assert [os.stat(f).st_mode & 0o777 for f in surfaces[:2]] == [0o640, 0o755]
+
+    # the coordinates are no longer guessed, and come out the same
+    stats = Stats()
+    assert Manifest(tei_file, uri, direct=True, stats=stats).jsonld() == before
+    assert stats.counts.get("surfaces.guessed") is None
+
+    # the pagination of abinger d 33 is moved, even if it has coordinates
+    d33 = str(tmpdir.join("ox-ms_abinger_d33-0001.xml"))
+    with open(surfaces[0]) as fh:
+        xml = fh.read()
+    with open(d33, "w") as fh:
+        fh.write(xml)
+    assert coordinates.materialize_file(d33)
+    zones = Surface(d33).zones
+    assert [z.ulx for z in zones if z.type == "pagination"] == ["150"]
+    with open(d33) as fh:
+        assert fh.read() == xml.replace('type="pagination" ulx="4328"', 'type="pagination" ulx="150"')
+
+def test_compact(tmpdir, synthetic_tei):
+    tei_file = synthetic_tei(pages=2)
+    uri = 'http://example.com/manifests/{id}/{name}'
+    out_dir = str(tmpdir.join("out"))
+    written = batch.build([tei_file], uri, out_dir=out_dir, direct=True, lists=True, indent=None, compress="gz")
+    for path in written + glob.glob(os.path.join(out_dir, "*", "lists", "*.jsonld")):
+        with open(path, "rb") as fh:
+            data = fh.read()
+        assert b"\n" not in data.rstrip() and b'": ' not in data
+        assert gzip.open(path + ".gz").read() == data
+
+    # the same JSON-LD as the indented manifest, whichever way it is built
+    for direct in [True, False]:
+        m = Manifest(tei_file, 'http://example.com/synthetic.json', direct=direct)
+        fh = io.BytesIO()
+        m.write(fh, indent=None)
+        compact = json.loads(fh.getvalue())
+        jsonld = m.jsonld()
+        assert len(compact['@graph']) == len(jsonld['@graph'])
+        assert count_type(compact, 'sga:LineAnnotation') == count_type(jsonld, 'sga:LineAnnotation')
+        if direct:
+            assert compact == json.loads(json.dumps(jsonld))
+
+    with pytest.raises(ValueError):
+        batch.build([tei_file], uri, out_dir=out_dir, compress="zip")
+
+def test_catalog(tmpdir, synthetic_tei):
+    tei_file = synthetic_tei(pages=3)
+    uri = 'http://example.com/manifests/{id}/{name}'
+    out_dir = str(tmpdir.join("out"))
+    published = Catalog()
+    built = Catalog()
+    batch.build([tei_file], uri, out_dir=out_dir, lists=True, stable=True, catalog=built)
+    assert len(built.documents["ox-synthetic_notebook"]) == 4
+    steps = built.plan(published)
+    assert len(steps) == 2 + 3 * 4
+    assert set(a for a, p in steps) == set(["copy"])
+    # the manifests go live after the lists they refer to
+    assert [p for a, p in steps[-2:]] == ["ox-synthetic_notebook/Manifest-index.jsonld", "ox-synthetic_notebook/Manifest.jsonld"]
+    assert all("/lists/" in p for a, p in steps[:-2])
+
+    # only what the changed surface is in is copied again
+    built.save(str(tmpdir.join("catalog.json")))
+    published = Catalog.load(str(tmpdir.join("catalog.json")))
+    surface = Document(tei_file).filenames[1]
+    with open(surface) as fh:
+        xml = fh.read()
+    with open(surface, "w") as fh:
+        fh.write(xml.replace("</line>", " more</line>", 1))
+    batch.build([tei_file], uri, out_dir=out_dir, lists=True, stable=True, catalog=built)
+    steps = built.plan(published)
+    assert steps and all(p.startswith("ox-synthetic_notebook/lists/ox-synthetic_notebook-0002-") for a, p in steps)
+
+    # files that are no longer built are deleted
+    batch.build([tei_file], uri, out_dir=out_dir, variants=["full"], stable=True, catalog=built)
+    steps = built.plan(published)
+    assert ("copy", "ox-synthetic_notebook/Manifest.jsonld") in steps
+    assert ("delete", "ox-synthetic_notebook/Manifest-index.jsonld") in steps
+    assert len([a for a, p in steps if a == "delete"]) == 1 + 3 * 4
+
+    # the steps as commands, here or on another host
+    steps = [("copy", "doc/Manifest.jsonld"), ("delete", "doc/lists/page.jsonld")]
+    assert commands(steps, "out", "/srv/www") == [
+        "mkdir -p /srv/www/doc",
+        "cp out/doc/Manifest.jsonld /srv/www/doc/Manifest.jsonld",
+        "rm -f /srv/www/doc/lists/page.jsonld",
+    ]
+    assert commands(steps, "out", "/srv/www", "me@example.com") == [
+        "ssh me@example.com 'mkdir -p /srv/www/doc'",
+        "scp out/doc/Manifest.jsonld me@example.com:/srv/www/doc/Manifest.jsonld",
+        "ssh me@example.com 'rm -f /srv/www/doc/lists/page.jsonld'",
+    ]
+
+def test_batch_errors(tmpdir, synthetic_tei):
+    tei_file = synthetic_tei(pages=2)
+    missing = str(tmpdir.join("tei", "data", "tei", "ox", "ox-missing.xml"))
+    uri = 'http://example.com/manifests/{id}/{name}'
+    built = Catalog()
+    with pytest.raises(batch.BuildError) as e:
+        batch.build([missing, tei_file], uri, out_dir=str(tmpdir.join("out")), catalog=built)
+    assert e.value.failed == [missing]
+    assert len(e.value.written) == 2
+    assert list(built.documents) == ["ox-synthetic_notebook"]
+
+def test_watch(tmpdir, synthetic_tei):
+    tei_file = synthetic_tei(pages=3)
+    stats = Stats()
+    w = Watcher([tei_file], 'http://example.com/{id}/{name}', out_dir=str(tmpdir.join("out")), direct=True, stats=stats)
+    written = w.build()
+    assert len(written) == 2
+    assert stats.counts["surfaces.parsed"] == 3
+    assert w.poll() == []
+
+    # only the surface that changed is parsed again
+    with open(w.documents[tei_file].filenames[1], "a") as fh:
+        fh.write("\n")
+    assert w.poll() == written
+    assert stats.counts["surfaces.parsed"] == 4
+    assert stats.counts["surfaces.reused"] == 2
+    assert json.load(open(written[0])) == Manifest(tei_file, 'http://example.com/ox-synthetic_notebook/Manifest.jsonld', direct=True).jsonld()
+
+def test_serve(tmpdir, synthetic_tei):
+    tei_file = synthetic_tei(pages=2)
+    app = ManifestServer(str(tmpdir.join("tei", "data", "tei")), "http://example.com/", lists=True)
+    status, headers, body = app.get("/ox/ox-synthetic_notebook/Manifest.jsonld")
+    assert status == 200
+    headers = dict(headers)
+    assert headers["Content-Type"] == "application/ld+json"
+    manifest = json.loads(body.decode('utf-8'))
+    canvas = [r for r in manifest['@graph'] if r.get('@type') == 'sc:Canvas'][0]
+    assert canvas['otherContent'][0] == 'http://example.com/ox/ox-synthetic_notebook/lists/ox-synthetic_notebook-0001-zone.jsonld'
+    status, h, body = app.get("/ox/ox-synthetic_notebook/lists/ox-synthetic_notebook-0001-text.jsonld")
+    assert status == 200
+    assert count_type(json.loads(body.decode('utf-8')), 'sga:LineAnnotation') == 5 + 2 + 2
+
+    # conditional requests
+    status, h, body = app.get("/ox/ox-synthetic_notebook/Manifest.jsonld", {"If-None-Match": headers["ETag"]})
+    assert (status, body) == (304, b"")
+    status, h, body = app.get("/ox/ox-synthetic_notebook/Manifest.jsonld", {"If-Modified-Since": headers["Last-Modified"]})
+    assert status == 304
+
+    # and answered while another manifest is being built
+    with app._building:
+        status, h, body = app.get("/ox/ox-synthetic_notebook/Manifest.jsonld", {"If-None-Match": headers["ETag"]})
+    assert status == 304
+    assert app.get("/ox/ox-missing/Manifest.jsonld")[0] == 404
+    assert app.get("/../ox/ox-synthetic_notebook.xml")[0] == 404
+
+    # a changed surface changes the etag
+    with open(Document(tei_file).filenames[1], "a") as fh:
+        fh.write("\n")
+    status, h, body = app.get("/ox/ox-synthetic_notebook/Manifest.jsonld", {"If-None-Match": headers["ETag"]})
+    assert status == 200
+    assert dict(h)["ETag"] != headers["ETag"]
+
+    # the least recently used responses are evicted
+    app.responses.max_size = len(body)
+    app.get("/ox/ox-synthetic_notebook/Manifest-index.jsonld")
+    assert "/ox/ox-synthetic_notebook/Manifest.jsonld" not in app.responses.responses
+
+def test_document_id():
+    assert batch.document_id("sga/data/tei/ox/ox-ms_abinger_c56.xml", "sga/data/tei") == "ox/ox-ms_abinger_c56"
+
+@pytest.fixture
+def synthetic_tei(tmpdir):
+    # writes a synthetic document to tmpdir/tei and returns its filename
+    def generate(pages, lines=5, **options):
+        return synthetic.generate(str(tmpdir.join("tei")), pages=pages, lines=lines, **options)
+    return generate
+
 def get(jsonld, id):
     for o in jsonld['@graph']:
         if o['@id'] == id:
@@ -127,4 +752,9 @@ def count_type(jsonld, resource_type):
             count += 1
     return count
 
-
+def style_refs(jsonld):
+    refs = []
+    for r in jsonld['@graph']:
+        style = r.get('oa:hasStyle', [])
+        refs.extend(s['@id'] for s in (style if isinstance(style, list) else [style]))
+    return refs
@@ -1,6 +1,7 @@
+__version__ = '0.0.1'
+
 from .shared_canvas import Manifest
 
 def jsonld(tei_file):
     m = Manifest(tei_file)
     return m.jsonld()
-
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+import os
+import glob
+import logging
+import multiprocessing
+
+from collections import OrderedDict
+
+from . import tei
+from .catalog import source_hashes
+from .output import write_manifest, get_compressions
+from .shared_canvas import Manifest
+from .sidecar import Sidecar
+from .stats import NULL_STATS
+
+log = logging.getLogger(__name__)
+
+# the manifests that can be written for each document: the name of the
+# file and the options to pass to Manifest
+VARIANTS = OrderedDict([
+    ("full", ("Manifest.jsonld", {})),
+    ("index", ("Manifest-index.jsonld", {"skip_annos": True})),
+])
+
+
+def expand(patterns):
+    """
+    Returns the TEI files for a list of paths and glob patterns.
+    """
+    filenames = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        filenames.extend(matches or [pattern])
+    return filenames
+
+
+def document_id(tei_filename, root):
+    """
+    Returns the id used to name a document's manifests: the path of the
+    TEI file relative to root, without its extension.
+
+    document_id("sga/data/tei/ox/ox-ms_abinger_c56.xml", "sga/data/tei")
+    => "ox/ox-ms_abinger_c56"
+    """
+    rel = os.path.relpath(os.path.abspath(tei_filename), os.path.abspath(root))
+    return os.path.splitext(rel)[0].replace(os.sep, "/")
+
+
+def build(tei_filenames, uri_template, path_template="{id}/{name}",
+          out_dir=".", root=None, variants=("full", "index"), cache=None,
+          jobs=None, direct=False, stream=False, incremental=False,
+          lists=False, stats=None, parser=None, layers=None, text_types=None,
+          stable=False, catalog=None, indent=2, compress=()):
+    """
+    Write manifests for many TEI documents. Each document is parsed once
+    and every requested variant is generated from it. A tei.Document that
+    has already been parsed can be given in place of a path.
+
+    A document that can't be built is logged and skipped, and once the
+    others have been written a BuildError is raised that names it.
+
+    The uri_template and path_template are formatted with the document's
+    id (see document_id), the variant and the name of the manifest file,
+    e.g. "http://example.com/manifests/{id}/{name}". Paths are relative to
+    out_dir. Returns the paths that were written.
+
+    When jobs is more than one the surfaces of every document are parsed
+    with one shared pool of processes. Set direct to true to write the
+    manifests with the emitter rather than through an rdflib graph.
+
+    Set stream to true to write each manifest page by page without keeping
+    the document's surfaces in memory. Every variant then parses the
+    surfaces again, so it is best combined with a cache.
+
+    Set incremental to true to keep a sidecar.Sidecar next to each manifest
+    (its path with .sidecar added) and only parse the surfaces that changed
+    since it was written. It implies stream.
+
+    Set lists to true to write the annotations of each canvas to annotation
+    lists in a lists directory next to each manifest (see Manifest).
+
+    Optionally pass in a stats.Stats to collect timings for all of the
+    documents, or a profiler.Profiler to also label what it samples with
+    the document being built.
+
+    Optionally set parser to "lxml" or "stdlib" to choose what the TEI is
+    read with (see parsers.get_parser).
+
+    Optionally pass in the layers and text_types of annotations to include
+    in every manifest, and set stable to true to write them so that they
+    only change where their TEI does (see Manifest).
+
+    Optionally pass in a catalog.Catalog to record the files that are
+    written, with their hashes and those of the TEI they were built from,
+    so that only the ones that changed need to be published.
+
+    The manifests and lists are indented by indent spaces, or written
+    without whitespace if it is None. Optionally give the compressed copies
+    to write next to each of them, such as ["gz", "br"] (see output.write).
+    """
+    for variant in variants:
+        if variant not in VARIANTS:
+            raise ValueError("unknown manifest variant: %s" % variant)
+    compress = get_compressions(compress)
+    if root is None:
+        root = common_dir([getattr(f, 'tei_filename', f) for f in tei_filenames])
+
+    pool = None
+    if jobs and jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+
+    stats = stats or NULL_STATS
+    written = []
+    failed = []
+    try:
+        for tei_filename in tei_filenames:
+            doc = None
+            if isinstance(tei_filename, tei.Document):
+                doc, tei_filename = tei_filename, tei_filename.tei_filename
+            # the files the document is written to, which are only recorded
+            # in the catalog once they all have been
+            outputs = []
+            try:
+                with stats.label("document:" + tei_filename):
+                    if doc is None:
+                        log.info("parsing %s", tei_filename)
+                        doc = tei.Document(tei_filename, cache=cache, executor=pool,
+                                           stream=stream or incremental, stats=stats,
+                                           parser=parser)
+                    doc_id = document_id(tei_filename, root)
+                    for variant in variants:
+                        name, options = VARIANTS[variant]
+                        params = {"id": doc_id, "variant": variant, "name": name}
+                        uri = uri_template.format(**params)
+                        path = os.path.join(out_dir, path_template.format(**params))
+                        sidecar = None
+                        if incremental:
+                            sidecar = Sidecar.load(path + ".sidecar")
+                        lists_dir = None
+                        if lists:
+                            lists_dir = os.path.join(os.path.dirname(path), "lists")
+                        m = Manifest(doc, uri, direct=direct, sidecar=sidecar, stats=stats, lists=lists_dir, layers=layers, text_types=text_types, stable=stable, **options)
+                        write_manifest(path, m, indent=indent, compress=compress)
+                        if incremental:
+                            m.sidecar.save(path + ".sidecar")
+                        log.info("wrote %s", path)
+                        written.append(path)
+                        for p in [path] + [os.path.join(lists_dir, n) for n in m.list_names]:
+                            outputs.extend((f, p == path) for f in [p] + ["%s.%s" % (p, c) for c in compress])
+                    if catalog is not None:
+                        catalog.add_document(doc_id, source_hashes(doc, root))
+                        for f, is_manifest in outputs:
+                            catalog.add(os.path.relpath(f, out_dir), f, doc_id, is_manifest)
+            except Exception:
+                log.exception("couldn't build %s", tei_filename)
+                failed.append(tei_filename)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    if failed:
+        raise BuildError(failed, written)
+    return written
+
+
+class BuildError(Exception):
+    """
+    Raised by build once it has written what it could, when some of the
+    documents couldn't be built. It has the documents that failed and the
+    paths that were written.
+    """
+
+    def __init__(self, failed, written):
+        Exception.__init__(self, "couldn't build %s" % ", ".join(failed))
+        self.failed = failed
+        self.written = written
+
+
+def common_dir(filenames):
+    """
+    Returns the deepest directory that all of the files are in.
+    """
+    dirs = [os.path.dirname(os.path.abspath(f)).split(os.sep) for f in filenames]
+    common = []
+    for parts in zip(*dirs):
+        if len(set(parts)) != 1:
+            break
+        common.append(parts[0])
+    return os.sep.join(common) or os.sep
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+import os
+import time
+import json
+import errno
+import shutil
+import hashlib
+import tempfile
+
+from six.moves import cPickle as pickle
+
+from . import __version__
+
+# changes whenever the pickled surfaces do
+FORMAT = "2"
+
+
+class SurfaceCache(object):
+    """
+    An on-disk cache of parsed tei.Surface objects. Entries are keyed by a
+    hash of the surface XML, the unbind version and the Document context
+    the surface was parsed with, so a stale entry is never returned: it
+    simply stops being looked up and is eventually evicted.
+
+    cache = SurfaceCache("/var/cache/unbind", max_size=500 * 1024 * 1024)
+    d = tei.Document("/path/to/tei.xml", cache=cache)
+
+    Entries are written atomically so that several builds can share the
+    same cache directory.
+    """
+
+    def __init__(self, path, max_size=None, max_age=None):
+        """
+        Create a cache in the given directory. Optionally limit the total
+        size of the cache in bytes (max_size) and the age of its entries
+        in seconds (max_age); both are enforced by prune().
+        """
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, filename, document=None, extra=None):
+        """
+        Returns the cache key for a surface file parsed in the context of
+        an optional tei.Document.
+        """
+        return surface_key(filename, document, extra)
+
+    def get(self, key, count=True):
+        """
+        Returns the cached Surface for a key, or None if there isn't one.
+        The lookup is counted as a hit or a miss unless count is false, for
+        lookups made in another process that are counted with record().
+        """
+        surface = self._load(key)
+        if count:
+            self.record(surface is not None)
+        return surface
+
+    def record(self, hit):
+        """
+        Count a lookup as a hit or a miss.
+        """
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def put(self, key, surface):
+        """
+        Store a Surface under a key.
+        """
+        entry = self._entry(key)
+        entry_dir = os.path.dirname(entry)
+        try:
+            os.makedirs(entry_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp_filename = tempfile.mkstemp(dir=entry_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                pickle.dump(surface, fh, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_filename, entry)
+        except Exception:
+            self._remove(tmp_filename)
+            raise
+
+    def prune(self):
+        """
+        Evict entries older than max_age, and then the least recently used
+        entries until the cache is no bigger than max_size. Returns the
+        number of entries that were removed.
+        """
+        if self.max_size is None and self.max_age is None:
+            return 0
+
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for name in filenames:
+                entry = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(entry)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry))
+        entries.sort()
+
+        removed = 0
+        if self.max_age is not None:
+            cutoff = time.time() - self.max_age
+            while entries and entries[0][0] < cutoff:
+                self._remove(entries.pop(0)[2])
+                removed += 1
+        if self.max_size is not None:
+            total = sum(e[1] for e in entries)
+            while entries and total > self.max_size:
+                mtime, size, entry = entries.pop(0)
+                self._remove(entry)
+                total -= size
+                removed += 1
+        return removed
+
+    def clear(self):
+        """
+        Remove every entry from the cache.
+        """
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def _load(self, key):
+        entry = self._entry(key)
+        try:
+            with open(entry, 'rb') as fh:
+                surface = pickle.load(fh)
+        except (IOError, OSError):
+            return None
+        except Exception:
+            # a truncated or otherwise unreadable entry is just a miss
+            self._remove(entry)
+            return None
+        # bump the modification time so eviction is least recently used
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+        return surface
+
+    def _entry(self, key):
+        return os.path.join(self.path, key[:2], key[2:] + '.pickle')
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+
+def surface_key(filename, document=None, extra=None):
+    """
+    Returns a hash of everything that parsing a surface file depends on:
+    its XML, the unbind version and the context of an optional
+    tei.Document.
+    """
+    h = hashlib.sha1()
+    h.update(__version__.encode('utf-8'))
+    h.update(FORMAT.encode('utf-8'))
+    with open(filename, 'rb') as fh:
+        h.update(fh.read())
+    if document is not None:
+        h.update(document.fingerprint.encode('utf-8'))
+    if extra:
+        h.update(json.dumps(extra, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import posixpath
+
+from collections import OrderedDict
+
+from six.moves import shlex_quote
+
+from .output import write, makedirs
+
+log = logging.getLogger(__name__)
+
+# changes whenever what is recorded for an output does
+FORMAT = 1
+
+
+class Catalog(object):
+    """
+    A record of the files a batch build wrote: for each one its path
+    relative to the output directory, the hash and size of its contents and
+    the id of the document it was built from, and for each document the
+    hashes of its TEI and surface files.
+
+    catalog = Catalog.load("site/manifests/catalog.json")
+    batch.build(tei_filenames, uri_template, out_dir="site/manifests", catalog=catalog)
+    catalog.save("site/manifests/catalog.json")
+
+    Comparing the catalog of what was last published with the catalog of
+    a new build gives the files that need to be copied and deleted to
+    publish it (see plan).
+    """
+
+    def __init__(self, documents=None, outputs=None):
+        self.documents = OrderedDict(sorted((documents or {}).items()))
+        self.outputs = OrderedDict(sorted((outputs or {}).items()))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns the Catalog saved in a file, or an empty one if there is no
+        file or it can't be used.
+        """
+        try:
+            with open(path) as fh:
+                j = json.load(fh)
+        except (IOError, OSError):
+            return cls()
+        except ValueError:
+            log.warning("ignoring unreadable catalog %s", path)
+            return cls()
+        if j.get("format") != FORMAT:
+            return cls()
+        return cls(j["documents"], j["outputs"])
+
+    def save(self, path):
+        j = OrderedDict([
+            ("format", FORMAT),
+            ("documents", self.documents),
+            ("outputs", self.outputs),
+        ])
+        write(path, lambda fh: fh.write(json.dumps(j, indent=2, sort_keys=True) + "\n"))
+
+    def add_document(self, doc_id, sources):
+        """
+        Records the hashes of a document's sources (see source_hashes) and
+        forgets the files it was last built into, before they are written
+        again.
+        """
+        self.documents[doc_id] = sources
+        for path in [p for p, o in self.outputs.items() if o["document"] == doc_id]:
+            del self.outputs[path]
+
+    def add(self, path, filename, doc_id, manifest=False):
+        """
+        Records a file of a document that was written to filename, at path
+        relative to the output directory. Set manifest to true for a
+        manifest (or a copy of one), which may refer to the other files.
+        """
+        self.outputs[path.replace(os.sep, "/")] = {
+            "sha1": file_hash(filename),
+            "size": os.path.getsize(filename),
+            "document": doc_id,
+            "manifest": manifest,
+        }
+
+    def plan(self, published):
+        """
+        Returns the ("copy", path) and ("delete", path) steps that turn the
+        files in the catalog of what is published into the ones in this
+        catalog. Manifests are copied after the annotation lists and other
+        files they might refer to, and files are only deleted once every
+        copy is done, so a published manifest never refers to an annotation
+        list that isn't there.
+        """
+        copies = [path for path, output in self.outputs.items()
+                  if published.outputs.get(path, {}).get("sha1") != output["sha1"]]
+        deletes = [path for path in published.outputs if path not in self.outputs]
+        copies.sort(key=lambda path: (self.outputs[path].get("manifest", False), path))
+        return [("copy", p) for p in copies] + [("delete", p) for p in sorted(deletes)]
+
+
+def source_hashes(doc, root):
+    """
+    Returns the hashes of a tei.Document's TEI and surface files, by their
+    paths relative to root.
+    """
+    sources = OrderedDict()
+    for filename in [doc.tei_filename] + [f for n, f in doc.page_filenames()]:
+        rel = os.path.relpath(os.path.abspath(filename), os.path.abspath(root))
+        sources[rel.replace(os.sep, "/")] = file_hash(filename)
+    return sources
+
+
+def file_hash(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def commands(steps, src, dest, remote=None):
+    """
+    Returns the shell commands that carry out the steps of a plan, copying
+    from the src directory to the dest directory. With a remote host (e.g.
+    user@example.com) dest is a directory on it, copied to with scp and
+    changed with ssh.
+    """
+    lines = []
+    dirs = set()
+    for action, path in steps:
+        target = _join(dest, path)
+        if action == "copy":
+            directory = _join(dest, posixpath.dirname(path))
+            if directory not in dirs:
+                lines.append(_command(remote, "mkdir -p %s" % shlex_quote(directory)))
+                dirs.add(directory)
+            if remote:
+                lines.append("scp %s %s" % (shlex_quote(_join(src, path)), shlex_quote("%s:%s" % (remote, target))))
+            else:
+                lines.append("cp %s %s" % (shlex_quote(_join(src, path)), shlex_quote(target)))
+        else:
+            lines.append(_command(remote, "rm -f %s" % shlex_quote(target)))
+    return lines
+
+
+def run(steps, src, dest):
+    """
+    Carries out the steps of a plan, copying from the src directory to the
+    dest directory.
+    """
+    for action, path in steps:
+        target = os.path.join(dest, *path.split("/"))
+        if action == "copy":
+            makedirs(os.path.dirname(target))
+            shutil.copyfile(os.path.join(src, *path.split("/")), target)
+        elif os.path.exists(target):
+            os.remove(target)
+        log.info("%s %s", action, path)
+
+
+def _command(remote, command):
+    # a command run here, or on the remote host
+    if remote:
+        return "ssh %s %s" % (shlex_quote(remote), shlex_quote(command))
+    return command
+
+
+def _join(directory, path):
+    return directory.rstrip("/") + "/" + path if path else directory
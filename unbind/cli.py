@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import shutil
+import difflib
+import logging
+import argparse
+
+from . import batch, catalog, coordinates, tei
+from .cache import SurfaceCache
+from .shared_canvas import Manifest, LAYERS, TEXT_TYPES
+from .sidecar import Sidecar
+from .parsers import PARSERS
+from .stats import Stats, NULL_STATS
+from .profiler import Profiler
+from .watch import Watcher
+from .serve import ManifestServer
+
+log = logging.getLogger(__name__)
+
+
+def main(argv=None):
+    """
+    The unbind command line. With a TEI document and a URI it prints a
+    manifest; the first argument can also name one of the other commands:
+
+    unbind /path/to/tei.xml http://example.com/manifest.jsonld
+    unbind batch --uri 'http://example.com/{id}/{name}' /path/to/*.xml
+    unbind watch --uri 'http://example.com/{id}/{name}' /path/to/*.xml
+    unbind serve --root /path/to/tei --port 8000
+    unbind publish --dest /srv/www/manifests site/manifests/catalog.json published.json
+    unbind materialize-coords --check /path/to/*.xml
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in commands:
+        return commands[argv[0]](argv[1:])
+    return manifest(argv)
+
+
+def manifest(argv):
+    parser = argparse.ArgumentParser(description="Generate Shared Canvas manifest.")
+    parser.add_argument('tei', help='path to a TEI document')
+    parser.add_argument('uri', help='URI for the published manifest')
+    parser.add_argument('--page', dest='page', help="Only include some pages in the manifest, e.g. 3, 3-10, 1,5,7 or the xml:id of a surface.")
+    parser.add_argument('--skip-annos', dest='skip_annos', action='store_true', help="Skip text annotations.")
+    parser.add_argument('--lists', dest='lists', help="Write the annotations of each canvas to annotation lists in this directory, which the manifest refers to (implies --direct).")
+    parser.add_argument('--lists-uri', dest='lists_uri', help="URI the --lists directory is published at (default: a directory named like it next to the manifest).")
+    parser.add_argument('--sidecar', dest='sidecar', help="File recording the previous build, to only rebuild the pages that changed since; it is updated afterwards (implies --stream).")
+    add_build_arguments(parser)
+
+    args = parser.parse_args(argv)
+    stats = get_stats(args)
+    sidecar = None
+    if args.sidecar:
+        sidecar = Sidecar.load(args.sidecar)
+    with stats.label("document:" + args.tei), stats.stage("total"):
+        m = Manifest(args.tei, args.uri, page=args.page, skip_annos=args.skip_annos, cache=get_cache(args), jobs=args.jobs, direct=args.direct, stream=args.stream, sidecar=sidecar, stats=stats, parser=args.parser, lists=args.lists, lists_uri=args.lists_uri, layers=args.layers, text_types=args.text_types, stable=args.stable)
+        m.write(sys.stdout, indent=get_indent(args))
+    if sidecar is not None:
+        m.sidecar.save(args.sidecar)
+    save_stats(args, stats)
+
+
+def batch_build(argv):
+    parser = argparse.ArgumentParser(prog="unbind batch", description="Generate manifests for many TEI documents, parsing each one once.")
+    add_batch_arguments(parser)
+    parser.add_argument('--catalog', dest='catalog', help="JSON file recording the hashes of the files written and the TEI they were built from; it is updated afterwards (see unbind publish).")
+    add_build_arguments(parser)
+
+    args = parser.parse_args(argv)
+    tei_filenames = get_tei_filenames(parser, args)
+
+    build_catalog = None
+    if args.catalog:
+        build_catalog = catalog.Catalog.load(args.catalog)
+    stats = get_stats(args)
+    status = 0
+    with stats.stage("total"):
+        try:
+            batch.build(tei_filenames, args.uri, path_template=args.path,
+                        out_dir=args.out, root=args.root,
+                        variants=args.variants.split(','), cache=get_cache(args),
+                        jobs=args.jobs, direct=args.direct, stream=args.stream,
+                        incremental=args.incremental, lists=args.lists,
+                        stats=stats, parser=args.parser, layers=args.layers,
+                        text_types=args.text_types, stable=args.stable,
+                        catalog=build_catalog, indent=get_indent(args),
+                        compress=args.compress)
+        except batch.BuildError as e:
+            log.error("%s of %s documents couldn't be built", len(e.failed), len(tei_filenames))
+            status = 1
+    if build_catalog is not None:
+        build_catalog.save(args.catalog)
+    save_stats(args, stats)
+    return status
+
+
+def watch(argv):
+    parser = argparse.ArgumentParser(prog="unbind watch", description="Keep the manifests of TEI documents up to date as they are edited.")
+    add_batch_arguments(parser)
+    parser.add_argument('--interval', dest='interval', type=float, default=0.5, help="Seconds to wait between looking for changes (default: 0.5).")
+    add_build_arguments(parser)
+
+    args = parser.parse_args(argv)
+    tei_filenames = get_tei_filenames(parser, args)
+
+    stats = get_stats(args)
+    w = Watcher(tei_filenames, args.uri, path_template=args.path,
+                out_dir=args.out, root=args.root,
+                variants=args.variants.split(','), cache=get_cache(args),
+                jobs=args.jobs, direct=args.direct, stream=args.stream,
+                incremental=args.incremental, lists=args.lists, stats=stats,
+                parser=args.parser, layers=args.layers,
+                text_types=args.text_types, stable=args.stable,
+                indent=get_indent(args), compress=args.compress,
+                interval=args.interval)
+    try:
+        w.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        save_stats(args, stats)
+
+
+def serve(argv):
+    parser = argparse.ArgumentParser(prog="unbind serve", description="Serve the manifests of TEI documents over HTTP, building them when they are asked for.")
+    parser.add_argument('--root', dest='root', required=True, help="Directory of TEI documents; a manifest is served at {id}/{name}, with the path of its TEI relative to the root as the id.")
+    parser.add_argument('--host', dest='host', default='localhost', help="Host name to listen on (default: localhost).")
+    parser.add_argument('--port', dest='port', type=int, default=8000, help="Port to listen on (default: 8000).")
+    parser.add_argument('--base-uri', dest='base_uri', help="URI the manifests are published at (default: http://HOST:PORT/).")
+    parser.add_argument('--max-memory', dest='max_memory', type=int, default=256 * 1024 * 1024, help="Bytes of built manifests and annotation lists to keep in memory (default: 256MB).")
+    parser.add_argument('--lists', dest='lists', action='store_true', help="Serve the annotations of each canvas as annotation lists at {id}/lists/.")
+    parser.add_argument('--quiet', dest='quiet', action='store_true', help="Don't log requests.")
+    add_build_arguments(parser, direct=False)
+
+    args = parser.parse_args(argv)
+    if not args.quiet:
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    stats = get_stats(args)
+    base_uri = args.base_uri or "http://%s:%s/" % (args.host, args.port)
+    app = ManifestServer(args.root, base_uri, max_size=args.max_memory,
+                         lists=args.lists, cache=get_cache(args),
+                         jobs=args.jobs, parser=args.parser, stats=stats,
+                         layers=args.layers, text_types=args.text_types,
+                         stable=args.stable, indent=get_indent(args))
+    try:
+        app.serve(args.host, args.port)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        save_stats(args, stats)
+
+
+def publish(argv):
+    parser = argparse.ArgumentParser(prog="unbind publish", description="Copy the files of a batch build that changed since it was last published, and delete the ones that are gone.")
+    parser.add_argument('catalog', help="catalog of the new build (see unbind batch --catalog)")
+    parser.add_argument('published', help="catalog of what is published, which is replaced by the new one with --run; if it doesn't exist everything is copied")
+    parser.add_argument('--src', dest='src', help="Directory the build was written to (default: the directory of the catalog).")
+    parser.add_argument('--dest', dest='dest', required=True, help="Directory the files are published in.")
+    parser.add_argument('--remote', dest='remote', help="Host the files are published on, as USER@HOST: the commands copy to --dest on it with scp and change it with ssh.")
+    parser.add_argument('--run', dest='run', action='store_true', help="Copy and delete the files rather than printing the commands that would.")
+    parser.add_argument('--quiet', dest='quiet', action='store_true', help="Don't log progress.")
+
+    args = parser.parse_args(argv)
+    if args.run and args.remote:
+        parser.error("--run only publishes to a local directory; run the commands printed with --remote instead")
+    if not args.quiet:
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+    new = catalog.Catalog.load(args.catalog)
+    if not new.outputs:
+        parser.error("no files in catalog %s" % args.catalog)
+    src = args.src or os.path.dirname(args.catalog) or "."
+    steps = new.plan(catalog.Catalog.load(args.published))
+    if args.run:
+        catalog.run(steps, src, args.dest)
+        shutil.copyfile(args.catalog, args.published)
+    else:
+        for line in catalog.commands(steps, src, args.dest, args.remote):
+            sys.stdout.write(line + "\n")
+    log.info("%s files to copy, %s to delete",
+             sum(1 for a, p in steps if a == "copy"),
+             sum(1 for a, p in steps if a == "delete"))
+
+
+def materialize_coords(argv):
+    parser = argparse.ArgumentParser(prog="unbind materialize-coords", description="Write the coordinates unbind guesses for zones into the surface files of TEI documents, so that builds don't have to guess them.")
+    parser.add_argument('tei', nargs='*', help='paths or glob patterns of TEI documents')
+    parser.add_argument('--list', dest='list', help="File with the paths of TEI documents, one per line.")
+    parser.add_argument('--check', dest='check', action='store_true', help="Don't write anything, list the surface files that are missing coordinates and exit with status 1 if there are any.")
+    parser.add_argument('--diff', dest='diff', action='store_true', help="Don't write anything, print the changes that would be made as a diff.")
+    parser.add_argument('--parser', dest='parser', default='auto', choices=('auto',) + PARSERS, help="XML parser to read the TEI with (default: lxml if it is installed, else the standard library).")
+    parser.add_argument('--quiet', dest='quiet', action='store_true', help="Don't log progress.")
+
+    args = parser.parse_args(argv)
+    changed = 0
+    for tei_filename in get_tei_filenames(parser, args):
+        doc = tei.Document(tei_filename, parser=args.parser)
+        for n, filename in doc.page_filenames():
+            if not (args.check or args.diff):
+                changed += coordinates.materialize_file(filename, args.parser)
+                continue
+            xml = coordinates.materialize(filename, args.parser)
+            if xml is None:
+                continue
+            changed += 1
+            if args.check:
+                sys.stdout.write(filename + "\n")
+            else:
+                with open(filename, 'rb') as fh:
+                    old = fh.read().decode('utf-8').splitlines(True)
+                diff = difflib.unified_diff(old, xml.decode('utf-8').splitlines(True), filename, filename)
+                sys.stdout.write("".join(diff).encode('utf-8'))
+    log.info("%s surface files %s", changed, "to change" if args.check or args.diff else "changed")
+    if args.check and changed:
+        return 1
+
+
+def add_batch_arguments(parser):
+    parser.add_argument('tei', nargs='*', help='paths or glob patterns of TEI documents')
+    parser.add_argument('--list', dest='list', help="File with the paths of TEI documents, one per line.")
+    parser.add_argument('--uri', dest='uri', required=True, help="URI template for the published manifests, e.g. http://example.com/manifests/{id}/{name}")
+    parser.add_argument('--out', dest='out', default='.', help="Directory to write manifests to.")
+    parser.add_argument('--path', dest='path', default='{id}/{name}', help="Path template for the manifests, relative to --out (default: {id}/{name}).")
+    parser.add_argument('--root', dest='root', help="Directory that document ids are relative to (default: the common directory of the TEI documents).")
+    parser.add_argument('--variants', dest='variants', default=','.join(batch.VARIANTS), help="Comma separated manifest variants to write (default: %s)." % ','.join(batch.VARIANTS))
+    parser.add_argument('--lists', dest='lists', action='store_true', help="Write the annotations of each canvas to annotation lists in a lists directory next to each manifest (implies --direct).")
+    parser.add_argument('--incremental', dest='incremental', action='store_true', help="Keep a sidecar next to each manifest and only rebuild the pages that changed since (implies --stream).")
+    parser.add_argument('--compress', dest='compress', help="Comma separated compressed copies to write next to each manifest and annotation list: gz, or br if brotli is installed.")
+    parser.add_argument('--quiet', dest='quiet', action='store_true', help="Don't log progress.")
+
+
+def get_tei_filenames(parser, args):
+    # documents that can't be built are still reported when quiet
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format="%(message)s")
+    patterns = list(args.tei)
+    if args.list:
+        with open(args.list) as fh:
+            patterns.extend(line.strip() for line in fh if line.strip())
+    if not patterns:
+        parser.error("no TEI documents given")
+    return batch.expand(patterns)
+
+
+def add_build_arguments(parser, direct=True):
+    # serve always writes the JSON-LD directly, so it leaves out --direct
+    # and --stream
+    parser.add_argument('--jobs', dest='jobs', type=int, help="Number of processes to parse surfaces with.")
+    parser.add_argument('--cache', dest='cache', help="Directory to cache parsed surfaces in.")
+    parser.add_argument('--cache-max-size', dest='cache_max_size', type=int, help="Evict cached surfaces when the cache grows beyond this many bytes.")
+    parser.add_argument('--cache-max-age', dest='cache_max_age', type=int, help="Evict cached surfaces that haven't been used for this many seconds.")
+    parser.add_argument('--clear-cache', dest='clear_cache', action='store_true', help="Empty the cache before building.")
+    if direct:
+        parser.add_argument('--direct', dest='direct', action='store_true', help="Write the JSON-LD directly instead of compacting an RDF graph.")
+        parser.add_argument('--stream', dest='stream', action='store_true', help="Parse and write one page at a time to keep memory use down (implies --direct).")
+    parser.add_argument('--stable', dest='stable', action='store_true', help="Label blank nodes by what they are and sort the keys of the JSON-LD, so that unchanged TEI is written the same way every time (implies --direct).")
+    parser.add_argument('--compact', dest='compact', action='store_true', help="Write the JSON-LD without indentation or spaces.")
+    parser.add_argument('--layers', dest='layers', help="Comma separated layers of annotations to include (default: %s)." % ','.join(LAYERS))
+    parser.add_argument('--text-types', dest='text_types', help="Comma separated kinds of text annotation to include (default: %s)." % ','.join(TEXT_TYPES))
+    parser.add_argument('--parser', dest='parser', default='auto', choices=('auto',) + PARSERS, help="XML parser to read the TEI with (default: lxml if it is installed, else the standard library).")
+    parser.add_argument('--stats', dest='stats', help="Write the time spent in each stage of the build, and counts of what was built, to this JSON file.")
+    parser.add_argument('--profile', dest='profile', help="Profile the build, writing cProfile stats to PROFILE.pstats and collapsed stacks for flame graphs to PROFILE.folded.")
+
+
+def get_indent(args):
+    return None if args.compact else 2
+
+
+def get_stats(args):
+    if args.profile:
+        profiler = Profiler()
+        profiler.start()
+        return profiler
+    if args.stats:
+        return Stats()
+    return NULL_STATS
+
+
+def save_stats(args, stats):
+    if args.profile:
+        stats.stop()
+        stats.save_profile(args.profile)
+    if args.stats:
+        stats.save(args.stats)
+
+
+def get_cache(args):
+    if not args.cache:
+        return None
+    cache = SurfaceCache(args.cache, max_size=args.cache_max_size, max_age=args.cache_max_age)
+    if args.clear_cache:
+        cache.clear()
+    return cache
+
+
+commands = {
+    "batch": batch_build,
+    "watch": watch,
+    "serve": serve,
+    "publish": publish,
+    "materialize-coords": materialize_coords,
+}
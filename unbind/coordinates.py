@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+import os
+import re
+import stat
+import logging
+
+from xml.etree import ElementTree
+
+from . import parsers, tei
+from .namespaces import TEI
+from .output import write
+
+log = logging.getLogger(__name__)
+
+# the start tag of a zone, with its attributes
+ZONE_TAG = re.compile(br'<(?:[\w.-]+:)?zone\b[^>]*>')
+
+
+def materialize(filename, parser=None):
+    """
+    Returns the XML of a surface file with the coordinates that unbind
+    would otherwise guess for its zones written into their start tags (see
+    tei.place_zones), or None if it has them already. Nothing else in the
+    file is changed, so that the difference can be reviewed like any other
+    edit of the TEI. Raises ValueError if the zones can't be matched up
+    with the tags in the file.
+    """
+    doc = parsers.parse(filename, parser)
+    zones = doc.getroot().findall('.//{%s}zone' % TEI)
+    before = [dict(z.attrib) for z in zones]
+    tei.place_zones(filename, doc)
+    changes = []
+    for zone, attrib in zip(zones, before):
+        changes.append([(c, zone.get(c)) for c in tei.COORDINATES if zone.get(c) != attrib.get(c)])
+    if not any(changes):
+        return None
+
+    with open(filename, 'rb') as fh:
+        xml = fh.read()
+    tags = list(ZONE_TAG.finditer(xml))
+    if len(tags) != len(zones):
+        raise ValueError("found %s zone tags for %s zones in %s" % (len(tags), len(zones), filename))
+    parts = []
+    pos = 0
+    for match, coords in zip(tags, changes):
+        if coords:
+            parts.append(xml[pos:match.start()])
+            parts.append(_set_attributes(match.group(0), coords))
+            pos = match.end()
+    parts.append(xml[pos:])
+    result = b"".join(parts)
+
+    # make sure the zones of the new XML are the ones that were placed
+    placed = ElementTree.fromstring(result).findall('.//{%s}zone' % TEI)
+    if [dict(z.attrib) for z in placed] != [dict(z.attrib) for z in zones]:
+        raise ValueError("couldn't write the coordinates of the zones in %s" % filename)
+    return result
+
+
+def materialize_file(filename, parser=None):
+    """
+    Writes the coordinates of the zones of a surface file into it, and
+    returns true if it changed. The file keeps its mode, and its owner and
+    group where they can be set.
+    """
+    xml = materialize(filename, parser)
+    if xml is None:
+        return False
+    st = os.stat(filename)
+    write(filename, lambda fh: fh.write(xml), mode='wb')
+    os.chmod(filename, stat.S_IMODE(st.st_mode))
+    if hasattr(os, 'chown'):
+        new = os.stat(filename)
+        if (new.st_uid, new.st_gid) != (st.st_uid, st.st_gid):
+            try:
+                os.chown(filename, st.st_uid, st.st_gid)
+            except OSError:
+                log.warning("couldn't give %s back its owner and group", filename)
+    log.info("wrote coordinates to %s", filename)
+    return True
+
+
+def _set_attributes(tag, coords):
+    # replaces or adds the attributes of a start tag
+    for name, value in coords:
+        name, value = name.encode('ascii'), value.encode('utf-8')
+        attr = re.compile(br'(\s' + name + br'\s*=\s*)(["\']).*?\2')
+        if attr.search(tag):
+            tag = attr.sub(lambda m: m.group(1) + m.group(2) + value + m.group(2), tag, 1)
+        else:
+            end = re.search(br'\s*/?>$', tag).start()
+            tag = tag[:end] + b' ' + name + b'="' + value + b'"' + tag[end:]
+    return tag
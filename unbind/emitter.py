@@ -0,0 +1,622 @@
+#!/usr/bin/env python
+
+import os
+import re
+import six
+import json
+
+from collections import OrderedDict
+from rdflib import RDF
+from pyld.jsonld import remove_base
+from six.moves.urllib.parse import urljoin
+
+from . import __version__
+from .namespaces import OA, OAX, ORE, SC, SGA, CNT
+from .output import write_json, separators
+from .sidecar import Sidecar, PageRecord
+from .tei import relative_path
+
+
+class Emitter(object):
+    """
+    Writes the compacted JSON-LD for a Manifest straight from its
+    tei.Document, without building an rdflib graph and compacting it
+    with pyld. The nodes are the ones Manifest.jsonld() returns, down to
+    the way single values, lists and relative URLs are compacted, but
+    blank nodes are labelled by page: _:p3-12 is the twelfth blank node
+    of the third page. The style nodes that every page shares are
+    labelled by style instead, like _:style-underline.
+
+    e = Emitter(manifest)
+    j = e.jsonld()
+
+    Or write it to a file page by page, as the surfaces are parsed:
+
+    Emitter(manifest).write(open("manifest.jsonld", "w"))
+
+    If the manifest has a sidecar.Sidecar the pages of a streamed document
+    that haven't changed since it was recorded are copied from it rather
+    than parsed, and a new one is recorded as sidecar.
+
+    If the manifest is stable the blank nodes of a page are labelled by
+    what they are instead, from the xml:id of its surface, the type of an
+    annotation and its offsets (_:ox-ms_abinger_c56-0003-line-25-76), so
+    that they don't change when other pages or annotations do, and the
+    keys of the nodes are written in order.
+
+    If the manifest has a directory for annotation lists, the annotations
+    of each canvas are written to a list per layer there instead, which the
+    canvas refers to with otherContent and the layer aggregates. Each list
+    is a JSON-LD document of its own, with the style nodes it uses.
+    """
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.context = manifest._context()
+        self.base = ''
+        self.nodes = OrderedDict()
+        self.page_nodes = self.nodes
+        self.sidecar = None
+        self.indent = 2
+        self.compress = ()
+        # the names of the annotation list files that were written
+        self.list_names = []
+        self._counts = {}
+        self._names = {}
+        self._iris = {}
+        self._terms, self._prefixes = self._term_definitions()
+
+    def jsonld(self, pages=None, skip_annos=False):
+        return {"@context": self.context, "@graph": list(self.graph(pages, skip_annos))}
+
+    def write(self, fh, pages=None, skip_annos=False, indent=2, compress=()):
+        """
+        Writes the JSON-LD to a file as it is built, the way json.dump
+        would write jsonld(), without holding the whole graph in memory.
+        With no indent it is written without any whitespace. Annotation
+        lists are written the same way, with compressed copies if any are
+        given (see output.write).
+        """
+        self.indent = indent
+        self.compress = compress
+        sort_keys = self.manifest.stable
+        dumps = lambda j: json.dumps(j, indent=indent, sort_keys=sort_keys, separators=separators(indent))
+        if indent is None:
+            fh.write('{"@context":%s,"@graph":[' % dumps(self.context))
+            sep = ""
+            for node in self.graph(pages, skip_annos):
+                fh.write(sep)
+                fh.write(dumps(node))
+                sep = ","
+            fh.write("]}\n")
+            return
+
+        comma = json.JSONEncoder(indent=indent).item_separator
+        pad = "\n" + " " * (indent * 2)
+        fh.write('{\n%s"@context": ' % (" " * indent))
+        fh.write(dumps(self.context).replace("\n", "\n" + " " * indent))
+        fh.write('%s\n%s"@graph": [' % (comma, " " * indent))
+        sep = pad
+        for node in self.graph(pages, skip_annos):
+            fh.write(sep)
+            fh.write(dumps(node).replace("\n", pad))
+            sep = comma + pad
+        fh.write("\n%s]\n}\n" % (" " * indent))
+
+    def graph(self, pages=None, skip_annos=False):
+        """
+        Yields the nodes of the graph, for a tei.PageSelection of pages if
+        one is given. The canvas and annotations of each
+        page are yielded as soon as its surface has been parsed, and the
+        manifest and the nodes that refer to every page come last.
+        """
+        m = self.manifest
+        doc = m.tei
+        uri = self.iri(m.uri)
+        self.page_nodes = self.nodes
+
+        manifest = self.node(uri)
+        self.add(manifest, "@type", self.term(SC.Manifest))
+        self.add(manifest, "label", literal(doc.label))
+        self.add(manifest, "dc:title", literal(doc.title))
+        self.add(manifest, "sc:agentLabel", literal(doc.agent))
+        self.add(manifest, "attribution", literal(doc.attribution))
+        self.add(manifest, "sc:dateLabel", literal(doc.date))
+        if hasattr(doc, 'state'):
+            self.add(manifest, "sga:stateLabel", literal(doc.state))
+        self.add(manifest, "sc:service", {"@id": self.iri(doc.service)})
+
+        # the layers of annotations, by name, that the manifest has
+        self.layers = {}
+        if "text" in m.layers:
+            self.layers["text"] = self.layer(manifest, [ORE.Aggregation, SC.AnnotationList, SC.Layer], "Transcription", SC.painting)
+        if "zone" in m.layers:
+            self.layers["zone"] = self.layer(manifest, [ORE.Aggregation, SC.AnnotationList, SC.Layer], "Zones")
+        if "html" in m.layers:
+            self.layers["html"] = self.layer(manifest, [SC.AnnotationList, ORE.Aggregation, SC.Layer], "Reading layer", SGA.reading)
+        if "xml" in m.layers:
+            self.layers["xml"] = self.layer(manifest, [SC.AnnotationList, ORE.Aggregation, SC.Layer], "TEI source", SGA.source)
+
+        sequence = self.node(self.bnode())
+        manifest["sequences"] = [sequence["@id"]]
+        self.add(sequence, "@type", self.term(SC.Sequence))
+        self.add(sequence, "@type", self.term(RDF.List))
+        self.add(sequence, "rdf:rest", {"@list": []})
+        self.add(sequence, "label", "Physical sequence")
+
+        # find the pages that can be copied from the sidecar of a previous
+        # build, which only a streamed document can leave unparsed
+        keys = {}
+        reuse = {}
+        if m.sidecar is not None:
+            options = self.options(skip_annos)
+            self.sidecar = Sidecar(options)
+            for n, filename in doc.page_filenames():
+                keys[n] = doc.surface_key(filename)
+                record = m.sidecar.reusable(options, n, keys[n], relative_path(filename))
+                if record is not None and doc.stream:
+                    reuse[n] = record
+
+        canvases = []
+        images = []
+        range_canvases = {}
+        self.aggregated = dict((layer, []) for layer in self.layers)
+        for surface in doc.iter_surfaces(reuse):
+
+            if pages is not None and not pages.includes(surface.page, surface.xmlid):
+                continue
+
+            if isinstance(surface, PageRecord):
+                record = surface
+            else:
+                record = self.page(surface, skip_annos, keys.get(surface.page))
+            self.add_page(record)
+            canvases.append(record.canvas)
+            images.append(record.image_annotation)
+            if self.sidecar is not None:
+                self.sidecar.pages[record.page] = record
+
+            range_label = doc.section_loci_pages_only.get(record.xmlid, None)
+            if range_label:
+                range_canvases.setdefault(range_label, []).append(record.canvas)
+
+            for node in record.nodes:
+                yield node
+
+        for layer, aggregated in self.aggregated.items():
+            if aggregated:
+                self.layers[layer]["ore:aggregates"] = aggregated[0] if len(aggregated) == 1 else aggregated
+
+        self.chain(sequence, canvases)
+
+        # the ranges are only known once every surface has been seen
+        ranges = []
+        for ran in doc.ranges:
+            range_node = self.node(self.bnode())
+            self.add(range_node, "@type", self.term(SC.Range))
+            self.add(range_node, "@type", self.term(RDF.List))
+            self.add(range_node, "label", literal(ran))
+            self.chain(range_node, range_canvases.get(ran, []))
+            ranges.append(range_node["@id"])
+
+        self.list_property(manifest, "structures", "sc:hasRanges", ranges)
+        self.list_property(manifest, "images", "sc:hasImageAnnotations", images)
+        self.list_property(manifest, "canvases", "sc:hasCanvases", canvases)
+
+        works = [literal(w) for w in doc.works]
+        manifest["sga:containedWorks"] = works[0] if len(works) == 1 else works
+
+        for node in self.nodes.values():
+            yield node
+
+        if m.stats.enabled:
+            m.stats.count("bnodes", sum(self._counts.values()))
+
+    def page(self, surface, skip_annos=False, key=None):
+        """
+        Builds the nodes of a page, and returns them in a PageRecord with
+        what the page adds to the nodes shared by every page.
+        """
+        self.page_nodes = OrderedDict()
+        self.aggregates = []
+        self.styles = []
+        scope = "p%s" % surface.page
+        if self.manifest.stable:
+            scope = surface.xmlid or scope
+        canvas, image_ann = self.add_canvas(surface, scope)
+
+        self.lists = []
+
+        if not skip_annos:
+            if "zone" in self.layers:
+                self.annotate("zone", surface, canvas, self.add_zone_annotations, surface, canvas, scope)
+            if "text" in self.layers:
+                self.annotate("text", surface, canvas, self.add_text_annotations, surface, scope)
+            if "html" in self.layers:
+                self.annotate("html", surface, canvas, self.add_html_annotation, surface, canvas, scope)
+            if "xml" in self.layers:
+                self.annotate("xml", surface, canvas, self.add_xml_annotation, surface, canvas, scope)
+
+        record = PageRecord(surface.page, key, surface.relative_path, surface.xmlid,
+                            list(surface.range_events),
+                            self.iri(surface.image), surface.height,
+                            surface.width, canvas, image_ann,
+                            self.aggregates, list(self.page_nodes.values()),
+                            self.styles, self.lists)
+        self.page_nodes = self.nodes
+        return record
+
+    def add_page(self, record):
+        """
+        Adds a page to the nodes shared by every page: its image and its
+        annotations to the annotation lists.
+        """
+        # images are kept with the manifest since pages can share them
+        image = self.node(record.image, self.nodes)
+        self.add(image, "format", "image/jp2")
+        self.add(image, "height", literal(record.height))
+        self.add(image, "width", literal(record.width))
+        self.add(image, "service", self.iri("https://iiif.bodleian.ox.ac.uk/iiif/image/"))
+
+        # the ids are unique to the page, so unlike add() this doesn't
+        # have to look through everything the layer already aggregates
+        for layer, node_id in record.aggregates:
+            self.aggregated[layer].append({"@id": node_id})
+
+        # like images, styles are shared by the pages that use them
+        for style in record.styles:
+            self.add_style(style, self.nodes)
+
+        # the lists are written again for reused pages too, so that they
+        # are there even when the manifest is built somewhere new
+        for name, nodes in record.lists:
+            self.write_list(name, nodes)
+
+    def annotate(self, layer, surface, canvas, add, *args):
+        """
+        Calls add with args to add a page's annotations in a layer: to the
+        page, or to an annotation list of their own when the manifest has
+        lists, which is then kept to be written by add_page().
+        """
+        m = self.manifest
+        if m.lists is None:
+            add(*args)
+            return
+
+        page_nodes, aggregates, styles = self.page_nodes, self.aggregates, self.styles
+        self.page_nodes, self.aggregates, self.styles = OrderedDict(), [], []
+        try:
+            add(*args)
+            nodes, annotations, used = self.page_nodes, self.aggregates, self.styles
+        finally:
+            self.page_nodes, self.aggregates, self.styles = page_nodes, aggregates, styles
+        if not annotations:
+            return
+
+        name = "%s-%s.jsonld" % (surface.xmlid or "p%s" % surface.page, layer)
+        list_id = self.iri(urljoin(m.lists_uri, name))
+        self.page_nodes[canvas].setdefault("otherContent", []).append(list_id)
+        self.aggregates.append((layer, list_id))
+
+        list_nodes = OrderedDict()
+        annotation_list = self.node(list_id, list_nodes)
+        self.add(annotation_list, "@type", self.term(SC.AnnotationList))
+        for key in ("label", "sc:forMotivation"):
+            if key in self.layers[layer]:
+                annotation_list[key] = self.layers[layer][key]
+        annotation_list["resources"] = [node_id for l, node_id in annotations]
+        list_nodes.update(nodes)
+        for style in used:
+            self.add_style(style, list_nodes)
+        self.lists.append((name, list(list_nodes.values())))
+
+    def write_list(self, name, nodes):
+        m = self.manifest
+        j = {"@context": self.context, "@graph": nodes}
+        if isinstance(m.lists, six.string_types):
+            write_json(os.path.join(m.lists, name), j, indent=self.indent,
+                       sort_keys=m.stable, compress=self.compress)
+            self.list_names.append(name)
+        else:
+            m.lists[name] = j
+        if m.stats.enabled:
+            m.stats.count("annotation_lists")
+
+    def add_style(self, style, nodes):
+        node_id = self.style_id(style)
+        if node_id not in nodes:
+            self._counts["style"] = self._counts.get("style", 0) + 1
+            css = self.node(node_id, nodes)
+            self.add(css, "@type", self.term(CNT.ContentAsText))
+            self.add(css, "format", "text/css")
+            self.add(css, "chars", self.manifest._style_css(style))
+
+    def options(self, skip_annos=False):
+        """
+        Returns the options that the nodes of a page depend on, besides
+        its surface.
+        """
+        return {
+            "version": __version__,
+            "uri": six.text_type(self.manifest.uri),
+            "skip_annos": bool(skip_annos),
+            # relative urls are compacted against the working directory
+            "base": self.iri("/"),
+            "lists": six.text_type(self.manifest.lists_uri) if self.manifest.lists else None,
+            "layers": list(self.manifest.layers),
+            "text_types": list(self.manifest.text_types),
+            "stable": bool(self.manifest.stable),
+        }
+
+    def layer(self, manifest, types, label, motivation=None):
+        layer = self.node(self.bnode())
+        self.add(manifest, "ore:aggregates", {"@id": layer["@id"]})
+        for t in types:
+            self.add(layer, "@type", self.term(t))
+        self.add(layer, "label", label)
+        if motivation:
+            self.add(layer, "sc:forMotivation", {"@id": self.iri(motivation)})
+        return layer
+
+    def add_canvas(self, surface, scope):
+        canvas = self.node(self.bnode(scope, "canvas"))
+        self.add(canvas, "@type", self.term(SC.Canvas))
+        self.add(canvas, "label", literal(surface.folio))
+        self.add(canvas, "sga:folioLabel", literal(surface.folio))
+        self.add(canvas, "sga:shelfmarkLabel", literal(surface.shelfmark))
+        self.add(canvas, "sga:handLabel", literal(surface.hands_label))
+        self.add(canvas, "height", literal(surface.height))
+        self.add(canvas, "width", literal(surface.width))
+
+        image_ann = self.node(self.bnode(scope, "image"))
+        self.add(image_ann, "@type", self.term(OA.Annotation))
+        self.add(image_ann, "on", canvas["@id"])
+        self.add(image_ann, "resource", self.iri(surface.image))
+        return canvas["@id"], image_ann["@id"]
+
+    def add_zone_annotations(self, surface, canvas, scope):
+        tei_url = self.iri(self.manifest.tei_url(surface))
+
+        for zone in surface.zones:
+            if not self.manifest._annotates_zone(zone):
+                continue
+            self.manifest._count_annotation(SC.ContentAnnotation)
+
+            annotation = self.node(self.bnode(scope, "zone-%s-%s" % (zone.begin, zone.end)))
+            self.aggregates.append(("zone", annotation["@id"]))
+            self.add(annotation, "@type", self.term(OA.Annotation))
+            self.add(annotation, "@type", self.term(SC.ContentAnnotation))
+
+            body = self.node(self.bnode(scope, "body", annotation["@id"]))
+            self.add(annotation, "resource", body["@id"])
+            self.add(body, "@type", self.term(OA.SpecificResource))
+            self.add(body, "full", tei_url)
+
+            selector = self.node(self.bnode(scope, "selector", body["@id"]))
+            self.add(body, "selector", selector["@id"])
+            self.add(selector, "@type", self.term(OAX.TextOffsetSelector))
+            self.add(selector, "beginOffset", literal(zone.begin))
+            self.add(selector, "endOffset", literal(zone.end))
+
+            target = self.node(self.bnode(scope, "target", annotation["@id"]))
+            self.add(annotation, "on", target["@id"])
+            self.add(target, "@type", self.term(OA.SpecificResource))
+            self.add(target, "full", canvas)
+
+            selector = self.node(self.bnode(scope, "selector", target["@id"]))
+            self.add(target, "selector", selector["@id"])
+            self.add(selector, "@type", self.term(OA.FragmentSelector))
+            self.add(selector, "value", literal(zone.xywh))
+            if zone.rotate > 0:
+                self.add(selector, "sc:rotation", literal(zone.rotate))
+            if zone.type == "left_margin":
+                self.add(selector, "@type", self.term(SC[zone.type]))
+
+    def add_text_annotations(self, surface, scope):
+        tei_url = self.iri(self.manifest.tei_url(surface))
+        for zone in surface.zones:
+            for a in self.manifest._text_annotations(zone):
+                self.add_text_annotation(a, tei_url, scope)
+
+    def add_text_annotation(self, a, tei_url, scope):
+        # Skip possible *Span elements that failed to get an end pos,
+        # which tei.Document logs a warning about
+        if not a.end:
+            return
+
+        m = self.manifest
+        ann_type = m._text_annotation_type(a)
+        m._count_annotation(ann_type)
+
+        name = "%s-%s-%s" % (_type_name(ann_type), a.begin, a.end)
+        annotation = self.node(self.bnode(scope, name))
+        self.aggregates.append(("text", annotation["@id"]))
+        self.add(annotation, "@type", self.term(ann_type))
+        self.add(annotation, "@type", self.term(OAX.Highlight))
+
+        rendition = m._text_rendition(a)
+        if rendition:
+            self.add(annotation, self.term(rendition[0]), literal(rendition[1]))
+        if ann_type == SGA.SpaceAnnotation:
+            self.add(annotation, "sga:spaceExt", literal(a.ext))
+
+        target = self.node(self.bnode(scope, "target", annotation["@id"]))
+        self.add(annotation, "on", target["@id"])
+        self.add(target, "@type", self.term(OA.SpecificResource))
+        self.add(target, "full", tei_url)
+
+        classes = m._text_classes(a)
+        if classes:
+            self.add(target, "sga:hasClass", classes)
+
+        selector = self.node(self.bnode(scope, "selector", target["@id"]))
+        self.add(target, "selector", selector["@id"])
+        self.add(selector, "@type", self.term(OAX.TextOffsetSelector))
+        self.add(selector, "beginOffset", literal(a.begin))
+        self.add(selector, "endOffset", literal(a.end))
+
+        style = m._text_style(a, ann_type)
+        if style:
+            self.add(target, "oa:hasStyle", {"@id": self.style_id(style)})
+            if style not in self.styles:
+                self.styles.append(style)
+
+    def style_id(self, style):
+        return "_:style-%s" % style
+
+    def add_html_annotation(self, surface, canvas, scope):
+        self._add_layer_annotation("html", SGA.reading, canvas,
+                                   self.manifest.html_url(surface), scope)
+
+    def add_xml_annotation(self, surface, canvas, scope):
+        self._add_layer_annotation("xml", SGA.source, canvas,
+                                   self.manifest.tei_url(surface), scope)
+
+    def _add_layer_annotation(self, layer, motivation, canvas, body, scope):
+        ann = self.node(self.bnode(scope, layer))
+        self.aggregates.append((layer, ann["@id"]))
+        self.add(ann, "@type", self.term(OA.Annotation))
+        self.add(ann, "sc:motivatedBy", {"@id": self.iri(motivation)})
+        self.add(ann, "on", canvas)
+        self.add(ann, "resource", self.iri(body))
+
+    def chain(self, node, items):
+        """
+        Adds items to a node that is itself the head of an rdf:List, the
+        way the sequence and ranges are built.
+        """
+        if not items:
+            self.add(node, "rdf:rest", {"@list": []})
+        elif len(items) == 1:
+            node["first"] = items[0]
+            rest = self.node(self.bnode())
+            rest["rdf:rest"] = {"@list": []}
+            self.add(node, "rdf:rest", {"@id": rest["@id"]})
+        else:
+            node["first"] = items[0]
+            node["rest"] = items[1:]
+
+    def list_property(self, node, term, key, items):
+        """
+        Adds an rdf:List of items to a node. An empty list can't be
+        compacted into the term's @list container so it is left as a list
+        node of its own.
+        """
+        if items:
+            node[term] = items
+        else:
+            empty = self.node(self.bnode())
+            empty["@type"] = self.term(RDF.List)
+            empty["rdf:rest"] = {"@list": []}
+            node[key] = {"@id": empty["@id"]}
+
+    def node(self, node_id, nodes=None):
+        """
+        Returns the node with an id, adding it to the nodes of the page
+        being built unless other nodes are given.
+        """
+        if nodes is None:
+            nodes = self.page_nodes
+        if node_id not in nodes:
+            nodes[node_id] = {"@id": node_id}
+        return nodes[node_id]
+
+    def bnode(self, scope="b", name=None, parent=None):
+        """
+        Returns the label of a new blank node in a scope, numbered in the
+        order they are made: _:p3-12. When the manifest is stable and the
+        node is given a name it is labelled by it instead, after the label
+        of the node it belongs to if there is one: _:p3-line-25-76 and
+        _:p3-line-25-76-target. A name used twice in a scope is numbered.
+        """
+        n = self._counts.get(scope, 0) + 1
+        self._counts[scope] = n
+        if name is None or not self.manifest.stable:
+            return "_:%s-%s" % (scope, n)
+        if parent is not None:
+            return "%s-%s" % (parent, name)
+        label = "_:%s-%s" % (scope, name)
+        n = self._names.get(label, 0) + 1
+        self._names[label] = n
+        return label if n == 1 else "%s-%s" % (label, n)
+
+    def add(self, node, key, value):
+        """
+        Adds a value to a node. Like a triple in a graph it is only added
+        once, and a key with more than one value holds a list of them.
+        """
+        if key not in node:
+            node[key] = value
+            return
+        values = node[key]
+        if not isinstance(values, list):
+            values = [values]
+        if value not in values:
+            node[key] = values + [value]
+
+    def term(self, iri):
+        """
+        Compacts a type or property IRI to a term or CURIE.
+        """
+        iri = six.text_type(iri)
+        if iri not in self._terms:
+            self._terms[iri] = self._curie(iri) or iri
+        return self._terms[iri]
+
+    def iri(self, iri):
+        """
+        Compacts an IRI that is used as a node id: to a CURIE if one of the
+        context's prefixes matches, otherwise relative to the base IRI as
+        pyld does.
+        """
+        iri = six.text_type(iri)
+        if iri not in self._iris:
+            self._iris[iri] = self._curie(iri) or remove_base(self.base, iri)
+        return self._iris[iri]
+
+    def _curie(self, iri):
+        candidate = None
+        for prefix, prefix_iri in self._prefixes:
+            if iri == prefix_iri or not iri.startswith(prefix_iri):
+                continue
+            curie = prefix + ':' + iri[len(prefix_iri):]
+            if curie in self.context:
+                continue
+            if candidate is None or (len(curie), curie) < (len(candidate), candidate):
+                candidate = curie
+        return candidate
+
+    def _term_definitions(self):
+        """
+        Returns the terms of the context, by the IRI they expand to, and the
+        (term, IRI) pairs that can be used as CURIE prefixes.
+        """
+        iris = {}
+        for term, definition in self.context.items():
+            if isinstance(definition, dict):
+                definition = definition.get("@id")
+            iris[term] = definition
+        for term, iri in iris.items():
+            prefix, sep, suffix = iri.partition(':')
+            if sep and prefix in iris and not suffix.startswith('//'):
+                iris[term] = iris[prefix] + suffix
+
+        terms = {}
+        for term, iri in sorted(iris.items(), key=lambda t: (len(t[0]), t[0])):
+            terms.setdefault(iri, term)
+        return terms, sorted(iris.items())
+
+
+def _type_name(ann_type):
+    # the name of an annotation type in labels, like line for LineAnnotation
+    return re.split('[#/]', ann_type)[-1].replace("Annotation", "").lower()
+
+
+def literal(value):
+    """
+    Returns a value as it appears in the compacted JSON-LD of an
+    rdflib Literal.
+    """
+    if value is None:
+        return 'None'
+    return value
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+import re
+import string
+import logging
+
+from . import parsers
+from .namespaces import XI, TEI, XML
+
+TEI_HEADER = "{%s}teiHeader" % TEI
+MS_ITEM = "{%s}msItem" % TEI
+BIBL = "{%s}bibl" % TEI
+BIBL_TITLE = "{%s}bibl/{%s}title" % (TEI, TEI)
+BIBL_AUTHOR = "{%s}bibl/{%s}author" % (TEI, TEI)
+TITLE = "{%s}title" % TEI
+DATE = "{%s}date" % TEI
+REPOSITORY = "{%s}repository" % TEI
+HISTORY = "{%s}history" % TEI
+ORIGIN = "{%s}origin" % TEI
+TITLE_STMT = "{%s}titleStmt" % TEI
+PHYS_DESC = "{%s}physDesc" % TEI
+HAND_NOTE = "{%s}handNote" % TEI
+PERS_NAME = "{%s}persName" % TEI
+LOCUS = "{%s}locus" % TEI
+SOURCE_DOC = "{%s}sourceDoc" % TEI
+INCLUDE = "{%s}include" % XI
+XML_ID = "{%s}id" % XML
+
+# the elements the metadata is read from, which only count in the teiHeader
+METADATA = (MS_ITEM, LOCUS, REPOSITORY, HISTORY, TITLE_STMT, HAND_NOTE)
+
+WORK_CLASSES = ("#work", "#work_part")
+SECTION_CLASSES = ("#chapter", "#scene")
+
+log = logging.getLogger(__name__)
+
+
+class Header(object):
+    """
+    The metadata tei.Document needs from the teiHeader of a TEI document,
+    read in a single pass. Reading stops at the end of the teiHeader, and
+    includes() then carries on through the rest of the document, yielding
+    the href of each xi:include in the sourceDoc as soon as it is read so
+    that surfaces can be loaded before the whole document has been:
+
+    header = Header("/path/to/tei.xml")
+    print(header.title, header.hands, header.loci)
+    for href in header.includes():
+        print(href)
+
+    The metadata is what Document used to find by searching the whole
+    document with ElementTree, e.g. the first .//repository or the titles
+    of .//msItem[@class="#work"]/bibl, in the same (document) order, but
+    only in the teiHeader: an msItem, locus, repository, history,
+    titleStmt or handNote after it is ignored, with a warning.
+    """
+
+    def __init__(self, filename, parser=None):
+        self.filename = filename
+        self.xmlid = None
+        self.title = None
+        self.agent = None
+        self.attribution = None
+        self.date = None
+        self.state = "none"
+        self.label = None
+        self.hands = {}
+        self.works = []
+        self.loci = []
+
+        self._events = parsers.iterparse(filename, ("start", "end"), parser)
+        self._tags = []
+        self._hrefs = []
+        self._ignored = set()
+        # for the open elements: their position in document order and the
+        # last msItem in them; the open msItems themselves
+        self._seqs = []
+        self._last_items = []
+        self._items = []
+        self._seq = 0
+        self._in_phys_desc = 0
+        # (position, value) of everything that might be the first match
+        self._titles = dict((c, []) for c in WORK_CLASSES)
+        self._agents = dict((c, []) for c in WORK_CLASSES)
+        self._states = dict((c, []) for c in WORK_CLASSES)
+        self._works = dict((c, []) for c in WORK_CLASSES)
+        self._attributions = []
+        self._ms_dates = []
+        self._work_dates = []
+        self._labels = []
+
+        for event, elem in self._events:
+            if event == "start":
+                self._start(elem)
+            elif self._end(elem) == TEI_HEADER:
+                break
+        self._finish()
+
+    def includes(self):
+        """
+        Yields the hrefs of the xi:includes in the sourceDoc in order. They
+        can only be read once.
+        """
+        hrefs, self._hrefs = self._hrefs, []
+        for href in hrefs:
+            yield href
+        tags = self._tags
+        for event, elem in self._events:
+            if event == "start":
+                tags.append(elem.tag)
+                continue
+            tags.pop()
+            if elem.tag == INCLUDE:
+                if tags and tags[-1] == SOURCE_DOC:
+                    yield elem.attrib['href']
+                elem.clear()
+            elif elem.tag in METADATA and elem.tag not in self._ignored:
+                self._ignored.add(elem.tag)
+                log.warning("%s: ignoring <%s> outside the teiHeader",
+                            self.filename, elem.tag.split("}")[-1])
+
+    def _start(self, elem):
+        tag = elem.tag
+        if not self._tags:
+            self.xmlid = elem.get(XML_ID)
+        self._tags.append(tag)
+        self._seqs.append(self._seq)
+        self._last_items.append(None)
+        if tag == MS_ITEM:
+            self._items.append(_Item(self._seq, elem.get('class')))
+        elif tag == PHYS_DESC:
+            self._in_phys_desc += 1
+        self._seq += 1
+
+    def _end(self, elem):
+        tag = self._tags.pop()
+        seq = self._seqs.pop()
+        last = self._last_items.pop()
+
+        # the agent is the author of an msItem that is the last one in
+        # its parent, as ElementTree reads msItem[@class="#work"][0]
+        if last is not None and last.author is not None and last.cls in self._agents:
+            self._agents[last.cls].append((last.seq, last.author))
+
+        if tag == MS_ITEM:
+            item = self._items.pop()
+            self._end_item(elem, item)
+            if self._last_items:
+                self._last_items[-1] = item
+        elif tag == LOCUS:
+            target = elem.get('target')
+            if target:
+                for item in self._items:
+                    item.loci.append(target)
+        elif tag == REPOSITORY:
+            self._attributions.append((seq, elem.text))
+        elif tag == HISTORY:
+            origin = elem.find(ORIGIN)
+            if origin is not None:
+                self._ms_dates.append((seq, origin.text))
+        elif tag == TITLE_STMT:
+            for title in elem.findall(TITLE):
+                if title.get('type') == "main":
+                    self._labels.append((seq, title.text))
+                    break
+        elif tag == HAND_NOTE:
+            xmlid = elem.get(XML_ID)
+            if self._in_phys_desc and xmlid is not None:
+                self.hands[xmlid] = elem.findall(PERS_NAME)[0].text
+                if elem.get('scope') == 'major' or elem.get('scope') == 'sole':
+                    self.main_hand = xmlid
+        elif tag == PHYS_DESC:
+            self._in_phys_desc -= 1
+        elif tag == INCLUDE:
+            if self._tags and self._tags[-1] == SOURCE_DOC:
+                self._hrefs.append(elem.attrib['href'])
+        elif tag == TEI_HEADER:
+            elem.clear()
+        return tag
+
+    def _end_item(self, elem, item):
+        bibls = elem.findall(BIBL)
+        title = elem.find(BIBL_TITLE)
+        if title is not None:
+            item.title = title.text
+        author = elem.find(BIBL_AUTHOR)
+        if author is not None:
+            item.author = author.text
+        for bibl in bibls:
+            date = bibl.find(DATE)
+            if date is not None:
+                self._work_dates.append((item.seq, date.text))
+                break
+
+        if item.cls in WORK_CLASSES:
+            for i, bibl in enumerate(bibls):
+                for title in bibl.findall(TITLE):
+                    self._titles[item.cls].append(((item.seq, i), title.text))
+            if bibls:
+                self._states[item.cls].append((item.seq, bibls[0].attrib.get('status')))
+            self._works[item.cls].append(item)
+        elif item.cls in SECTION_CLASSES:
+            for parent in self._items:
+                parent.sections.append(item)
+
+    def _finish(self):
+        # the metadata of the works, or failing that the work parts
+        class_decl = "#work" if self._titles["#work"] else "#work_part"
+        titles = [t for s, t in sorted(self._titles[class_decl], key=lambda t: t[0])]
+        if titles:
+            self.title = titles[0]
+            if class_decl == "#work" and len(titles) > 1:
+                self.title += " and others"
+        self.agent = _first(self._agents[class_decl])
+        self.attribution = _first(self._attributions)
+        # the manuscript's history, otherwise the work's metadata
+        if self._ms_dates:
+            self.date = _first(self._ms_dates)
+        else:
+            self.date = _first(self._work_dates)
+        if self._states[class_decl]:
+            state = _first(self._states[class_decl])
+            if state is not None:
+                self.state = state.replace("_", " ")
+        self.label = _first(self._labels)
+
+        # (target, work, section) of the loci that locate works scattered
+        # across pages, in order; a target can be given more than once
+        for work in sorted(self._works[class_decl], key=lambda w: w.seq):
+            w_title = work.title.strip()
+            self.works.append(w_title)
+            sections = []
+            for s in SECTION_CLASSES:
+                sections += sorted([i for i in work.sections if i.cls == s], key=lambda i: i.seq)
+            # If there are no subsections, set the context back to work
+            if not sections:
+                sections = [work]
+            for section in sections:
+                s_title = section.title.strip()
+                for targets in section.loci:
+                    for target in re.split(r'\s+', targets.strip()):
+                        target = target.lstrip("#")
+                        w_title = w_title.lower()
+                        w_title = re.sub(r"["+string.punctuation+r"\s]", "_", w_title)
+                        self.loci.append((target, w_title, s_title))
+
+
+class _Item(object):
+    """
+    What the header has in an msItem.
+    """
+
+    def __init__(self, seq, cls):
+        self.seq = seq
+        self.cls = cls
+        self.title = None
+        self.author = None
+        self.loci = []
+        self.sections = []
+
+
+def _first(matches):
+    # the value of the match that comes first in the document
+    return min(matches, key=lambda m: m[0])[1] if matches else None
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+import os
+import six
+import json
+import gzip
+import errno
+import tempfile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# the compressed copies that can be written next to a file, by extension
+COMPRESSIONS = ("gz", "br")
+
+
+def write_json(path, j, indent=2, sort_keys=False, compress=()):
+    """
+    Write JSON to a file the way bin/unbind prints it. With no indent it
+    is written without any whitespace.
+    """
+    def dump(fh):
+        json.dump(j, fh, indent=indent, sort_keys=sort_keys, separators=separators(indent))
+        fh.write("\n")
+    write(path, dump, compress)
+
+
+def write_manifest(path, manifest, indent=2, compress=()):
+    """
+    Write a Manifest's JSON-LD to a file, page by page if it is direct.
+    """
+    write(path, lambda fh: manifest.write(fh, indent=indent, compress=compress), compress)
+
+
+def separators(indent):
+    """
+    Returns the separators json.dumps should use: the usual ones when it
+    indents and ones without spaces when it doesn't.
+    """
+    return (',', ': ') if indent is not None else (',', ':')
+
+
+def write(path, writer, compress=(), mode='w'):
+    """
+    Call writer with a file to write to. The file is written next to its
+    destination and moved into place when it is complete, so a published
+    manifest is never seen half written.
+
+    Optionally give the extensions of compressed copies to write next to
+    it (see COMPRESSIONS), which are compressed as the file is written.
+    Set mode to 'wb' to write bytes.
+    """
+    compress = get_compressions(compress)
+    makedirs(os.path.dirname(path))
+    paths = [path] + ["%s.%s" % (path, c) for c in compress]
+    tmp_paths = []
+    files = []
+    try:
+        for p in paths:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+            tmp_paths.append(tmp_path)
+            # mkstemp only lets the owner read the file, unlike open()
+            os.chmod(tmp_path, 0o666 & ~_umask())
+            files.append(os.fdopen(fd, mode if p == path else 'wb'))
+        fh = files[0]
+        if compress:
+            fh = _Tee(fh, [_compressor(c, f) for c, f in zip(compress, files[1:])])
+        writer(fh)
+        if compress:
+            fh.close()
+        for f in files:
+            f.close()
+        for tmp_path, p in zip(tmp_paths, paths):
+            os.rename(tmp_path, p)
+    except Exception:
+        for f in files:
+            f.close()
+        for tmp_path in tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+
+
+def get_compressions(names):
+    """
+    Returns the compressed copies to write for a list of extensions, or a
+    comma separated string of them. Brotli (br) needs the brotli module.
+    """
+    if not names:
+        return ()
+    if isinstance(names, six.string_types):
+        names = [n.strip() for n in names.split(",") if n.strip()]
+    for name in names:
+        if name not in COMPRESSIONS:
+            raise ValueError("unknown compression: %s" % name)
+        if name == "br" and brotli is None:
+            raise ValueError("br compression needs brotli to be installed")
+    return tuple(names)
+
+
+def _compressor(name, fh):
+    if name == "gz":
+        # no name or time in the header, so the same file compresses the same
+        return gzip.GzipFile(filename='', mode='wb', fileobj=fh, mtime=0)
+    return _BrotliFile(fh)
+
+
+class _Tee(object):
+    # a file that writes text to a file and its bytes to compressors
+
+    def __init__(self, fh, compressors):
+        self.fh = fh
+        self.compressors = compressors
+
+    def write(self, s):
+        self.fh.write(s)
+        data = s.encode('utf-8') if isinstance(s, six.text_type) else s
+        for c in self.compressors:
+            c.write(data)
+
+    def close(self):
+        for c in self.compressors:
+            c.close()
+
+
+class _BrotliFile(object):
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.compressor = brotli.Compressor()
+
+    def write(self, data):
+        self.fh.write(self.compressor.process(data))
+
+    def close(self):
+        self.fh.write(self.compressor.finish())
+
+
+def makedirs(path):
+    if not path:
+        return
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
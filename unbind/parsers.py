@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+from xml.etree import ElementTree
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+PARSERS = ("lxml", "stdlib")
+
+
+def get_parser(name=None):
+    """
+    Returns the name of the XML parser to read TEI with: "lxml", or
+    "stdlib" for the ElementTree in the standard library. By default, or
+    when name is "auto", lxml is used if it is installed. The trees they
+    build differ only in ways unbind doesn't see (lxml keeps comments),
+    so the manifests are the same with either.
+    """
+    if name is None or name == "auto":
+        return "lxml" if lxml_etree is not None else "stdlib"
+    if name not in PARSERS:
+        raise ValueError("unknown XML parser: %s" % name)
+    if name == "lxml" and lxml_etree is None:
+        raise ValueError("the lxml parser needs lxml to be installed")
+    return name
+
+
+def parse(filename, parser=None):
+    """
+    Parses an XML file with the named parser and returns the ElementTree.
+    """
+    if get_parser(parser) == "lxml":
+        # like the standard library, don't limit the size of text nodes
+        return lxml_etree.parse(filename, lxml_etree.XMLParser(huge_tree=True))
+    return ElementTree.parse(filename)
+
+
+def iterparse(filename, events=("end",), parser=None):
+    """
+    Returns an iterator over the (event, element) pairs of parsing an XML
+    file with the named parser, like ElementTree.iterparse.
+    """
+    if get_parser(parser) == "lxml":
+        return lxml_etree.iterparse(filename, events=events, huge_tree=True)
+    return ElementTree.iterparse(filename, events)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+import os
+import signal
+import cProfile
+
+from .output import write
+from .stats import Stats, _Stage
+
+
+class Profiler(Stats):
+    """
+    Profiles a build two ways: with cProfile, for a pstats dump of the
+    time spent in each function, and by sampling the stack every interval
+    seconds, for collapsed stacks that flame graph tools can draw. The
+    samples are labelled with the stages of the build, as Stats records
+    them, and with any labels (like the TEI document) added with label().
+
+    profiler = Profiler()
+    profiler.start()
+    with profiler.label("document:/path/to/tei.xml"):
+        Manifest("/path/to/tei.xml", "http://example.com/Manifest.jsonld", stats=profiler).jsonld()
+    profiler.stop()
+    profiler.save_profile("build")  # build.pstats and build.folded
+
+    It is a Stats, so it collects the same stats as well, and save()
+    writes them. Stacks are only
+    sampled on platforms with setitimer, and only in the process that
+    started the profiler, so surfaces parsed with --jobs are left out.
+    """
+
+    def __init__(self, interval=0.002):
+        Stats.__init__(self)
+        self.interval = interval
+        self.profile = cProfile.Profile()
+        self.samples = {}
+        self.labels = []
+        self._names = {}
+
+    def start(self):
+        if hasattr(signal, "setitimer"):
+            signal.signal(signal.SIGPROF, self._sample)
+            # restart the system calls the timer interrupts, instead of
+            # failing them with EINTR (signal() turns that back on)
+            signal.siginterrupt(signal.SIGPROF, False)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        if hasattr(signal, "setitimer"):
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def stage(self, name):
+        return _ProfiledStage(self, name)
+
+    def label(self, name):
+        """
+        Returns a context manager that labels the samples taken in it.
+        """
+        return _Label(self, name)
+
+    def save_profile(self, prefix):
+        """
+        Writes the cProfile stats to prefix.pstats, for pstats or a viewer
+        like snakeviz, and the sampled stacks to prefix.folded, one
+        "label;frame;frame count" line per stack as flamegraph.pl and
+        speedscope read them.
+        """
+        self.profile.dump_stats(prefix + ".pstats")
+
+        def dump(fh):
+            for stack, count in sorted(self.samples.items()):
+                fh.write("%s %s\n" % (stack, count))
+        write(prefix + ".folded", dump)
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append(self._name(frame.f_code))
+            frame = frame.f_back
+        stack.extend(reversed(self.labels))
+        key = ";".join(reversed(stack))
+        self.samples[key] = self.samples.get(key, 0) + 1
+
+    def _name(self, code):
+        name = self._names.get(code)
+        if name is None:
+            filename = os.path.basename(code.co_filename)
+            name = "%s (%s:%s)" % (code.co_name, filename, code.co_firstlineno)
+            name = self._names[code] = name.replace(";", ",")
+        return name
+
+
+class _ProfiledStage(_Stage):
+
+    def __enter__(self):
+        self.stats.labels.append("stage:" + self.name)
+        return _Stage.__enter__(self)
+
+    def __exit__(self, *exc):
+        _Stage.__exit__(self, *exc)
+        self.stats.labels.pop()
+
+
+class _Label(object):
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name.replace(";", ",")
+
+    def __enter__(self):
+        self.profiler.labels.append(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.labels.pop()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+import os
+import six
+import json
+import hashlib
+import logging
+import threading
+import posixpath
+
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.parse import urljoin, urlsplit, unquote
+
+from . import __version__, tei
+from .batch import VARIANTS
+from .output import separators
+from .shared_canvas import Manifest
+from .stats import NULL_STATS
+from .watch import file_stamp
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = "application/ld+json"
+
+
+class ManifestServer(object):
+    """
+    Builds the manifests of the TEI documents in a directory when they are
+    asked for, keeping the most recently used ones in memory. Manifests are
+    found at {id}/{name} like the ones unbind batch writes, where the id
+    is the path of a TEI document relative to the root without its
+    extension and the name is that of a variant (see batch.VARIANTS):
+
+    app = ManifestServer("sga/data/tei", "http://localhost:8000/")
+    status, headers, body = app.get("/ox/ox-ms_abinger_c56/Manifest.jsonld")
+
+    With lists the annotations are served as annotation lists from
+    {id}/lists/, which are made when the manifest is.
+
+    Responses have an ETag made from the keys of the surfaces and the
+    document they were built from (see tei.Document.surface_key) and the
+    time the newest of their files was modified, so that conditional
+    requests can be answered with 304 Not Modified. A cached response is
+    built again once any of its files change.
+
+    Requests can be answered from several threads. Manifests are built one
+    at a time, but cached responses are answered while one is built.
+    """
+
+    def __init__(self, root, base_uri, max_size=256 * 1024 * 1024,
+                 lists=False, cache=None, jobs=None, parser=None, stats=None,
+                 indent=2, **options):
+        """
+        Serve the TEI documents in root from base_uri. Optionally limit the
+        bytes of responses kept in memory (max_size), and pass in what to
+        build the manifests with: a cache.SurfaceCache, the number of
+        processes to parse surfaces with, the parser, a stats.Stats, the
+        indent of the JSON-LD (None to leave out whitespace) and other
+        options for Manifest such as layers.
+        """
+        self.root = root
+        self.base_uri = base_uri.rstrip("/") + "/"
+        self.lists = lists
+        self.cache = cache
+        self.jobs = jobs
+        self.parser = parser
+        self.stats = stats or NULL_STATS
+        self.indent = indent
+        self.options = options
+        self.responses = ResponseCache(max_size)
+        self._building = threading.Lock()
+
+    def get(self, path, headers=None):
+        """
+        Returns the (status, headers, body) of the response to a GET of a
+        path, given the headers of the request.
+        """
+        headers = headers or {}
+        path = unquote(urlsplit(path).path)
+        response = self.responses.get(path)
+        if response is None or response.stale():
+            target = self._target(path)
+            if target is None:
+                return _error(404, "Not Found")
+            with self._building:
+                # it may have been built while this request waited
+                response = self.responses.get(path)
+                if response is None or response.stale():
+                    try:
+                        self._build(*target)
+                    except Exception:
+                        log.exception("couldn't build %s", path)
+                        return _error(500, "Internal Server Error")
+                    response = self.responses.get(path)
+            if response is None:
+                return _error(404, "Not Found")
+
+        if response.not_modified(headers):
+            return 304, response.headers(), b""
+        return 200, response.headers(), response.body
+
+    def _target(self, path):
+        # the TEI file and manifest variant to build for a path, or None
+        parts = posixpath.normpath(path).strip("/").split("/")
+        if ".." in parts or len(parts) < 2:
+            return None
+        if self.lists and len(parts) > 2 and parts[-2] == "lists":
+            parts = parts[:-2] + [VARIANTS["full"][0]]
+        doc_id, name = "/".join(parts[:-1]), parts[-1]
+        variants = dict((n, v) for v, (n, o) in VARIANTS.items())
+        tei_filename = os.path.join(self.root, *doc_id.split("/")) + ".xml"
+        if name not in variants or not os.path.isfile(tei_filename):
+            return None
+        return tei_filename, doc_id, variants[name]
+
+    def _build(self, tei_filename, doc_id, variant):
+        log.info("building %s for %s", variant, tei_filename)
+        name, options = VARIANTS[variant]
+        options = dict(self.options, **options)
+        doc = tei.Document(tei_filename, cache=self.cache, jobs=self.jobs,
+                           stats=self.stats, parser=self.parser)
+        files = [tei_filename] + doc.filenames
+        stamps = [(f, file_stamp(f)) for f in files]
+
+        # the keys of the surfaces change with their files and the header
+        h = hashlib.sha1()
+        h.update(json.dumps([__version__, variant, self.lists, self.indent,
+                             sorted(self.options.items())]).encode('utf-8'))
+        with open(tei_filename, 'rb') as fh:
+            h.update(fh.read())
+        for n, filename in doc.page_filenames():
+            h.update(doc.surface_key(filename).encode('utf-8'))
+        etag = '"%s"' % h.hexdigest()
+        modified = max(s[0] for f, s in stamps if s is not None)
+
+        uri = urljoin(self.base_uri, "%s/%s" % (doc_id, name))
+        lists = None
+        if self.lists and not options.get("skip_annos"):
+            lists = OrderedDict()
+            options["lists"] = lists
+            options["lists_uri"] = urljoin(self.base_uri, "%s/lists/" % doc_id)
+        m = Manifest(doc, uri, direct=True, stats=self.stats, **options)
+        fh = six.StringIO()
+        m.write(fh, indent=self.indent)
+
+        path = "/%s/%s" % (doc_id, name)
+        self.responses.put(path, Response(fh.getvalue(), etag, modified, stamps))
+        for list_name, j in (lists or {}).items():
+            body = json.dumps(j, indent=self.indent, sort_keys=m.stable,
+                              separators=separators(self.indent)) + "\n"
+            path = "/%s/lists/%s" % (doc_id, list_name)
+            self.responses.put(path, Response(body, etag, modified, stamps))
+
+    def serve(self, host="localhost", port=8000):
+        """
+        Serves the manifests over HTTP until interrupted.
+        """
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+        server.app = self
+        log.info("serving %s on http://%s:%s/", self.root, host, port)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+
+class Response(object):
+    """
+    A built manifest or annotation list, with the files it was built from
+    and their stamps.
+    """
+
+    def __init__(self, body, etag, modified, stamps):
+        if isinstance(body, six.text_type):
+            body = body.encode('utf-8')
+        self.body = body
+        self.etag = etag
+        self.modified = modified
+        self.stamps = stamps
+
+    def stale(self):
+        """
+        Returns true if any of the files it was built from have changed.
+        """
+        return any(file_stamp(f) != stamp for f, stamp in self.stamps)
+
+    def not_modified(self, headers):
+        """
+        Returns true if a conditional request can be answered with 304.
+        """
+        if_none_match = headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [t.strip() for t in if_none_match.split(",")]
+            return "*" in tags or self.etag in tags or "W/" + self.etag in tags
+        if_modified_since = headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            since = parsedate_tz(if_modified_since)
+            return since is not None and int(self.modified) <= mktime_tz(since)
+        return False
+
+    def headers(self):
+        return [
+            ("Content-Type", CONTENT_TYPE),
+            ("ETag", self.etag),
+            ("Last-Modified", formatdate(self.modified, usegmt=True)),
+            ("Access-Control-Allow-Origin", "*"),
+        ]
+
+
+class ResponseCache(object):
+    """
+    The responses of a ManifestServer by path, least recently used first,
+    evicted once their bodies take up more than max_size bytes. It can be
+    used from several threads.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.responses = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        with self.lock:
+            response = self.responses.pop(path, None)
+            if response is not None:
+                self.responses[path] = response
+            return response
+
+    def put(self, path, response):
+        with self.lock:
+            old = self.responses.pop(path, None)
+            if old is not None:
+                self.size -= len(old.body)
+            self.responses[path] = response
+            self.size += len(response.body)
+            while self.size > self.max_size and len(self.responses) > 1:
+                path, old = self.responses.popitem(last=False)
+                self.size -= len(old.body)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    An HTTPServer that answers each request in a thread of its own.
+    """
+
+    daemon_threads = True
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    Answers GET and HEAD requests with the server's ManifestServer.
+    """
+
+    def do_GET(self):
+        self._respond(True)
+
+    def do_HEAD(self):
+        self._respond(False)
+
+    def _respond(self, send_body):
+        status, headers, body = self.server.app.get(self.path, self.headers)
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body and status != 304:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.info("%s %s", self.address_string(), format % args)
+
+
+def _error(status, message):
+    return status, [("Content-Type", "text/plain")], (message + "\n").encode('utf-8')
+
@@ -1,71 +1,234 @@
 #!/usr/bin/env python
 
+import os
 import re
+import six
 import sys
 import tei
 import json
 import pyld
 
+from collections import OrderedDict
 from six.moves.urllib.parse import urljoin
 from rdflib.plugin import register, Parser, Serializer
 from rdflib import ConjunctiveGraph, URIRef, RDF, RDFS, BNode, Literal
 
+from .emitter import Emitter
+from .output import separators
+from .stats import NULL_STATS
 from .namespaces import DC, OA, OAX, ORE, SC, SGA, TEI, EXIF, CNT
 
 
+# zone types that get zone annotations
+ZONE_TYPES = [
+    "top",
+    "left_margin",
+    "main",
+    "pagination",
+    "library"
+    ]
+
+TEXT_ANNOTATION_TYPES = {
+    tei.Line: SGA.LineAnnotation,
+    tei.Delete: SGA.DeletionAnnotation,
+    tei.Add: SGA.AdditionAnnotation,
+    tei.Space: SGA.SpaceAnnotation,
+    tei.Segment: SGA.SegmentAnnotation,
+    tei.Highlight: SGA.HighlightAnnotation,
+}
+
+# the layers of annotations a manifest can have, in the order they are
+# added to each canvas
+LAYERS = ["zone", "text", "html", "xml"]
+
+# the kinds of text annotation by the name they are selected with, and
+# the attribute of a zone that has them, in the order they are added
+TEXT_TYPES = OrderedDict([
+    ("line", "lines"),
+    ("addition", "adds"),
+    ("deletion", "deletes"),
+    ("highlight", "highlights"),
+    ("space", "spaces"),
+    ("segment", "segments"),
+])
+
+# literal CSS for addition places
+PLACE_CSS = {
+    "superlinear": "vertical-align: super;",
+    "sublinear": "vertical-align: sub;",
+}
+
+# literal CSS for highlight renditions
+RENDER_CSS = {
+    # "hyphenated" : None
+    "underline": "border-bottom: 1px solid; line-height: 1em;",
+    "double-underline": "border-bottom: 3px double; line-height: 1em;",
+    "bold": "font-weight: bold;",
+    "caps": "font-variant: small-caps;",
+    "italic": "font-style: italic;",
+    "sup": "vertical-align: super; font-size: 80%",
+    "sub": "vertical-align: sub; font-size: 80%"
+}
+
+
 class Manifest(object):
 
-    def __init__(self, tei_filename, manifest_uri, page=None, skip_annos=False):
+    def __init__(self, tei_filename, manifest_uri, page=None, skip_annos=False, cache=None, jobs=None, direct=False, stream=False, sidecar=None, stats=None, parser=None, lists=None, lists_uri=None, layers=None, text_types=None, stable=False):
         """
         Create a Shared Canvas manifest using the path to a given TEI file
         and the URI where the manifest will be published.
 
         m = Manifest("/path/to/tei.xml", "http://example.com/manifest.jsonld")
 
+        You can also pass in a tei.Document that has already been parsed in
+        place of the path, for example to build several manifests from it.
+
         Optionally pass in a page number if you are debugging and want
-        to limit the manifest to a specific page.
+        to limit the manifest to a specific page, or a selection of pages
+        like "3-10", "1,5,7" or the xml:ids of surfaces (see
+        tei.PageSelection). Only the selected surfaces are parsed.
 
         Optionally set the skip_annos parameter to true to skip text annotations.
+
+        Optionally pass in the layers of annotations to add, from LAYERS,
+        and the kinds of text annotation to add to the text layer, from
+        TEXT_TYPES, either as lists or comma separated, to only build what
+        is needed: layers="zone,text", text_types="line,deletion". The
+        layers that aren't selected are left out of the manifest.
+
+        Optionally pass in a cache.SurfaceCache to reuse the surfaces parsed
+        by a previous build, and the number of processes (jobs) to parse
+        surfaces with.
+
+        Optionally set direct to true to write the JSON-LD straight from
+        the TEI with an emitter.Emitter instead of building an rdflib graph
+        and compacting it with pyld, which is much faster for big
+        notebooks. The graph (m.g) is not built then.
+
+        Optionally set stream to true to parse the surfaces only as the
+        manifest is written with write(), which writes each page as soon
+        as it is done so that memory use depends on the biggest page rather
+        than on the whole notebook. Streaming implies direct, as does passing
+        in a streamed tei.Document.
+
+        Optionally pass in the sidecar.Sidecar of a previous build to only
+        parse the surfaces that changed since (or whose document header
+        did) and copy the other pages from it. It implies stream, and once
+        the manifest is written the sidecar for the new build is in
+        m.sidecar; pass in an empty Sidecar to start recording one.
+
+        Optionally pass in a stats.Stats to collect the time spent in each
+        stage of the build and counts of what was built.
+
+        Optionally set parser to "lxml" or "stdlib" to choose what the TEI
+        is read with (see parsers.get_parser).
+
+        Optionally pass in a directory to write the annotations of each
+        canvas to, as an annotation list per layer, so that the manifest
+        only has the canvases, images, sequence and ranges and a viewer can
+        fetch the annotations of a page when it is shown. The canvases
+        refer to their lists with otherContent. The lists are published at
+        lists_uri, by default a directory named like the one they are
+        written to next to the manifest. It implies direct. The lists can
+        also be kept in a dict by file name rather than written, if you
+        give their lists_uri. The names of the files that were written are
+        in list_names once the manifest has been.
+
+        Optionally set stable to true to label the blank nodes of each page
+        after its surface, the type of each annotation and its offsets
+        rather than by counting them, and to write the keys of the JSON-LD
+        in order, so that an unchanged page is written the same way
+        whatever changes around it. It implies direct.
         """
 
-        g = self.g = ConjunctiveGraph()
-        self.tei = tei.Document(tei_filename)
+        self.pages = None
+        if page is not None:
+            self.pages = tei.PageSelection(page)
+        self.sidecar = sidecar
+        self.stats = stats or NULL_STATS
+        self.layers = _select(layers, LAYERS, "layer")
+        self.text_types = _select(text_types, TEXT_TYPES, "text annotation type")
+        self.lists = lists
+        self.lists_uri = None
+        self.list_names = []
+        if lists is not None:
+            if lists_uri is None:
+                if not isinstance(lists, six.string_types):
+                    raise ValueError("annotation lists kept in a dict need a lists_uri")
+                lists_uri = urljoin(manifest_uri, os.path.basename(os.path.normpath(lists)))
+            self.lists_uri = lists_uri.rstrip("/") + "/"
+        if sidecar is not None:
+            stream = True
+        if isinstance(tei_filename, tei.Document):
+            self.tei = tei_filename
+        else:
+            self.tei = tei.Document(tei_filename, cache=cache, jobs=jobs, stream=stream, pages=self.pages, stats=self.stats, parser=parser)
         self.uri = URIRef(manifest_uri)
+        self.skip_annos = skip_annos
+        self.stable = stable
+        # a streamed document has no surfaces to build a graph from
+        self.direct = direct or stable or sidecar is not None or lists is not None or self.tei.stream
+        if self.direct:
+            self.g = None
+            return
 
-        ta = self.text_annotations = BNode()
-        g.add((self.uri, ORE.aggregates, ta))
-        g.add((ta, RDF.type, ORE.Aggregation))
-        g.add((ta, RDF.type, SC.AnnotationList))
-        g.add((ta, RDF.type, SC.Layer))
-        g.add((ta, RDFS.label, Literal("Transcription")))
-        g.add((ta, SC.forMotivation, SC.painting))
-
-        za = self.zone_annotations = BNode()
-        g.add((self.uri, ORE.aggregates, za))
-        g.add((za, RDF.type, ORE.Aggregation))
-        g.add((za, RDF.type, SC.AnnotationList))
-        g.add((za, RDF.type, SC.Layer))
-        g.add((za, RDFS.label, Literal("Zones")))
-
-        ha = self.html_annotations = BNode()
-        g.add((self.uri, ORE.aggregates, ha))
-        g.add((ha, RDF.type, SC.AnnotationList))
-        g.add((ha, RDF.type, ORE.Aggregation))
-        g.add((ha, RDF.type, SC.Layer))
-        g.add((ha, SC.forMotivation, SGA.reading))
-        g.add((ha, RDFS.label, Literal("Reading layer")))
-
-        xa = self.xml_annotations = BNode()
-        g.add((self.uri, ORE.aggregates, xa))
-        g.add((xa, RDF.type, SC.AnnotationList))
-        g.add((xa, RDF.type, ORE.Aggregation))
-        g.add((xa, RDF.type, SC.Layer))
-        g.add((xa, SC.forMotivation, SGA.source))
-        g.add((xa, RDFS.label, Literal("TEI source")))
-
-        self._build(page, skip_annos)
+        g = self.g = ConjunctiveGraph()
+        # the style nodes, shared by every annotation with the same style
+        self._styles = {}
+
+        if "text" in self.layers:
+            ta = self.text_annotations = BNode()
+            g.add((self.uri, ORE.aggregates, ta))
+            g.add((ta, RDF.type, ORE.Aggregation))
+            g.add((ta, RDF.type, SC.AnnotationList))
+            g.add((ta, RDF.type, SC.Layer))
+            g.add((ta, RDFS.label, Literal("Transcription")))
+            g.add((ta, SC.forMotivation, SC.painting))
+
+        if "zone" in self.layers:
+            za = self.zone_annotations = BNode()
+            g.add((self.uri, ORE.aggregates, za))
+            g.add((za, RDF.type, ORE.Aggregation))
+            g.add((za, RDF.type, SC.AnnotationList))
+            g.add((za, RDF.type, SC.Layer))
+            g.add((za, RDFS.label, Literal("Zones")))
+
+        if "html" in self.layers:
+            ha = self.html_annotations = BNode()
+            g.add((self.uri, ORE.aggregates, ha))
+            g.add((ha, RDF.type, SC.AnnotationList))
+            g.add((ha, RDF.type, ORE.Aggregation))
+            g.add((ha, RDF.type, SC.Layer))
+            g.add((ha, SC.forMotivation, SGA.reading))
+            g.add((ha, RDFS.label, Literal("Reading layer")))
+
+        if "xml" in self.layers:
+            xa = self.xml_annotations = BNode()
+            g.add((self.uri, ORE.aggregates, xa))
+            g.add((xa, RDF.type, SC.AnnotationList))
+            g.add((xa, RDF.type, ORE.Aggregation))
+            g.add((xa, RDF.type, SC.Layer))
+            g.add((xa, SC.forMotivation, SGA.source))
+            g.add((xa, RDFS.label, Literal("TEI source")))
+
+        # parse the surfaces first so that they aren't timed as the graph
+        with self.stats.stage("manifest.surfaces"):
+            self.tei.surfaces
+        with self.stats.stage("manifest.graph"):
+            self._build(self.pages, skip_annos)
+        if self.stats.enabled:
+            self.stats.count("triples", len(g))
+            self.stats.count("bnodes", len(set(n for t in g for n in t if isinstance(n, BNode))))
 
     def jsonld(self, indent=2):
+        if self.direct:
+            e = Emitter(self)
+            with self.stats.stage("manifest.emit"):
+                j = e.jsonld(self.pages, self.skip_annos)
+            self.sidecar = e.sidecar
+            self.list_names = e.list_names
+            return j
+
         # somewhat inefficient since we are serializing the json
         # and then reading it back in, to compact it with jsonld
         # jsonld's compaction actually works properly with the context
@@ -73,17 +236,39 @@ class Manifest(object):
         # also use rdflib_jsonld.serlializer.from_rdf to skip
         # the serialization, but unofortunately it seems to introduce
         # errors into the graph.
-        j = self.g.serialize(format='json-ld')
-        j = json.loads(j)
+        with self.stats.stage("manifest.serialize"):
+            j = self.g.serialize(format='json-ld')
+            j = json.loads(j)
         # Before returning, add information about works.
         # This is a hack until we move to IIIF
         for node in j:
             if node["@id"] == str(self.uri):
                 node["sga:containedWorks"] = self.tei.works
 
-        j = pyld.jsonld.compact(j, self._context())
+        with self.stats.stage("manifest.compact"):
+            j = pyld.jsonld.compact(j, self._context())
         return j
 
+    def write(self, fh, indent=2, compress=()):
+        """
+        Write the JSON-LD to a file. Direct manifests are written page by
+        page as they are built. With no indent the JSON-LD is written
+        without any whitespace, and annotation lists are written like the
+        manifest, with compressed copies if any are given (see
+        output.write).
+        """
+        if self.direct:
+            e = Emitter(self)
+            with self.stats.stage("manifest.emit"):
+                e.write(fh, self.pages, self.skip_annos, indent=indent, compress=compress)
+            self.sidecar = e.sidecar
+            self.list_names = e.list_names
+        else:
+            j = self.jsonld()
+            with self.stats.stage("manifest.write"):
+                json.dump(j, fh, indent=indent, separators=separators(indent))
+                fh.write("\n")
+
     def tei_url(self, surface):
         path = surface.relative_path
         path = path.replace('/data', '')
@@ -98,7 +283,7 @@ class Manifest(object):
         html_url = html_url.replace('.xml', '.html')
         return html_url
 
-    def _build(self, page=None, skip_annos=None):
+    def _build(self, pages=None, skip_annos=None):
         self.g.add((self.uri, RDF.type, SC.Manifest))
         self.g.add((self.uri, RDFS.label, Literal(self.tei.label)))
         self.g.add((self.uri, DC.title, Literal(self.tei.title)))
@@ -108,9 +293,9 @@ class Manifest(object):
         if hasattr(self.tei, 'state'):
             self.g.add((self.uri, SGA.stateLabel, Literal(self.tei.state)))
         self.g.add((self.uri, SC.service, URIRef(self.tei.service)))
-        self._add_canvases(page, skip_annos)
+        self._add_canvases(pages, skip_annos)
 
-    def _add_canvases(self, page=None, skip_annos=None):
+    def _add_canvases(self, pages=None, skip_annos=None):
         g = self.g
 
         # add the list of sequences
@@ -157,12 +342,9 @@ class Manifest(object):
         g.add((canvas_list_uri, RDF.type, RDF.List))
 
         # now add each surface
-        page_count=0
-
         for surface in self.tei.surfaces:
 
-            page_count += 1
-            if page is not None and page_count != page:
+            if pages is not None and not pages.includes(surface.page, surface.xmlid):
                 continue
 
             # add the canvas
@@ -205,16 +387,20 @@ class Manifest(object):
             # Skip lower-level annotations when requested
             if not skip_annos:
                 # add the zone annotations
-                self._add_zone_annotations(surface, canvas_uri)
+                if "zone" in self.layers:
+                    self._add_zone_annotations(surface, canvas_uri)
 
                 # add the line annotations
-                self._add_text_annotations(surface)
+                if "text" in self.layers:
+                    self._add_text_annotations(surface)
 
                 # add the html annotations
-                self._add_html_annotations(surface, canvas_uri)
+                if "html" in self.layers:
+                    self._add_html_annotations(surface, canvas_uri)
 
                 # add the xml annotations
-                self._add_xml_annotations(surface, canvas_uri)
+                if "xml" in self.layers:
+                    self._add_xml_annotations(surface, canvas_uri)
 
             range_label = self.tei.section_loci_pages_only.get(surface.xmlid, None)
             if range_label:
@@ -236,17 +422,11 @@ class Manifest(object):
     def _add_zone_annotations(self, surface, canvas):
         g = self.g
 
-        accepted_types = [
-            "top",
-            "left_margin",
-            "main",
-            "pagination",
-            "library"
-            ]
-
+        source = URIRef(self.tei_url(surface))
         for zone in surface.zones:
 
-            if zone.type in accepted_types:
+            if self._annotates_zone(zone):
+                self._count_annotation(SC.ContentAnnotation)
 
                 annotation = BNode()
                 g.add((self.zone_annotations, ORE.aggregates, annotation))
@@ -259,7 +439,7 @@ class Manifest(object):
 
                 # construct a URL for the tei xml file assuming that the
                 # sga data is mounted next to the manifest
-                g.add((body, OA.hasSource, URIRef(self.tei_url(surface))))
+                g.add((body, OA.hasSource, source))
 
                 selector = BNode()
                 g.add((body, OA.hasSelector, selector))
@@ -281,42 +461,34 @@ class Manifest(object):
                 if zone.type == "left_margin":
                   g.add((selector, RDF.type, SC[zone.type]))
 
+    def _annotates_zone(self, zone):
+        return zone.type in ZONE_TYPES
+
     def _add_text_annotations(self, surface):
-        g = self.g
+        source = URIRef(self.tei_url(surface))
 
         for zone in surface.zones:
-            # TODO: process highlights too
-            for line in zone.lines:
-                self._add_text_annotation(line, surface)
-            for add in zone.adds:
-                self._add_text_annotation(add, surface)
-            for delete in zone.deletes:
-                self._add_text_annotation(delete, surface)
-            for highlight in zone.highlights:
-                self._add_text_annotation(highlight, surface)
-            for space in zone.spaces:
-                self._add_text_annotation(space, surface)
-            for segment in zone.segments:
-                self._add_text_annotation(segment, surface)
-
-    def _add_text_annotation(self, a, surface):
-        # Skip possible *Span elements that failed to get an end pos
+            for a in self._text_annotations(zone):
+                self._add_text_annotation(a, source)
+
+    def _text_annotations(self, zone):
+        """
+        Yields the lines, additions, deletions, highlights, spaces and
+        segments of a zone, or only the selected text_types of them.
+        """
+        for text_type in self.text_types:
+            for a in getattr(zone, TEXT_TYPES[text_type]):
+                yield a
+
+    def _add_text_annotation(self, a, source):
+        # Skip possible *Span elements that failed to get an end pos,
+        # which tei.Document logs a warning about
         if not a.end:
             return 0
 
         g = self.g
-        if type(a) == tei.Line:
-            ann_type = SGA.LineAnnotation
-        elif type(a) == tei.Delete:
-            ann_type = SGA.DeletionAnnotation
-        elif type(a) == tei.Add:
-            ann_type = SGA.AdditionAnnotation
-        elif type(a) == tei.Space:
-            ann_type = SGA.SpaceAnnotation
-        elif type(a) == tei.Segment:
-            ann_type = SGA.SegmentAnnotation
-        elif type(a) == tei.Highlight:
-            ann_type = SGA.HighlightAnnotation
+        ann_type = self._text_annotation_type(a)
+        self._count_annotation(ann_type)
 
         # link AnnotationList to Annotation
         annotation = BNode()
@@ -325,13 +497,9 @@ class Manifest(object):
         g.add((annotation, RDF.type, OAX.Highlight))
 
         # add rendering styles
-        if a.rend:
-            m = re.match('indent(\d+)', a.rend)
-            if m:
-                indent = int(m.group(1))
-                g.add((annotation, SGA.textIndentLevel, Literal(indent)))
-            else:
-                g.add((annotation, SGA.textAlignment, Literal(a.rend)))
+        rendition = self._text_rendition(a)
+        if rendition:
+            g.add((annotation, rendition[0], Literal(rendition[1])))
         if ann_type == SGA.SpaceAnnotation:
             g.add((annotation, SGA.spaceExt, Literal(a.ext)))
 
@@ -339,16 +507,11 @@ class Manifest(object):
         target = BNode()
         g.add((annotation, OA.hasTarget, target))
         g.add((target, RDF.type, OA.SpecificResource))
-        g.add((target, OA.hasSource, URIRef(self.tei_url(surface))))
+        g.add((target, OA.hasSource, source))
 
-        classes = []
-        if hasattr(a, 'in_work'):
-            if a.in_work:  # it may be false when present
-                classes.append('work-' + a.in_work)
-        if a.hand:
-            classes.append('hand-' + a.hand)
+        classes = self._text_classes(a)
         if classes:
-            g.add((target, SGA.hasClass, Literal(" ".join(classes))))
+            g.add((target, SGA.hasClass, Literal(classes)))
 
         # link SpecificResource and TextOffsetSelector
         selector = BNode()
@@ -358,39 +521,63 @@ class Manifest(object):
         g.add((selector, OAX.end, Literal(a.end)))
 
         # link SpecificResource to CSS as needed
-        if ann_type == SGA.AdditionAnnotation and a.place:
-            if a.place == "superlinear":
-                text = "vertical-align: super;"
-            elif a.place == "sublinear":
-                text = "vertical-align: sub;"
-            else:
-                text = None
-            if text:
-                css = BNode()
-                g.add((target, OA.hasStyle, css))
+        style = self._text_style(a, ann_type)
+        if style:
+            css = self._styles.get(style)
+            if css is None:
+                css = self._styles[style] = BNode()
                 g.add((css, RDF.type, CNT.ContentAsText))
                 g.add((css, DC['format'], Literal("text/css")))
-                g.add((css, CNT.chars, Literal(text)))
-
-        # Add literal CSS
-        if ann_type == SGA.HighlightAnnotation:
-            rend_to_css = {
-                # "hyphenated" : None
-                "underline": "border-bottom: 1px solid; line-height: 1em;",
-                "double-underline": "border-bottom: 3px double; line-height: 1em;",
-                "bold": "font-weight: bold;",
-                "caps": "font-variant: small-caps;",
-                "italic": "font-style: italic;",
-                "sup": "vertical-align: super; font-size: 80%",
-                "sub": "vertical-align: sub; font-size: 80%"
-            }
-            value = rend_to_css.get(a.rend)
-            if value:
-                css = BNode()
-                g.add((target, OA.hasStyle, css))
-                g.add((css, RDF.type, CNT.ContentAsText))
-                g.add((css, DC['format'], Literal("text/css")))
-                g.add((css, CNT.chars, Literal(value)))
+                g.add((css, CNT.chars, Literal(self._style_css(style))))
+            g.add((target, OA.hasStyle, css))
+
+    def _text_annotation_type(self, a):
+        # views of a tei.ZoneTable know which element they stand in for
+        return TEXT_ANNOTATION_TYPES[getattr(a, 'element', None) or type(a)]
+
+    def _count_annotation(self, ann_type):
+        if self.stats.enabled:
+            name = re.split('[#/]', ann_type)[-1]
+            self.stats.count("annotations." + name)
+
+    def _text_rendition(self, a):
+        """
+        Returns the property and value for the rend of a text annotation:
+        its indent level or its alignment.
+        """
+        if not a.rend:
+            return None
+        return _rendition(a.rend)
+
+    def _text_classes(self, a):
+        """
+        Returns the CSS classes for the work and hand of a text annotation.
+        """
+        classes = []
+        if hasattr(a, 'in_work'):
+            if a.in_work:  # it may be false when present
+                classes.append('work-' + a.in_work)
+        if a.hand:
+            classes.append('hand-' + a.hand)
+        return " ".join(classes)
+
+    def _text_style(self, a, ann_type):
+        """
+        Returns the name of the style of a text annotation, if it has one:
+        the place of an addition or the rend of a highlight. Annotations
+        with the same style share a node with its CSS (see _style_css).
+        """
+        if ann_type == SGA.AdditionAnnotation and a.place in PLACE_CSS:
+            return a.place
+        if ann_type == SGA.HighlightAnnotation and a.rend in RENDER_CSS:
+            return a.rend
+        return None
+
+    def _style_css(self, style):
+        """
+        Returns the literal CSS of a style.
+        """
+        return PLACE_CSS.get(style) or RENDER_CSS[style]
 
     def _add_html_annotations(self, surface, canvas_uri):
         ann = BNode()
@@ -615,4 +802,30 @@ class Manifest(object):
         "mbox" : "foaf:mbox"
       }
 
+
+def _select(names, known, what):
+    # the names selected from a list of known ones, in the order they are
+    # known in; all of them if none are given
+    if names is None:
+        return list(known)
+    if isinstance(names, six.string_types):
+        names = [n.strip() for n in names.split(",") if n.strip()]
+    for name in names:
+        if name not in known:
+            raise ValueError("unknown %s: %s" % (what, name))
+    return [name for name in known if name in names]
+
+
+def _rendition(rend, _renditions={}):
+    # the property and value for a rend, worked out once for each rend
+    rendition = _renditions.get(rend)
+    if rendition is None:
+        m = re.match(r'indent(\d+)', rend)
+        if m:
+            rendition = SGA.textIndentLevel, int(m.group(1))
+        else:
+            rendition = SGA.textAlignment, rend
+        _renditions[rend] = rendition
+    return rendition
+
 register('json-ld', Serializer, 'rdflib_jsonld.serializer', 'JsonLDSerializer')
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+import json
+import logging
+
+from collections import OrderedDict
+
+from .output import write
+
+log = logging.getLogger(__name__)
+
+# changes whenever what is recorded for a page does
+FORMAT = 3
+
+
+class Sidecar(object):
+    """
+    A record of a direct build of a manifest, kept next to it so that the
+    next build only has to parse the surfaces that changed. For every page
+    it keeps the key of the surface it was built from (see
+    tei.Document.surface_key) and the path of its file, the nodes it added to the manifest and what
+    it added to the nodes that are shared by every page.
+
+    sidecar = Sidecar.load("Manifest.jsonld.sidecar")
+    m = Manifest("/path/to/tei.xml", "http://example.com/Manifest.jsonld", sidecar=sidecar)
+    m.write(open("Manifest.jsonld", "w"))
+    m.sidecar.save("Manifest.jsonld.sidecar")
+    """
+
+    def __init__(self, options=None, pages=None):
+        self.options = options or {}
+        self.pages = OrderedDict()
+        for record in pages or []:
+            self.pages[record.page] = record
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns the Sidecar saved in a file, or an empty one if there is no
+        file or it can't be used.
+        """
+        try:
+            with open(path) as fh:
+                # keep the keys of the nodes in the order they are written
+                j = json.load(fh, object_pairs_hook=OrderedDict)
+        except (IOError, OSError):
+            return cls()
+        except ValueError:
+            log.warning("ignoring unreadable sidecar %s", path)
+            return cls()
+        if j.get("format") != FORMAT:
+            return cls()
+        return cls(j["options"], [PageRecord(**p) for p in j["pages"]])
+
+    def save(self, path):
+        j = OrderedDict([
+            ("format", FORMAT),
+            ("options", self.options),
+            ("pages", [r.__dict__ for r in self.pages.values()]),
+        ])
+        write(path, lambda fh: fh.write(json.dumps(j, separators=(',', ':'))))
+
+    def reusable(self, options, page, key, path):
+        """
+        Returns the record of a page if it was built with the same options
+        from a surface with the same key at the same path (see
+        tei.relative_path), or None. The urls of the page's TEI and HTML
+        are made from the path, so a moved surface is built again.
+        """
+        record = self.pages.get(page)
+        if record is None or record.key != key or record.path != path or self.options != options:
+            return None
+        return record
+
+
+class PageRecord(object):
+    """
+    What one page of a manifest was built from and what it added to it. It
+    stands in for the page's tei.Surface when the page is reused.
+    """
+
+    def __init__(self, page, key, path, xmlid, range_events, image, height,
+                 width, canvas, image_annotation, aggregates, nodes,
+                 styles=None, lists=None):
+        self.page = page
+        self.key = key
+        self.path = path
+        self.xmlid = xmlid
+        self.range_events = range_events
+        self.image = image
+        self.height = height
+        self.width = width
+        self.canvas = canvas
+        self.image_annotation = image_annotation
+        # (layer, id) pairs of the annotations, or annotation lists, that
+        # the page adds to the layers
+        self.aggregates = aggregates
+        self.nodes = nodes
+        # the names of the styles the page's annotations share
+        self.styles = styles or []
+        # the (file name, nodes) of the page's annotation lists
+        self.lists = lists or []
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+import sys
+import json
+import timeit
+
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from .output import write
+
+
+class Stats(object):
+    """
+    Collects where the time of a build goes: the wall time of each stage
+    (stages nest, so a stage includes the ones run inside it), how much
+    the peak memory of the process grew during it, how long each surface
+    took to load and counts of what was built.
+
+    stats = Stats()
+    m = Manifest("/path/to/tei.xml", "http://example.com/Manifest.jsonld", stats=stats)
+    m.jsonld()
+    stats.save("stats.json")
+
+    Classes that take stats use NULL_STATS when they aren't given any, so
+    collecting nothing costs next to nothing.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.counts = {}
+        self.surfaces = []
+
+    def stage(self, name):
+        """
+        Returns a context manager that times a stage.
+        """
+        return _Stage(self, name)
+
+    def label(self, name):
+        """
+        Returns a context manager that labels what is done in it, like the
+        TEI document being built. Only a profiler.Profiler uses labels.
+        """
+        return _null_stage
+
+    def add_time(self, name, seconds, calls=1, rss_growth_kb=None):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {"seconds": 0.0, "calls": 0, "rss_growth_kb": None}
+        stage["seconds"] += seconds
+        stage["calls"] += calls
+        stage["rss_growth_kb"] = _add(stage["rss_growth_kb"], rss_growth_kb)
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def surface(self, filename, seconds, cached=False):
+        self.surfaces.append({"filename": filename, "seconds": seconds, "cached": cached})
+
+    def merge(self, other):
+        """
+        Adds the stats collected by another Stats, like the ones a surface
+        was loaded with in another process.
+        """
+        for name, stage in other.stages.items():
+            self.add_time(name, stage["seconds"], stage["calls"], stage["rss_growth_kb"])
+        for name, n in other.counts.items():
+            self.count(name, n)
+        self.surfaces.extend(other.surfaces)
+
+    def as_dict(self):
+        return OrderedDict([
+            ("stages", self.stages),
+            ("counts", OrderedDict(sorted(self.counts.items()))),
+            ("surfaces", self.surfaces),
+        ])
+
+    def save(self, path):
+        write(path, lambda fh: json.dump(self.as_dict(), fh, indent=2))
+
+
+class NullStats(object):
+    """
+    Stats that are thrown away.
+    """
+
+    enabled = False
+
+    def stage(self, name):
+        return _null_stage
+
+    def label(self, name):
+        return _null_stage
+
+    def add_time(self, name, seconds, calls=1, rss_growth_kb=None):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def surface(self, filename, seconds, cached=False):
+        pass
+
+    def merge(self, other):
+        pass
+
+
+NULL_STATS = NullStats()
+
+
+class _Stage(object):
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+        self.start_rss = max_rss_kb()
+        return self
+
+    def __exit__(self, *exc):
+        growth = None
+        if self.start_rss is not None:
+            growth = max_rss_kb() - self.start_rss
+        self.stats.add_time(self.name, timeit.default_timer() - self.start, rss_growth_kb=growth)
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_null_stage = _NullStage()
+
+
+def max_rss_kb():
+    """
+    Returns the peak resident memory of the process so far in kilobytes,
+    or None where it isn't available. A stage can only see how much it
+    raised the peak, not how much memory it used below it.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes rather than kilobytes
+    if sys.platform == "darwin":
+        rss //= 1024
+    return rss
+
+
+def _add(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a + b
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+import io
+import os
+import random
+
+from .namespaces import TEI, XI, MITH
+
+ZONE_TYPES = ["pagination", "library", "main", "left_margin", "left_margin"]
+
+
+def generate(directory, doc_id="ox-synthetic_notebook", pages=10, zones=3,
+             lines=20, adds=0.2, deletes=0.2, spans=0.05, milestones=0.05,
+             seed=0):
+    """
+    Write a synthetic Shelley-Godwin style TEI document and its surfaces,
+    for testing and benchmarking without a copy of the sga data, and
+    return the path of the document. Like the sga data it is written to
+    data/tei/ox/ in the directory, with the surfaces in a directory of
+    their own:
+
+    path = generate("/tmp/corpus", pages=100)
+
+    The document has works with chapters whose loci point at the first
+    half of the surfaces and at lines in the second half, a work whose
+    locus points at a line and at the segments the milestones start, and
+    two hands. Each surface has zones of the first few ZONE_TYPES (and
+    more left margins after them), with lines lines in its main zone and
+    two in the others. adds, deletes, spans (addSpan and delSpan closed by
+    an anchor) and milestones are the chance of a line having one. The
+    same arguments always give the same TEI.
+    """
+    rnd = random.Random(seed)
+    tei_dir = os.path.join(directory, "data", "tei", "ox")
+    surface_dir = os.path.join(tei_dir, doc_id)
+    if not os.path.isdir(surface_dir):
+        os.makedirs(surface_dir)
+
+    surface_ids = []
+    segments = []
+    for n in range(1, pages + 1):
+        surface_id = "%s-%04d" % (doc_id, n)
+        xml = surface(surface_id, n, rnd, zones, lines, adds, deletes, spans, milestones, segments)
+        _write(os.path.join(surface_dir, surface_id + ".xml"), xml)
+        surface_ids.append(surface_id)
+
+    half = max(1, pages // 2)
+    chapter1 = " ".join("#" + s for s in surface_ids[:half])
+    chapter2 = " ".join("#%s-main-%s" % (s, min(3, lines - 1)) for s in surface_ids[half:])
+    other = " ".join("#" + s for s in ["%s-main-1" % surface_ids[0]] + segments) if surface_ids else ""
+    includes = "\n".join('  <xi:include href="%s/%s.xml"/>' % (doc_id, s) for s in surface_ids)
+    path = os.path.join(tei_dir, doc_id + ".xml")
+    _write(path, DOCUMENT % {
+        "tei": TEI,
+        "xi": XI,
+        "id": doc_id,
+        "chapter1": chapter1,
+        "chapter2": chapter2 or chapter1,
+        "other": other,
+        "includes": includes,
+    })
+    return path
+
+
+def surface(surface_id, n, rnd, zones=3, lines=20, adds=0.2, deletes=0.2,
+            spans=0.05, milestones=0.05, segments=None):
+    """
+    Returns the TEI for a synthetic surface, drawing what is in it from
+    the random.Random rnd. The xml:ids of its milestones are appended to
+    the list segments, if there is one.
+    """
+    out = [u'<?xml version="1.0" encoding="utf-8"?>\n'
+           u'<surface xmlns="%s" xmlns:mith="%s" ulx="0" uly="0" lrx="5410" lry="6660" '
+           u'xml:id="%s" mith:folio="%s%s" mith:shelfmark="MS. Synthetic">\n'
+           % (TEI, MITH, surface_id, (n + 1) // 2, "r" if n % 2 else "v")]
+    out.append(u'<graphic url="http://example.com/images/%s.jp2"/>\n' % surface_id)
+    anchors = 0
+    zone_types = ZONE_TYPES[:zones] + ["left_margin"] * (zones - len(ZONE_TYPES))
+    for z, zone_type in enumerate(zone_types):
+        # the line ids of a zone type that is repeated get its position
+        zone_id = zone_type if zone_types.index(zone_type) == z else "%s%s" % (zone_type, z)
+        out.append(u'<zone type="%s">\n' % zone_type)
+        for i in range(lines if zone_type == "main" else 2):
+            attrs = u' xml:id="%s-%s-%s"' % (surface_id, zone_id, i)
+            r = rnd.random()
+            if r < 0.2:
+                attrs += u' rend="indent%s"' % rnd.randint(1, 4)
+            elif r < 0.25:
+                attrs += u' rend="center"'
+            if rnd.random() < 0.1:
+                attrs += u' hand="#pbs"'
+            out.append(u'<line%s>It was on a dreary night of November ' % attrs)
+            if rnd.random() < deletes:
+                out.append(u'<del rend="strikethrough">that</del> ')
+            if rnd.random() < adds:
+                place = rnd.choice(["superlinear", "sublinear", "intralinear"])
+                out.append(u'<add place="%s" hand="#pbs">when</add> ' % place)
+            if rnd.random() < 0.1:
+                out.append(u'<hi rend="%s">I beheld</hi> ' % rnd.choice(["underline", "sup", "italic"]))
+            if rnd.random() < spans:
+                anchors += 1
+                name = rnd.choice(["addSpan", "delSpan"])
+                out.append(u'<%s spanTo="#%s-a%s" rend="strikethrough"/>the accomplishment ' % (name, surface_id, anchors))
+                out.append(u'of my toils<anchor xml:id="%s-a%s"/> ' % (surface_id, anchors))
+            if rnd.random() < milestones:
+                anchors += 1
+                out.append(u'<milestone unit="tei:seg" xml:id="%s-m%s" spanTo="#%s-a%s"/>' % (surface_id, anchors, surface_id, anchors))
+                out.append(u'with an anxiety<anchor xml:id="%s-a%s"/> ' % (surface_id, anchors))
+                if segments is not None:
+                    segments.append("%s-m%s" % (surface_id, anchors))
+            out.append(u'that almost amounted to agony</line>\n')
+            if rnd.random() < 0.02:
+                out.append(u'<space dim="vertical" extent="2"/>\n')
+        out.append(u'</zone>\n')
+    out.append(u'</surface>\n')
+    return u"".join(out)
+
+
+def _write(path, text):
+    with io.open(path, "w", encoding="utf-8") as fh:
+        fh.write(text)
+
+
+DOCUMENT = u'''<?xml version="1.0" encoding="utf-8"?>
+<TEI xmlns="%(tei)s" xmlns:xi="%(xi)s" xml:id="%(id)s">
+<teiHeader>
+ <fileDesc>
+  <titleStmt><title type="main">Synthetic Notebook</title></titleStmt>
+  <sourceDesc>
+   <msDesc>
+    <msIdentifier><repository>Bodleian Library</repository></msIdentifier>
+    <msContents>
+     <msItem class="#work">
+      <bibl status="fair_copy"><author>Mary Shelley</author><title>Frankenstein, or the Modern Prometheus</title><date>1816</date></bibl>
+      <msItem class="#chapter"><bibl><title>Chapter 1</title></bibl><locus target="%(chapter1)s"/></msItem>
+      <msItem class="#chapter"><bibl><title>Chapter 2</title></bibl><locus target="%(chapter2)s"/></msItem>
+     </msItem>
+     <msItem class="#work">
+      <bibl><author>Percy Shelley</author><title>Mont Blanc</title></bibl><locus target="%(other)s"/>
+     </msItem>
+    </msContents>
+    <physDesc>
+     <handDesc>
+      <handNote xml:id="mws" scope="major"><persName>Mary Shelley</persName></handNote>
+      <handNote xml:id="pbs"><persName>Percy Shelley</persName></handNote>
+     </handDesc>
+    </physDesc>
+    <history><origin>1816-1817</origin></history>
+   </msDesc>
+  </sourceDesc>
+ </fileDesc>
+</teiHeader>
+<sourceDoc>
+%(includes)s
+</sourceDoc>
+</TEI>
+'''
@@ -3,28 +3,67 @@
 import os
 import re
 import sys
+import json
+import hashlib
+import logging
+import six
 import teizone
-import StringIO
-import tempfile
-import string
+import timeit
+import multiprocessing
 
+from array import array
 from collections import OrderedDict
-from copy import copy
 
 from six.moves.urllib.parse import urljoin
 
-from xml.sax import make_parser
 from xml.sax.handler import ContentHandler
 from xml.etree import ElementTree as etree
 
+from . import parsers
+from .cache import surface_key
+from .header import Header
+from .stats import Stats, NULL_STATS
 from .namespaces import XI, TEI, MITH, XML
 
+log = logging.getLogger(__name__)
+
 
 class Document(object):
 
-    def __init__(self, tei_filename):
-        ns = {'tei': TEI, 'xi': XI, 'xml': XML}
-        tei = etree.parse(tei_filename).getroot()
+    def __init__(self, tei_filename, cache=None, jobs=None, executor=None, stream=False, pages=None, stats=None, parser=None):
+        """
+        Parse a TEI document. The surfaces it includes are parsed the first
+        time they (or the ranges they make up) are used.
+
+        Optionally pass in a cache.SurfaceCache to reuse surfaces that were
+        parsed by a previous build.
+
+        Surfaces are parsed one after another unless you set jobs to the
+        number of processes to parse them with, or pass in an executor:
+        anything with an order preserving map(), like a multiprocessing.Pool
+        or a concurrent.futures.ProcessPoolExecutor.
+
+        Optionally set stream to true to leave the surfaces unparsed:
+        iter_surfaces() then parses them one at a time as they are needed
+        and doesn't hold on to them, so that a big notebook can be written
+        out without keeping all of it in memory. The ranges are complete
+        once the surfaces have been iterated over.
+
+        Optionally pass in pages to only load some of the surfaces: a
+        PageSelection, or anything one can be made from, like 3, "3-10",
+        "1,5,ox-ms_abinger_c58-0061" or a list of them. The ranges are then
+        made up of the selected surfaces only.
+
+        Optionally pass in a stats.Stats to time the parsing.
+
+        The document and its surfaces are read with lxml if it is installed,
+        or else the standard library; set parser to "lxml" or "stdlib" to
+        choose (see parsers.get_parser).
+        """
+        self.stats = stats or NULL_STATS
+        self.parser = parsers.get_parser(parser)
+        with self.stats.stage("document.parse"):
+            header = Header(tei_filename, self.parser)
 
         # extract some document level metadata
         preserve_titles = ["ms_abinger",
@@ -40,7 +79,7 @@ class Document(object):
                            "to_william",
                            "msl_1876_forster"]
 
-        tei_id = tei.get('{%(xml)s}id' % ns)
+        tei_id = header.xmlid
         esc_title_id = tei_id
 
         for i, title in enumerate(preserve_titles):
@@ -54,111 +93,355 @@ class Document(object):
                             esc_title_id)
 
         page_sequence = page_sequence.replace("ox/", "oxford/")
-        # To determine the manifest title, get the first work title.
-        # If there are more than one work, add: "and others".
-        classDecl = ""
-        works = tei.findall('.//{%(tei)s}msItem[@class="#work"]/{%(tei)s}bibl/{%(tei)s}title' % ns)
-        if not works:
-            work_parts = tei.findall('.//{%(tei)s}msItem[@class="#work_part"]/{%(tei)s}bibl/{%(tei)s}title' % ns)
-            self.title = work_parts[0].text
-            classDecl = "#work_part"
-        else:
-            self.title = works[0].text
-            classDecl = "#work"
-            if len(works) > 1:
-                self.title += " and others"
-
-        xpath_params = copy(ns)
-        xpath_params["cd"] = classDecl
-        self.agent = tei.find('.//{%(tei)s}msItem[@class="%(cd)s"][0]/{%(tei)s}bibl/{%(tei)s}author' % xpath_params).text
-        self.attribution = tei.find('.//{%(tei)s}repository' % ns).text
-        # To determine the date, first look at the manuscript's history.
-        # Otherwise use the work's metadata.
-        ms_date = tei.find('.//{%(tei)s}history/{%(tei)s}origin' % ns)
-        main_work_date = tei.find('.//{%(tei)s}msItem/{%(tei)s}bibl/{%(tei)s}date' % ns)
-        if ms_date is not None:
-            self.date = ms_date.text
-        else:
-            self.date = main_work_date.text
+        self.title = header.title
+        self.agent = header.agent
+        self.attribution = header.attribution
+        self.date = header.date
         self.service = "http://shelleygodwinarchive.org/sc/%s" % page_sequence
-        state = tei.find('.//{%(tei)s}msItem[@class="%(cd)s"]/{%(tei)s}bibl' % xpath_params)
-        if 'status' in state.attrib:
-            self.state = state.get("status").replace("_", " ")
-        else:
-            self.state = "none"
-        self.label = tei.find('.//{%(tei)s}titleStmt/{%(tei)s}title[@type="main"]' % ns).text
-
-        # get the hands that are used
-        self.hands = {}
-        for hand in tei.findall('.//{%(tei)s}physDesc//{%(tei)s}handNote[@{%(xml)s}id]' % ns):
-            self.hands[hand.get('{%(xml)s}id' % ns)] = hand.findall('{%(tei)s}persName' % ns)[0].text
-            if hand.get('scope') == 'major' or hand.get('scope') == 'sole':
-                self.main_hand = hand.get('{%(xml)s}id' % ns)
+        self.state = header.state
+        self.label = header.label
+        self.hands = header.hands
+        if hasattr(header, 'main_hand'):
+            self.main_hand = header.main_hand
 
         # get all loci to locate works scattered across pages.
         # Also structure them by section for sc:ranges.
         self.work_loci = {}
         self.section_loci = {}
-        self.section_loci_pages_only = {}
-        self.works = []
-        allowed_sections = ["chapter", "scene"]
-        for work in tei.findall('.//{%(tei)s}msItem[@class="%(cd)s"]' % xpath_params):
-            w_title = work.find('./{%(tei)s}bibl/{%(tei)s}title' % ns).text
-            w_title = w_title.strip()
-            self.works.append(w_title)
-            sections = []
-            for s in allowed_sections:
-                sections += work.findall('.//{%s}msItem[@class="#%s"]' % (ns['tei'], s))
-            # If there are no subsections, set the context back to work
-            if not sections:
-                sections = [work]
-            for section in sections:
-                s_title = section.find('./{%(tei)s}bibl/{%(tei)s}title' % ns).text
-                s_title = s_title.strip()
-                for locus in section.findall('.//{%(tei)s}locus' % ns):
-                    if locus.attrib.get('target'):
-                        targets = re.split(r'\s+', locus.attrib.get('target').strip())
-                        for target in targets:
-                            target = target.lstrip("#")
-                            w_title = w_title.lower()
-                            w_title = re.sub(r"["+string.punctuation+r"\s]", "_", w_title)
-                            self.work_loci[target] = w_title
-                            self.section_loci[target] = s_title
-                            self.section_loci_pages_only[target] = s_title
-
-        # load each surface
-        self.surfaces = []
-        self.ranges = OrderedDict()
-        for inc in tei.findall('.//{%(tei)s}sourceDoc/{%(xi)s}include' % ns):
-            filename = urljoin(tei_filename, inc.attrib['href'])
-            surface = Surface(filename, self)
-            self.surfaces.append(surface)
+        self._section_loci_pages_only = {}
+        self.works = header.works
+        for target, w_title, s_title in header.loci:
+            self.work_loci[target] = w_title
+            self.section_loci[target] = s_title
+            self._section_loci_pages_only[target] = s_title
+
+        # everything a surface depends on when it is parsed in the
+        # context of this document, used to key cached surfaces
+        self.fingerprint = hashlib.sha1(json.dumps([
+            getattr(self, 'main_hand', None),
+            self.hands,
+            self.work_loci,
+            self.section_loci
+        ], sort_keys=True).encode('utf-8')).hexdigest()
+
+        # find the surfaces, which are loaded when they are needed; the
+        # rest of the document is only read as their filenames are
+        self.tei_filename = tei_filename
+        self.cache = cache
+        self.jobs = jobs
+        self.executor = executor
+        self.stream = stream
+        self._filenames = []
+        self._includes = header.includes()
+        self.pages = None
+        if pages is not None:
+            self.pages = pages if isinstance(pages, PageSelection) else PageSelection(pages)
+        self._surfaces = None
+        self._ranges = OrderedDict()
+        self._header_section_loci_pages_only = dict(self._section_loci_pages_only)
+
+    @property
+    def surfaces(self):
+        """
+        The parsed surfaces, in order. They are parsed the first time they
+        are used, and are never kept when the document is streamed (None).
+        """
+        if self._surfaces is None and not self.stream:
+            self._surfaces = list(self._stream_surfaces())
+        return self._surfaces
+
+    @property
+    def filenames(self):
+        """
+        The filenames of the surfaces the document includes, in order.
+        """
+        for filename in self._iter_filenames():
+            pass
+        return self._filenames
+
+    @property
+    def ranges(self):
+        """
+        The titles of the sections the surfaces belong to, with the xml:ids
+        of those surfaces.
+        """
+        self.surfaces
+        return self._ranges
+
+    @property
+    def section_loci_pages_only(self):
+        self.surfaces
+        return self._section_loci_pages_only
+
+    def iter_surfaces(self, reuse=None):
+        """
+        Returns an iterator over the surfaces in order. Unless the document
+        is streamed they are only parsed once.
+
+        A streamed document can be given a dict of objects that stand in
+        for some surfaces by page number, which are then not parsed, such
+        as the sidecar.PageRecords of a previous build. They need the page,
+        xmlid and range_events of the surface.
+        """
+        if self.stream:
+            return self._stream_surfaces(reuse)
+        return iter(self.surfaces)
+
+    def load(self, reuse=None):
+        """
+        Parses the surfaces of a document that isn't streamed now, rather
+        than the first time they are used, and returns them. Like
+        iter_surfaces() it can be given a dict of objects that stand in
+        for some surfaces by page number, such as the unchanged surfaces of
+        an earlier Document of the same file, which are then not parsed.
+        """
+        self._surfaces = list(self._stream_surfaces(reuse))
+        return self._surfaces
+
+    def page_filenames(self):
+        """
+        Returns the (page number, filename) of the surfaces to load, counting
+        pages from 1.
+        """
+        return list(self._iter_page_filenames())
+
+    def _iter_page_filenames(self):
+        for page in enumerate(self._iter_filenames(), 1):
+            if self.pages is None or self.pages.select([page]):
+                yield page
+
+    def _iter_filenames(self):
+        # the filenames read so far, then the rest as they are read
+        i = 0
+        while True:
+            if i < len(self._filenames):
+                yield self._filenames[i]
+                i += 1
+            elif self._includes is None:
+                return
+            else:
+                href = next(self._includes, None)
+                if href is None:
+                    self._includes = None
+                else:
+                    self._filenames.append(urljoin(self.tei_filename, href))
+
+    def surface_key(self, filename):
+        """
+        Returns a hash of everything the parsed surface in a file depends
+        on, which changes whenever the file or this document's header do.
+        """
+        return surface_key(filename, self, _needs_pagination_fix(filename))
+
+    def _stream_surfaces(self, reuse=None):
+        # each pass over the surfaces rebuilds the ranges from scratch
+        self._section_loci_pages_only = dict(self._header_section_loci_pages_only)
+        self._ranges = OrderedDict()
+        reuse = reuse or {}
+        if self.executor is None and not (self.jobs and self.jobs > 1):
+            # load each surface as soon as its filename is read
+            pages = self._iter_page_filenames()
+            surfaces = None
+        else:
+            pages = self.page_filenames()
+            filenames = [f for n, f in pages if n not in reuse]
+            surfaces = self._load_surfaces(filenames, self.jobs, self.executor)
+        for n, f in pages:
+            surface = reuse.get(n)
+            if surface is None:
+                if surfaces is None:
+                    surface = load_surface((f, self, self.cache, self.stats.enabled))
+                else:
+                    surface = next(surfaces)
+                self._merge_stats(surface, n)
+                for begin, name, span_to in getattr(surface, 'unclosed_spans', []):
+                    log.warning("%s: <%s spanTo=\"#%s\"> at offset %s is never closed by an anchor",
+                                f, name, span_to, begin)
+            else:
+                self.stats.count("surfaces.reused")
+            surface.page = n
+            self._add_to_ranges(surface)
+            yield surface
+        if self.cache:
+            self.cache.prune()
+
+    def _merge_stats(self, surface, page):
+        # the stats a surface was loaded with, possibly in another process
+        cached = surface.__dict__.pop('cached', None)
+        if cached is not None and self.cache:
+            self.cache.record(cached)
+        stats = surface.__dict__.pop('stats', None)
+        if stats is not None:
+            for s in stats.surfaces:
+                s["page"] = page
+            self.stats.merge(stats)
+
+    def _load_surfaces(self, filenames, jobs=None, executor=None):
+        """
+        Yields the parsed surfaces for a list of filenames, in order. When
+        they are parsed in other processes they only get a copy of the
+        document metadata they need.
+        """
+        if executor is None and jobs and jobs > 1:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                for surface in self._load_surfaces(filenames, executor=pool):
+                    yield surface
+            finally:
+                pool.close()
+                pool.join()
+            return
+        if executor is None:
+            for f in filenames:
+                yield load_surface((f, self, self.cache, self.stats.enabled))
+            return
+        # prefer Pool.imap, which hands back each surface as soon as it
+        # and the ones before it are ready
+        imap = getattr(executor, 'imap', executor.map)
+        context = SurfaceContext(self)
+        args = [(f, context, self.cache, self.stats.enabled) for f in filenames]
+        for surface in imap(load_surface, args):
+            yield surface
+
+    def _add_to_ranges(self, surface):
+        """
+        Replay the section loci that matched while a surface was parsed,
+        adding the surface to the document's ranges.
+        """
+        for xmlid in surface.range_events:
+            title = self.section_loci[xmlid]
+            if not self._ranges.get(title):
+                self._ranges[title] = set()
+            self._ranges[title].add(surface.xmlid)
+            # Update list of section_loci_pages_only
+            if self._section_loci_pages_only.get(xmlid, None):
+                self._section_loci_pages_only[surface.xmlid] = self._section_loci_pages_only.pop(xmlid)
+
+
+class PageSelection(object):
+    """
+    A selection of pages in a document: page numbers (counting from 1),
+    ranges of them and the xml:ids of surfaces, given as a list or a comma
+    separated string.
+
+    pages = PageSelection("3-10,12,ox-ms_abinger_c58-0061")
+    """
+
+    def __init__(self, pages):
+        self.numbers = set()
+        self.ids = set()
+        if isinstance(pages, six.string_types):
+            pages = pages.split(',')
+        elif not isinstance(pages, (list, tuple, set)):
+            pages = [pages]
+        for page in pages:
+            self._add(page)
+
+    def _add(self, page):
+        if isinstance(page, six.integer_types):
+            self.numbers.add(page)
+            return
+        page = page.strip()
+        m = re.match(r'^(\d+)(?:-(\d+))?$', page)
+        if m:
+            first = int(m.group(1))
+            last = int(m.group(2) or first)
+            if last < first:
+                raise ValueError("invalid page range: %s" % page)
+            self.numbers.update(range(first, last + 1))
+        elif page:
+            self.ids.add(page.lstrip('#'))
+
+    def includes(self, number, xmlid=None):
+        return number in self.numbers or (xmlid is not None and xmlid in self.ids)
+
+    def select(self, pages):
+        """
+        Returns the (page number, filename) pairs that are selected. A
+        surface's xml:id is read from the start of its file only when the
+        selection has ids in it.
+        """
+        selected = []
+        for number, filename in pages:
+            if number in self.numbers or (self.ids and surface_id(filename) in self.ids):
+                selected.append((number, filename))
+        return selected
+
+
+def surface_id(filename):
+    """
+    Returns the xml:id of a surface without parsing all of it.
+    """
+    with open(filename, 'rb') as fh:
+        for event, element in etree.iterparse(fh, events=('start',)):
+            return element.get('{%s}id' % XML)
+
+
+class SurfaceContext(object):
+    """
+    The parts of a Document that parsing a Surface depends on, small enough
+    to send to another process.
+    """
+
+    def __init__(self, document):
+        self.hands = document.hands
+        self.work_loci = document.work_loci
+        self.section_loci = document.section_loci
+        self.fingerprint = document.fingerprint
+        self.parser = document.parser
+        if hasattr(document, 'main_hand'):
+            self.main_hand = document.main_hand
+
+
+def load_surface(args):
+    """
+    Parse a surface, or fetch it from the cache if it is unchanged. Takes a
+    (filename, document, cache, collect) tuple so that it can be mapped over
+    a pool of processes; document may be a Document or a SurfaceContext and
+    cache may be None. With a cache the surface is returned with whether it
+    was found there as its cached attribute, and when collect is true with
+    the stats.Stats of loading it as its stats attribute.
+    """
+    filename, document, cache, collect = args
+    stats = Stats() if collect else NULL_STATS
+    start = timeit.default_timer()
+    surface = None
+    if cache:
+        key = cache.key(filename, document, _needs_pagination_fix(filename))
+        surface = cache.get(key, count=False)
+    cached = surface is not None
+    if surface is None:
+        surface = Surface(filename, document, stats)
+        if cache:
+            cache.put(key, surface)
+    surface.filename = filename
+    if cache:
+        # counted by the document, which may be in another process
+        surface.cached = cached
+    if collect:
+        stats.count("surfaces.cached" if cached else "surfaces.parsed")
+        stats.surface(filename, timeit.default_timer() - start, cached)
+        surface.stats = stats
+    return surface
 
 
 class Surface(object):
 
-    def __init__(self, filename, document=None):
+    def __init__(self, filename, document=None, stats=None):
         self.filename = filename
+        stats = stats or NULL_STATS
 
-        # TODO: at some point we should write the canonical coordinates to the
-        # TEI. For now it is being done dynamically with zoner, saved to a
-        # temporary file, which we then parse with a SAX Parser,
+        # the zones that have no coordinates in the TEI are placed with
+        # teizone, unless unbind materialize-coords has written them there,
+        # and the resulting tree is walked to extract the line annotations.
 
-        surface = teizone.Surface(filename)
-        surface.guess_coordinates()
-        tmp_fh, tmp_filename = tempfile.mkstemp()
-        surface.save(tmp_filename)
+        with stats.stage("surface.parse"):
+            parser = getattr(document, 'parser', None)
+            doc = parsers.parse(filename, parser)
+        if place_zones(filename, doc, stats):
+            stats.count("surfaces.guessed")
 
-        doc = surface.doc
         tei = doc.getroot()
-
-        # Hack to avoid changing teizone: if this is abinger d 33, change coords of pagination
-        if "ox-ms_abinger_d33" in filename:
-            pag = tei.find('./{%s}zone[@type="pagination"]' % TEI)
-            if pag is not None:
-                pag.set('ulx', '150')
-                surface.save(tmp_filename)
-
         self.height = int(tei.attrib.get('lry'))
         self.width = int(tei.attrib.get('lrx'))
         self.xmlid = tei.attrib.get('{%s}id' % XML)
@@ -170,6 +453,10 @@ class Surface(object):
             self.image = gph.get('url')
         self.hands_label = ""
 
+        # ids that matched a section locus, in the order they were found;
+        # the document uses them to place the surface in its ranges
+        self.range_events = []
+
         # Only attempt to populate Document-dependent
         # properties when the document object is available
         if document:
@@ -180,27 +467,157 @@ class Surface(object):
 
             # Determine if this surface is in a range
             if self.xmlid in document.section_loci:
-                title = document.section_loci[self.xmlid]
-                if not document.ranges.get(title):
-                    document.ranges[title] = set()
-                document.ranges[title].add(self.xmlid)
+                self.range_events.append(self.xmlid)
 
-        # use a SAX parser to get the line annotations
+        # feed the tree to a SAX handler to get the line annotations
         # since we need to keep track of text offsets
 
-        parser = make_parser()
         handler = LineOffsetHandler(document, self)
-        parser.setContentHandler(handler)
-        parser.parse(tmp_filename)
-        self.zones = handler.zones
+        with stats.stage("surface.offsets"):
+            saxify(tei, handler)
+        with stats.stage("surface.compact"):
+            self.zone_table = ZoneTable(handler.zones)
+        self.range_events.extend(handler.range_events)
+        # (offset, element name, spanTo) of spans that no anchor closes
+        self.unclosed_spans = handler.unclosed_spans
+
+    @property
+    def zones(self):
+        """
+        The zones of the surface, read from its ZoneTable.
+        """
+        return self.zone_table.zones()
 
     @property
     def relative_path(self):
         """
         Returns the path to the XML file in the SGA Github repository.
         """
-        m = re.search('(/data/.+)', os.path.abspath(self.filename))
-        return m.group(1)
+        return relative_path(self.filename)
+
+
+class _TeizoneSurface(teizone.Surface):
+    """
+    A teizone.Surface for a tree that is already parsed.
+    """
+
+    def __init__(self, path, doc):
+        self.path = path
+        self.doc = doc
+        self.root = doc.getroot()
+        self.ulx = int(self.root.get('ulx'))
+        self.uly = int(self.root.get('uly'))
+        self.lrx = int(self.root.get('lrx'))
+        self.lry = int(self.root.get('lry'))
+        self.zones = self.root.findall('.//{%s}zone' % TEI)
+
+
+def relative_path(filename):
+    """
+    Returns the path of a surface file in the SGA Github repository, which
+    its TEI and HTML urls are made from.
+    """
+    m = re.search('(/data/.+)', os.path.abspath(filename))
+    return m.group(1)
+
+
+# the coordinates teizone gives the zones it places
+COORDINATES = ('ulx', 'uly', 'lrx', 'lry')
+
+
+def place_zones(filename, doc, stats=None):
+    """
+    Gives the zones of a parsed surface the coordinates that teizone
+    guesses for them, unless they all have them already, and moves the
+    pagination of ox-ms_abinger_d33. Returns true if teizone was used.
+    """
+    stats = stats or NULL_STATS
+    guessed = not has_coordinates(doc.getroot())
+    if guessed:
+        with stats.stage("surface.coordinates"):
+            _TeizoneSurface(filename, doc).guess_coordinates()
+
+    # Hack to avoid changing teizone: if this is abinger d 33, change coords of pagination
+    if _needs_pagination_fix(filename):
+        pag = doc.getroot().find('./{%s}zone[@type="pagination"]' % TEI)
+        if pag is not None:
+            pag.set('ulx', '150')
+    return guessed
+
+
+def has_coordinates(surface):
+    """
+    Returns true if every zone of a surface element that teizone would place
+    already has its coordinates, so that it would leave them all alone.
+    """
+    return all(z.get(c) is not None for z in _placed_zones(surface) for c in COORDINATES)
+
+
+def _placed_zones(surface):
+    # the zones teizone.Surface.guess_coordinates sets: the last main,
+    # library and pagination zones and every left margin
+    placed = OrderedDict()
+    left_margin = []
+    for z in surface.findall('.//{%s}zone' % TEI):
+        z_type = z.get('type')
+        if z_type == "left_margin":
+            left_margin.append(z)
+        elif z_type in ("main", "library", "pagination"):
+            placed[z_type] = z
+    return list(placed.values()) + left_margin
+
+
+def _needs_pagination_fix(filename):
+    return "ox-ms_abinger_d33" in filename
+
+
+def saxify(element, handler):
+    """
+    Feed an ElementTree element to a SAX ContentHandler. The handler sees
+    the same events, element names and attribute names that a
+    non-namespace-aware xml.sax parser reports for the element saved as TEI
+    (with TEI as the default namespace), so character offsets are identical
+    to parsing the saved file, without writing it to disk.
+    """
+    qnames = {}
+    handler.startDocument()
+    _saxify(element, handler, qnames)
+    handler.endDocument()
+
+
+def _saxify(element, handler, qnames):
+    name = _qname(element.tag, qnames)
+    attrs = {}
+    for key, value in element.attrib.items():
+        attrs[_qname(key, qnames)] = value
+    handler.startElement(name, attrs)
+    if element.text:
+        handler.characters(element.text)
+    for child in element:
+        # comments and processing instructions only contribute their tail
+        if isinstance(child.tag, six.string_types):
+            _saxify(child, handler, qnames)
+        if child.tail:
+            handler.characters(child.tail)
+    handler.endElement(name)
+
+
+def _qname(tag, qnames):
+    qname = qnames.get(tag)
+    if qname is None:
+        qname = tag
+        if tag[0] == "{":
+            uri, local = tag[1:].split("}", 1)
+            if uri == TEI:
+                qname = local
+            else:
+                prefix = _prefixes.get(uri)
+                if prefix:
+                    qname = "%s:%s" % (prefix, local)
+        qnames[tag] = qname
+    return qname
+
+_prefixes = {XML: "xml", MITH: "mith", XI: "xi"}
 
 
 class Zone(object):
@@ -290,14 +707,212 @@ class Highlight(object):
         self.hand = None
         self.hand_attr = None
 
+
+# the attribute values shared by the zone tables in the process, least
+# recently used first, so that a long running unbind watch or serve keeps
+# sharing the values it still sees without holding on to every value
+_INTERNED_MAX = 10000
+_interned_values = OrderedDict()
+
+
+def _interned(value):
+    if isinstance(value, six.string_types):
+        shared = _interned_values.pop(value, None)
+        if shared is None:
+            shared = value
+            if len(_interned_values) >= _INTERNED_MAX:
+                _interned_values.popitem(last=False)
+        _interned_values[shared] = shared
+        return shared
+    return value
+
+
+class ZoneTable(object):
+    """
+    The zones of a surface and the text annotations in them, stored column
+    by column in arrays instead of as an object per TEI element. Rows are
+    grouped by zone and then by kind of annotation, in document order.
+    Hands, renditions, work names and other attribute values are stored
+    once, in the values list, and the columns hold their index.
+
+    The zones and annotations are read through views (ZoneView, LineView
+    and so on) that subclass the classes LineOffsetHandler builds, so a
+    surface can be used just like one built from the plain objects.
+    """
+
+    kinds = ('lines', 'segments', 'adds', 'deletes', 'highlights', 'spaces')
+    zone_fields = ('ulx', 'uly', 'lrx', 'lry', 'type', 'rotate')
+    fields = ('rend', 'hand', 'hand_attr', 'in_work', 'spanTo', 'place', 'ext')
+
+    def __init__(self, zones):
+        self.values = []
+        self._index = {}
+        self.zone_begin = array('i')
+        self.zone_end = array('i')
+        self.zone_values = array('i')
+        self.begin = array('i')
+        self.end = array('i')
+        self.kind = array('B')
+        self.zone = array('i')
+        for field in self.fields:
+            setattr(self, field, array('i'))
+        # the first row of each kind of annotation in each zone
+        self.offsets = array('i', [0])
+
+        for z, zone in enumerate(zones):
+            self.zone_begin.append(zone.begin)
+            self.zone_end.append(zone.end)
+            for field in self.zone_fields:
+                self.zone_values.append(self._value(getattr(zone, field)))
+            for k, kind in enumerate(self.kinds):
+                for a in getattr(zone, kind):
+                    self.begin.append(a.begin)
+                    self.end.append(a.end)
+                    self.kind.append(k)
+                    self.zone.append(z)
+                    for field in self.fields:
+                        getattr(self, field).append(self._value(getattr(a, field, None)))
+                self.offsets.append(len(self.begin))
+        del self._index
+
+    def __len__(self):
+        return len(self.begin)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.values = [_interned(v) for v in self.values]
+
+    def zones(self):
+        return [ZoneView(self, z) for z in range(len(self.zone_begin))]
+
+    def annotations(self, z, kind):
+        """
+        Returns views of one kind of annotation (e.g. 'lines') in a zone.
+        """
+        k = self.kinds.index(kind)
+        i = z * len(self.kinds) + k
+        view = _views[k]
+        return [view(self, row) for row in range(self.offsets[i], self.offsets[i + 1])]
+
+    def _value(self, value):
+        # False and 0 are equal, but mean different things here
+        key = (type(value), value)
+        i = self._index.get(key)
+        if i is None:
+            i = self._index[key] = len(self.values)
+            self.values.append(_interned(value))
+        return i
+
+
+def _zone_value(i):
+    return property(lambda self: self._table.values[self._table.zone_values[self._i + i]])
+
+
+def _annotations(kind):
+    return property(lambda self: self._table.annotations(self._z, kind))
+
+
+class ZoneView(Zone):
+    """
+    A zone in a ZoneTable.
+    """
+
+    def __init__(self, table, z):
+        self._table = table
+        self._z = z
+        self._i = z * len(table.zone_fields)
+
+    begin = property(lambda self: self._table.zone_begin[self._z])
+    end = property(lambda self: self._table.zone_end[self._z])
+
+    ulx = _zone_value(0)
+    uly = _zone_value(1)
+    lrx = _zone_value(2)
+    lry = _zone_value(3)
+    type = _zone_value(4)
+    rotate = _zone_value(5)
+
+    lines = _annotations('lines')
+    segments = _annotations('segments')
+    adds = _annotations('adds')
+    deletes = _annotations('deletes')
+    highlights = _annotations('highlights')
+    spaces = _annotations('spaces')
+
+
+def _value(field):
+    return property(lambda self: self._table.values[getattr(self._table, field)[self._row]])
+
+
+class AnnotationView(object):
+    """
+    A row of a ZoneTable. element is the class it stands in for.
+    """
+
+    element = None
+    text = ""
+
+    def __init__(self, table, row):
+        self._table = table
+        self._row = row
+
+    begin = property(lambda self: self._table.begin[self._row])
+    end = property(lambda self: self._table.end[self._row])
+    rend = _value('rend')
+    hand = _value('hand')
+    hand_attr = _value('hand_attr')
+
+
+class LineView(AnnotationView, Line):
+    element = Line
+    in_work = _value('in_work')
+
+class SegmentView(AnnotationView, Segment):
+    element = Segment
+    in_work = _value('in_work')
+    spanTo = _value('spanTo')
+
+class AddView(AnnotationView, Add):
+    element = Add
+    spanTo = _value('spanTo')
+    place = _value('place')
+
+class DeleteView(AnnotationView, Delete):
+    element = Delete
+    spanTo = _value('spanTo')
+
+class HighlightView(AnnotationView, Highlight):
+    element = Highlight
+
+class SpaceView(AnnotationView, Space):
+    element = Space
+    ext = _value('ext')
+
+# the views for each of ZoneTable.kinds
+_views = (LineView, SegmentView, AddView, DeleteView, HighlightView, SpaceView)
+
+
+# the order the zone lists are searched in for spans an anchor closes
+_span_order = {"delSpan": 0, "addSpan": 1, "milestone": 2}
+
+
 class LineOffsetHandler(ContentHandler):
     """
     SAX Handler for extracting zones, lines, adds, deletes,
     and highlights from a TEI canvas. Each canvas is a
     collection of zones. The lines, adds, deletes and highlights
     are added to the zone that they are a part of.
+
+    What is done with an element is looked up by its name in
+    start_handlers and end_handlers, so handlers for other TEI elements
+    can be added with register() without changing this class.
     """
 
+    # functions called with the handler and the attributes at the start
+    # of an element, and with the handler at its end, by element name
+    start_handlers = {}
+    end_handlers = {}
+
     def __init__(self, document=None, surface=None):
         self.document = document
         self.surface = surface
@@ -307,180 +922,243 @@ class LineOffsetHandler(ContentHandler):
         self.width = None
         if document:
             self.hand_stack = [document.main_hand]
+            self.work_loci = document.work_loci
+            self.section_loci = document.section_loci
         else:
             self.hand_stack = ["default"]
+            self.work_loci = None
+            self.section_loci = None
         self.work_stack = []
         self.stack = []
+        self.range_events = []
+        # spanning elements in the zones by the xml:id of the anchor that
+        # closes them, and the ones no anchor closed (see endDocument)
+        self.spans = {}
+        self.unclosed_spans = []
+        self._closed = set()
 
-    def startElement(self, name, attrs):
+    @classmethod
+    def register(cls, name, start=None, end=None):
+        """
+        Registers functions to call at the start of an element, with the
+        handler and the element's attributes, and at its end, with the
+        handler. Registering on a subclass leaves its parents alone.
 
-        def _determine_hand(hand):
-            if hand:
-                if hand[0]=="#": hand = hand[1:]
-                if self.hand_stack[-1] != hand:
-                    self.hand_stack.append(hand)
-                return hand
-            return self.hand_stack[-1]
-
-        def _is_in_work(xmlid):
-            # only proceed if document metadata does exist
-            if self.document:
-                if xmlid:
-                    xmlid = xmlid.strip()
-                    if xmlid in self.document.work_loci.keys():
-                        return self.document.work_loci[xmlid]
-                else:
-                    s_xmlid = self.surface.xmlid.strip()
-                    if s_xmlid in self.document.work_loci.keys():
-                        return self.document.work_loci[s_xmlid]
-            return False
-
-        def _add_to_range(xmlid):
-            """ Determine if id is part of a section and if yes add its
-                surface id to the document's ranges """
-            # only proceed if document metadata does exist
-            if self.document and self.surface:
-                if xmlid:
-                    xmlid = xmlid.strip()
-                    if xmlid in self.document.section_loci.keys():
-                        title = self.document.section_loci[xmlid]
-                        surface_id = self.surface.xmlid
-                        if not self.document.ranges.get(title):
-                            self.document.ranges[title] = set()
-                        self.document.ranges[title].add(surface_id)
-                        # Update list of section_loci_pages_only
-                        if self.document.section_loci_pages_only.get(xmlid, None):
-                            self.document.section_loci_pages_only[surface_id] = self.document.section_loci_pages_only.pop(xmlid)
-
-        def _pop_hand(e):
-            # pop hand from stack if defined at add level
-            hand = e.hand_attr
-            if hand and hand[0]=="#": hand = hand[1:]
-            # make sure to keep default hand at the bottom of the hand stack
-            if len(self.hand_stack) > 1 and hand == self.hand_stack[-1]:
-                self.hand_stack.pop()
-
-        if name == "zone":
-            z = Zone(attrs)
-            z.begin = self.pos
-            z.type = attrs.get("type")
-            self.zones.append(z)
-            self.stack.append(z)
-        elif name == "line":
-            l = Line()
-            l.begin = self.pos
-            l.rend = attrs.get('rend')
-            l.hand_attr = attrs.get('hand')
-            l.hand = _determine_hand(l.hand_attr)
-            l.in_work = _is_in_work(attrs.get('xml:id'))
-            _add_to_range(attrs.get('xml:id'))
-            self.zones[-1].lines.append(l)
-            self.stack.append(l)
-        elif name == "add":
-            a = Add()
-            a.begin = self.pos
-            a.rend = attrs.get('rend')
-            a.place = attrs.get('place')
-            a.hand_attr = attrs.get('hand')
-            a.hand = _determine_hand(a.hand_attr)
-            self.zones[-1].adds.append(a)
-            self.stack.append(a)
-        elif name == "addSpan":
-            d = Add()
-            d.begin = self.pos
-            d.spanTo = attrs.get('spanTo').lstrip('#')
-            d.rend = attrs.get('rend')
-            d.hand_attr = attrs.get('hand')
-            d.hand = _determine_hand(d.hand_attr)
-            self.zones[-1].adds.append(d)
-        elif name == "del":
-            d = Delete()
-            d.begin = self.pos
-            d.rend = attrs.get('rend')
-            d.hand_attr = attrs.get('hand')
-            d.hand = _determine_hand(d.hand_attr)
-            self.stack.append(d)
-            # Don't add it to a zone if it's unmarked
-            if d.rend != 'unmarked':
-                self.zones[-1].deletes.append(d)
-        elif name == "delSpan":
-            d = Delete()
-            d.begin = self.pos
-            d.spanTo = attrs.get('spanTo').lstrip('#')
-            d.rend = attrs.get('rend')
-            d.hand_attr = attrs.get('hand')
-            d.hand = _determine_hand(d.hand_attr)
-            # Don't add it to a zone if it's unmarked
-            if d.rend != 'unmarked':
-                self.zones[-1].deletes.append(d)
-        elif name == "hi":
-            h = Highlight()
-            h.begin = self.pos
-            h.rend = attrs.get('rend')
-            h.hand_attr = attrs.get('hand')
-            h.hand = _determine_hand(h.hand_attr)
-            self.zones[-1].highlights.append(h)
-            self.stack.append(h)
-        elif name == "handShift":
-            hand = attrs.get('new')
-            if hand:
-                if hand[0]=="#": hand = hand[1:]
-                if self.hand_stack[-1] != hand:
-                    # set new hand at the top of the stack
-                    self.hand_stack[-1] = hand
-        elif name == "milestone":
-            if attrs.get('unit') == 'tei:seg':
-                xmlid = attrs.get('xml:id')
-                work = _is_in_work(xmlid)
-                _add_to_range(attrs.get('xml:id'))
-                if work:
-                    s = Segment()
-                    s.begin = self.pos
-                    s.hand_attr = attrs.get('hand')
-                    s.hand = _determine_hand(s.hand_attr)
-                    s.in_work = work
-                    s.spanTo = attrs.get('spanTo').lstrip('#')
-                    self.zones[-1].segments.append(s)
-        # Turn vertical spaces into lines
-        elif name == "space":
-            if attrs.get('dim') == 'vertical':
-                s = Space()
-                s.begin = self.pos
-                s.end = self.pos
-                s.ext = int(attrs.get('extent'))
-                self.zones[-1].spaces.append(s)
-        elif name == "anchor":
-            # anchors must always occur after the anchored element
-            # so looking back is safe
-            anchor_id = attrs.get('xml:id')
-            for zone in self.zones:
-                for delete in zone.deletes:
-                    spanTo = delete.spanTo
-                    if spanTo and spanTo == anchor_id:
-                        delete.end = self.pos
-                        _pop_hand(delete)
-                for add in zone.adds:
-                    spanTo = add.spanTo
-                    if spanTo and spanTo == anchor_id:
-                        add.end = self.pos
-                        _pop_hand(add)
-                for segment in zone.segments:
-                    spanTo = segment.spanTo
-                    if spanTo and spanTo == anchor_id:
-                        segment.end = self.pos
-                        _pop_hand(segment)
+        def start_gap(handler, attrs):
+            handler.gaps.append((handler.pos, attrs.get('reason')))
+
+        LineOffsetHandler.register("gap", start=start_gap)
+        """
+        if start is not None:
+            if 'start_handlers' not in cls.__dict__:
+                cls.start_handlers = dict(cls.start_handlers)
+            cls.start_handlers[name] = start
+        if end is not None:
+            if 'end_handlers' not in cls.__dict__:
+                cls.end_handlers = dict(cls.end_handlers)
+            cls.end_handlers[name] = end
+
+    def startElement(self, name, attrs):
+        start = self.start_handlers.get(name)
+        if start is not None:
+            start(self, attrs)
 
     def endElement(self, name):
-        if name in ("zone", "line", "add", "del", "hi"):
-            e = self.stack.pop()
-            e.end = self.pos
-            # pop hand from stack if it was specified as an attribute
-            if name != "zone":
-                hand = e.hand_attr
-                if hand and hand[0]=="#": hand = hand[1:]
-                # make sure to keep default hand at the bottom of the hand stack
-                if len(self.hand_stack) > 1 and hand == self.hand_stack[-1]:
-                    self.hand_stack.pop()
+        end = self.end_handlers.get(name)
+        if end is not None:
+            end(self)
 
     def characters(self, content):
         self.pos += len(content) # TODO: does unicode matter here?
+
+    def endDocument(self):
+        # spans without an anchor get no end and so no annotation
+        for spans in self.spans.values():
+            for zone, order, name, span in spans:
+                if id(span) not in self._closed:
+                    self.unclosed_spans.append((span.begin, name, span.spanTo))
+        self.unclosed_spans.sort()
+
+    def determine_hand(self, hand):
+        if hand:
+            if hand[0]=="#": hand = hand[1:]
+            if self.hand_stack[-1] != hand:
+                self.hand_stack.append(hand)
+            return hand
+        return self.hand_stack[-1]
+
+    def pop_hand(self, e):
+        # pop hand from stack if defined at add level
+        hand = e.hand_attr
+        if hand and hand[0]=="#": hand = hand[1:]
+        # make sure to keep default hand at the bottom of the hand stack
+        if len(self.hand_stack) > 1 and hand == self.hand_stack[-1]:
+            self.hand_stack.pop()
+
+    def is_in_work(self, xmlid):
+        # only proceed if document metadata does exist
+        if self.work_loci is not None:
+            if xmlid:
+                return self.work_loci.get(xmlid.strip(), False)
+            return self.work_loci.get(self.surface.xmlid.strip(), False)
+        return False
+
+    def add_to_range(self, xmlid):
+        """ Determine if id is part of a section and if yes record it
+            so the document can add the surface to its ranges """
+        # only proceed if document metadata does exist
+        if self.section_loci is not None and self.surface and xmlid:
+            xmlid = xmlid.strip()
+            if xmlid in self.section_loci:
+                self.range_events.append(xmlid)
+
+    def add_span(self, name, span):
+        if span.spanTo:
+            entry = (len(self.zones) - 1, _span_order[name], name, span)
+            self.spans.setdefault(span.spanTo, []).append(entry)
+
+
+def _start_zone(handler, attrs):
+    z = Zone(attrs)
+    z.begin = handler.pos
+    z.type = attrs.get("type")
+    handler.zones.append(z)
+    handler.stack.append(z)
+
+def _start_line(handler, attrs):
+    l = Line()
+    l.begin = handler.pos
+    l.rend = attrs.get('rend')
+    l.hand_attr = attrs.get('hand')
+    l.hand = handler.determine_hand(l.hand_attr)
+    l.in_work = handler.is_in_work(attrs.get('xml:id'))
+    handler.add_to_range(attrs.get('xml:id'))
+    handler.zones[-1].lines.append(l)
+    handler.stack.append(l)
+
+def _start_add(handler, attrs):
+    a = Add()
+    a.begin = handler.pos
+    a.rend = attrs.get('rend')
+    a.place = attrs.get('place')
+    a.hand_attr = attrs.get('hand')
+    a.hand = handler.determine_hand(a.hand_attr)
+    handler.zones[-1].adds.append(a)
+    handler.stack.append(a)
+
+def _start_add_span(handler, attrs):
+    d = Add()
+    d.begin = handler.pos
+    d.spanTo = attrs.get('spanTo').lstrip('#')
+    d.rend = attrs.get('rend')
+    d.hand_attr = attrs.get('hand')
+    d.hand = handler.determine_hand(d.hand_attr)
+    handler.zones[-1].adds.append(d)
+    handler.add_span("addSpan", d)
+
+def _start_del(handler, attrs):
+    d = Delete()
+    d.begin = handler.pos
+    d.rend = attrs.get('rend')
+    d.hand_attr = attrs.get('hand')
+    d.hand = handler.determine_hand(d.hand_attr)
+    handler.stack.append(d)
+    # Don't add it to a zone if it's unmarked
+    if d.rend != 'unmarked':
+        handler.zones[-1].deletes.append(d)
+
+def _start_del_span(handler, attrs):
+    d = Delete()
+    d.begin = handler.pos
+    d.spanTo = attrs.get('spanTo').lstrip('#')
+    d.rend = attrs.get('rend')
+    d.hand_attr = attrs.get('hand')
+    d.hand = handler.determine_hand(d.hand_attr)
+    # Don't add it to a zone if it's unmarked
+    if d.rend != 'unmarked':
+        handler.zones[-1].deletes.append(d)
+        handler.add_span("delSpan", d)
+
+def _start_hi(handler, attrs):
+    h = Highlight()
+    h.begin = handler.pos
+    h.rend = attrs.get('rend')
+    h.hand_attr = attrs.get('hand')
+    h.hand = handler.determine_hand(h.hand_attr)
+    handler.zones[-1].highlights.append(h)
+    handler.stack.append(h)
+
+def _start_hand_shift(handler, attrs):
+    hand = attrs.get('new')
+    if hand:
+        if hand[0]=="#": hand = hand[1:]
+        if handler.hand_stack[-1] != hand:
+            # set new hand at the top of the stack
+            handler.hand_stack[-1] = hand
+
+def _start_milestone(handler, attrs):
+    if attrs.get('unit') == 'tei:seg':
+        xmlid = attrs.get('xml:id')
+        work = handler.is_in_work(xmlid)
+        handler.add_to_range(xmlid)
+        if work:
+            s = Segment()
+            s.begin = handler.pos
+            s.hand_attr = attrs.get('hand')
+            s.hand = handler.determine_hand(s.hand_attr)
+            s.in_work = work
+            s.spanTo = attrs.get('spanTo').lstrip('#')
+            handler.zones[-1].segments.append(s)
+            handler.add_span("milestone", s)
+
+def _start_space(handler, attrs):
+    # Turn vertical spaces into lines
+    if attrs.get('dim') == 'vertical':
+        s = Space()
+        s.begin = handler.pos
+        s.end = handler.pos
+        s.ext = int(attrs.get('extent'))
+        handler.zones[-1].spaces.append(s)
+
+def _start_anchor(handler, attrs):
+    # anchors must always occur after the anchored element
+    # so looking back is safe. The spans are closed in the order
+    # they appear in the zones: zone by zone, deletes before adds
+    # before segments.
+    spans = handler.spans.get(attrs.get('xml:id'))
+    if spans:
+        for zone, order, name, span in sorted(spans, key=lambda s: s[:2]):
+            span.end = handler.pos
+            handler.pop_hand(span)
+            handler._closed.add(id(span))
+
+def _end_zone(handler):
+    handler.stack.pop().end = handler.pos
+
+def _end_element(handler):
+    e = handler.stack.pop()
+    e.end = handler.pos
+    # pop hand from stack if it was specified as an attribute
+    handler.pop_hand(e)
+
+LineOffsetHandler.start_handlers = {
+    "zone": _start_zone,
+    "line": _start_line,
+    "add": _start_add,
+    "addSpan": _start_add_span,
+    "del": _start_del,
+    "delSpan": _start_del_span,
+    "hi": _start_hi,
+    "handShift": _start_hand_shift,
+    "milestone": _start_milestone,
+    "space": _start_space,
+    "anchor": _start_anchor,
+}
+
+LineOffsetHandler.end_handlers = {
+    "zone": _end_zone,
+    "line": _end_element,
+    "add": _end_element,
+    "del": _end_element,
+    "hi": _end_element,
+}
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+import os
+import time
+import logging
+import timeit
+
+from . import batch, tei
+from .stats import NULL_STATS
+
+log = logging.getLogger(__name__)
+
+
+class Watcher(object):
+    """
+    Keeps the manifests of some TEI documents up to date as they are
+    edited. The documents are parsed once and kept in memory, and their
+    files are polled for changes: when the TEI or one of its surfaces
+    changes only that document's manifests are written again, and only
+    the surfaces that changed are parsed again.
+
+    w = Watcher(["/path/to/tei.xml"], "http://example.com/{id}/{name}", out_dir="site")
+    w.run()
+
+    The options are the ones batch.build takes, and the manifests are
+    written the way it writes them.
+    """
+
+    def __init__(self, tei_filenames, uri_template, root=None, interval=0.5,
+                 cache=None, jobs=None, parser=None, stats=None, **options):
+        self.tei_filenames = list(tei_filenames)
+        self.uri_template = uri_template
+        self.root = root or batch.common_dir(self.tei_filenames)
+        self.interval = interval
+        self.cache = cache
+        self.jobs = jobs
+        self.parser = parser
+        self.stats = stats or NULL_STATS
+        self.options = options
+        self.documents = {}
+        # by document: the files it was built from with their stamps, and
+        # its surfaces by the key of the file they were parsed from
+        self._stamps = {}
+        self._surfaces = {}
+
+    def run(self):
+        """
+        Builds every document and then keeps rebuilding the ones that
+        change, until interrupted.
+        """
+        self.build()
+        while True:
+            time.sleep(self.interval)
+            self.poll()
+
+    def poll(self):
+        """
+        Rebuilds the documents that changed since they were last built, and
+        returns the paths that were written.
+        """
+        changed = [f for f in self.tei_filenames if self.changed(f)]
+        if not changed:
+            return []
+        return self.build(changed)
+
+    def changed(self, tei_filename):
+        """
+        Returns true if the TEI of a document or any of its surfaces have
+        changed since it was last built.
+        """
+        stamps = self._stamps.get(tei_filename)
+        if stamps is None:
+            return True
+        return any(file_stamp(f) != stamp for f, stamp in stamps)
+
+    def build(self, tei_filenames=None):
+        """
+        Writes the manifests of some documents, or all of them, and returns
+        the paths that were written. A document that can't be built is
+        logged and tried again when it next changes.
+        """
+        written = []
+        for tei_filename in tei_filenames or self.tei_filenames:
+            start = timeit.default_timer()
+            try:
+                doc = self.load(tei_filename)
+                written.extend(batch.build([doc], self.uri_template,
+                                           root=self.root, stats=self.stats,
+                                           **self.options))
+            except batch.BuildError as e:
+                # batch.build has logged why
+                written.extend(e.written)
+                continue
+            except Exception:
+                log.exception("couldn't build %s", tei_filename)
+                continue
+            log.info("built %s in %.2fs", tei_filename, timeit.default_timer() - start)
+        return written
+
+    def load(self, tei_filename):
+        """
+        Parses a document, reusing the surfaces of the last time it was
+        parsed that haven't changed since.
+        """
+        # stamp the files first, so that a change while they are read is
+        # seen the next time round
+        files = [tei_filename] + self._files(tei_filename)
+        self._stamps[tei_filename] = [(f, file_stamp(f)) for f in files]
+
+        doc = tei.Document(tei_filename, cache=self.cache, jobs=self.jobs,
+                           stats=self.stats, parser=self.parser)
+        surfaces = self._surfaces.get(tei_filename, {})
+        keys = {}
+        reuse = {}
+        for n, filename in doc.page_filenames():
+            keys[n] = doc.surface_key(filename)
+            if keys[n] in surfaces:
+                reuse[n] = surfaces[keys[n]]
+        doc.load(reuse)
+
+        if doc.filenames != files[1:]:
+            self._stamps[tei_filename] = [(f, file_stamp(f)) for f in [tei_filename] + doc.filenames]
+        self._surfaces[tei_filename] = dict((keys[s.page], s) for s in doc.surfaces)
+        self.documents[tei_filename] = doc
+        return doc
+
+    def _files(self, tei_filename):
+        # the surface files of the document when it was last loaded
+        doc = self.documents.get(tei_filename)
+        return list(doc.filenames) if doc is not None else []
+
+
+def file_stamp(filename):
+    """
+    Returns what changes when a file is written (its modification time and
+    size), or None if there is no file.
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)